@@ -0,0 +1,86 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable
+
+
+class LRUCache:
+  """A thread-safe LRU cache that evicts by size, rather than by number of entries.
+
+  Each entry is stored with its size in bytes, and the least recently used entries
+  are evicted until the total is under `max_bytes`. An entry that is bigger than
+  `max_bytes` on its own is returned, but not kept.
+  """
+  def __init__(self, max_bytes: int):
+    self.max_bytes = max_bytes
+    self._entries: OrderedDict[Any, tuple[Any, int]] = OrderedDict()
+    self._lock = Lock()
+    # One lock per key that is being loaded, so that concurrent requests for the same
+    # (missing) key load it once.
+    self._loading: dict[Any, Lock] = {}
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key, default=None):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return default
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key, value, nbytes: int):
+    with self._lock:
+      if key in self._entries:
+        self.bytes -= self._entries.pop(key)[1]
+      if nbytes > self.max_bytes:
+        return
+      self._entries[key] = (value, nbytes)
+      self.bytes += nbytes
+      while self.bytes > self.max_bytes:
+        _, (_, evicted) = self._entries.popitem(last=False)
+        self.bytes -= evicted
+        self.evictions += 1
+
+  def get_or_load(self, key, load: Callable[[], tuple[Any, int]]):
+    """Returns the value of `key`, calling `load` to get `(value, nbytes)` if it isn't cached."""
+    missing = object()
+    value = self.get(key, missing)
+    if value is not missing:
+      return value
+
+    with self._lock:
+      key_lock = self._loading.setdefault(key, Lock())
+
+    with key_lock:
+      # Another thread might have loaded it while we were waiting.
+      with self._lock:
+        entry = self._entries.get(key)
+      if entry is not None:
+        return entry[0]
+      try:
+        value, nbytes = load()
+        self.put(key, value, nbytes)
+      finally:
+        with self._lock:
+          self._loading.pop(key, None)
+    return value
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.bytes = 0
+
+  def stats(self) -> dict:
+    with self._lock:
+      return {
+        "entries": len(self._entries),
+        "bytes": self.bytes,
+        "max_bytes": self.max_bytes,
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+      }
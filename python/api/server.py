@@ -0,0 +1,482 @@
+import sys; sys.path.extend([".", "..", "../..", "../etl"])
+
+import gzip
+import hashlib
+import json
+import os
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils.paths import tasks_folder
+from utils.store import IDENTIFYING_COLUMNS, SCHEMA, TIME_COLUMNS, list_subevents, store_folder
+from catalog import Catalog
+import compact
+from publish import get_race_name, race_names
+from cache import LRUCache
+from percentiles import MANIFEST_FILENAME, SPLIT_COLUMNS, PercentileIndex, percentiles_folder, sorted_runs
+
+
+# Bump this if the format of the responses changes, so that clients don't reuse old ETags.
+API_VERSION = "1"
+
+DEFAULT_PORT = 8765
+
+# The default size of the cache of (in-memory) subevents, and of serialized responses.
+DEFAULT_CACHE_MB = 512
+DEFAULT_RESPONSE_CACHE_MB = 64
+
+# Responses smaller than this aren't worth compressing.
+GZIP_MIN_BYTES = 1024
+
+# Requests for a subevent that isn't in the store trigger a rescan, at most this often (seconds).
+RESCAN_INTERVAL = 5.0
+
+# Keep the integer columns as integers (with nulls), rather than turning them into floats.
+PANDAS_TYPES = {pa.int16(): pd.Int16Dtype(), pa.int32(): pd.Int32Dtype(), pa.int64(): pd.Int64Dtype()}
+
+
+def param(query: dict[str, list[str]], name: str, default: str | None = None) -> str | None:
+  """Returns the (last) value of a query parameter."""
+  values = query.get(name)
+  return values[-1] if values else default
+
+
+def param_list(query: dict[str, list[str]], name: str) -> list[str] | None:
+  """Returns the values of a query parameter that can be repeated and/or comma-separated."""
+  values = query.get(name)
+  if not values:
+    return None
+  return [v for value in values for v in value.split(",") if v != ""]
+
+
+def param_int(query: dict[str, list[str]], name: str, default: int | None = None) -> int | None:
+  value = param(query, name)
+  if value is None:
+    return default
+  try:
+    return int(value)
+  except ValueError:
+    raise ValueError(f"`{name}` has to be an integer (got {value}).")
+
+
+def parse_time(value: str) -> float:
+  """Parses a time given in seconds ("14335") or as "H:MM:SS" ("3:58:55")."""
+  try:
+    seconds = 0.0
+    for part in value.split(":"):
+      seconds = 60 * seconds + float(part)
+    return seconds
+  except ValueError:
+    raise ValueError(f"Couldn't parse the time {value} (use seconds or H:MM:SS).")
+
+
+def to_records(df: pd.DataFrame) -> list[dict]:
+  """Returns the rows of a dataframe as JSON-serializable dicts (missing values become None)."""
+  df = df.astype(object)
+  return df.where(df.notna(), None).to_dict(orient="records")
+
+
+@dataclass
+class SubeventData:
+  """The results of a subevent, loaded into memory."""
+  subevent_id: str
+  df: pd.DataFrame
+  gender: np.ndarray # the first letter of each age group (like the rankings)
+  nbytes: int
+  # The sorted times of each (split, group), for subevents that aren't in the percentile index yet.
+  runs: dict[tuple[str, str], np.ndarray] | None = None
+
+  def sorted_times(self, split: str, group: str) -> np.ndarray:
+    """Returns the sorted times of a group (the same ones as `percentiles.PercentileIndex`)."""
+    if self.runs is None:
+      self.runs = sorted_runs(self.df)
+    return self.runs.get((split, group), np.empty(0, dtype=np.int32))
+
+
+class ResultsService:
+  """Answers queries about the results store (see `utils/store.py`) from memory.
+
+  The subevents that are queried are loaded into an LRU cache that is bounded by
+  their size in memory, and the serialized responses are cached too (keyed by their
+  ETag). The ETag of a response depends on the query and the size and modification
+  time of the subevent's file, so a changed file is picked up on the next request.
+
+  Everything is read from the local `data` and `tasks` folders, so this works offline.
+  """
+  def __init__(
+    self,
+    folder: str = store_folder(),
+    subevents_csv: str = tasks_folder("im/subevents.csv"),
+    catalog_path: str = tasks_folder("im/catalog.json"),
+    cache_bytes: int = DEFAULT_CACHE_MB * 1_000_000,
+    response_cache_bytes: int = DEFAULT_RESPONSE_CACHE_MB * 1_000_000,
+    anonymized: bool = True,
+    percentiles: PercentileIndex | None = None,
+  ):
+    self.folder = folder
+    self.subevents_csv = subevents_csv
+    self.catalog_path = catalog_path
+    self.anonymized = anonymized
+    # Percentiles are looked up in the index if it's been built (see `etl/percentiles.py`).
+    if percentiles is None and os.path.exists(percentiles_folder(MANIFEST_FILENAME)):
+      percentiles = PercentileIndex(percentiles_folder())
+    self.percentiles = percentiles
+    self.subevents = LRUCache(cache_bytes)
+    self.responses = LRUCache(response_cache_bytes)
+    self._lock = Lock()
+    self._scanned_at = 0.0
+    self.refresh()
+
+  def refresh(self):
+    """Scans the store for subevents, and rebuilds the race index."""
+    paths = list_subevents(self.folder)
+
+    catalog = Catalog(self.catalog_path)
+    races = {}
+    if os.path.exists(self.subevents_csv):
+      df = pd.read_csv(self.subevents_csv).drop_duplicates(subset=["subevent_id"])
+      df["id"] = df.results_url.map(get_race_name)
+      df["name"] = race_names(df)
+      for row in df.itertuples():
+        race = races.setdefault(row.id, {"id": row.id, "name": row.name, "series": row.series, "subevents": []})
+        summary = catalog.get(row.subevent_id) or {}
+        race["subevents"].append({
+          "id": row.subevent_id,
+          "year": int(row.year),
+          "in_store": row.subevent_id in paths,
+          "participants": summary.get("participants"),
+          "finishers": summary.get("finishers"),
+        })
+
+    with self._lock:
+      self.paths = paths
+      self.races = list(races.values())
+      self.races_version = hashlib.sha256(json.dumps(self.races).encode()).hexdigest()
+      self._scanned_at = time.monotonic()
+
+  def path(self, subevent_id: str) -> str:
+    """Returns the path to the file of a subevent, or raises a KeyError if it isn't in the store."""
+    path = self.paths.get(subevent_id)
+    if path is None and time.monotonic() - self._scanned_at > RESCAN_INTERVAL:
+      self.refresh()
+      path = self.paths.get(subevent_id)
+    if path is None:
+      raise KeyError(f"{subevent_id} isn't in the results store.")
+    return path
+
+  def signature(self, subevent_id: str) -> str:
+    """Returns a string that changes whenever the file of a subevent does."""
+    try:
+      stat = os.stat(self.path(subevent_id))
+    except FileNotFoundError:
+      raise KeyError(f"{subevent_id} was removed from the results store.")
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+  def race(self, race_id: str) -> dict:
+    """Returns a race from the race index, or raises a KeyError if there isn't one."""
+    for race in self.races:
+      if race["id"] == race_id:
+        return race
+    raise KeyError(f"There's no race called {race_id}.")
+
+  def etag(self, route: str, subevent_id: str | None, query: dict[str, list[str]], race_id: str | None = None) -> str:
+    """Returns the ETag of a response, without computing it."""
+    if race_id is not None:
+      subevents = [s["id"] for s in self.race(race_id)["subevents"] if s["id"] in self.paths]
+      version = [self.races_version] + [self.signature(s) for s in subevents]
+    else:
+      version = self.races_version if subevent_id is None else self.signature(subevent_id)
+    canonical = json.dumps([API_VERSION, route, subevent_id, version, self.anonymized, sorted(query.items())])
+    return '"' + hashlib.sha256(canonical.encode()).hexdigest()[:32] + '"'
+
+  def load(self, subevent_id: str) -> SubeventData:
+    """Returns the results of a subevent, from the cache if they were loaded before."""
+    path = self.path(subevent_id)
+
+    def read():
+      columns = [c for c in SCHEMA.names if not (self.anonymized and c in IDENTIFYING_COLUMNS)]
+      df = pq.read_table(path, columns=columns).to_pandas(types_mapper=PANDAS_TYPES.get)
+      age_groups = df.AgeGroup.cat.categories.astype(str)
+      gender = np.array([ag[:1] for ag in age_groups] + [""])[df.AgeGroup.cat.codes.to_numpy()]
+      nbytes = int(df.memory_usage(deep=True).sum()) + gender.nbytes
+      return SubeventData(subevent_id, df, gender, nbytes), nbytes
+
+    return self.subevents.get_or_load((subevent_id, self.signature(subevent_id)), read)
+
+  def get_races(self, query: dict[str, list[str]]) -> dict:
+    """The race index, optionally filtered by `series` and `year`."""
+    series, years = param_list(query, "series"), param_list(query, "year")
+    races = []
+    for race in self.races:
+      if series is not None and race["series"] not in series:
+        continue
+      subevents = [s for s in race["subevents"] if years is None or str(s["year"]) in years]
+      if subevents:
+        races.append({**race, "subevents": subevents})
+    return {"races": races}
+
+  def get_subevent(self, subevent_id: str, query: dict[str, list[str]]) -> dict:
+    """A summary of a subevent: its columns and the counts of each age group and status."""
+    data = self.load(subevent_id)
+    df = data.df
+    return {
+      "id": subevent_id,
+      "n": len(df),
+      "columns": list(df.columns),
+      "age_groups": {str(k): int(v) for k, v in df.AgeGroup.value_counts(sort=False).items() if v > 0},
+      "statuses": {str(k): int(v) for k, v in df.EventStatus.value_counts(sort=False).items() if v > 0},
+    }
+
+  def get_results(self, subevent_id: str, query: dict[str, list[str]]) -> dict:
+    """The results of a subevent, filtered by `age_group`, `gender` and `status`.
+
+    The rows can be sorted by a column (`sort=FinishTime`, or `sort=-FinishTime` for
+    descending), and paged with `offset` and `limit`. Missing and zero times sort
+    last. Pass `columns` to only get some of the columns, and `format=columnar` to
+    get struct-of-arrays JSON (see `compact.encode`).
+    """
+    data = self.load(subevent_id)
+    df = data.df
+
+    mask = np.ones(len(df), dtype=bool)
+    age_groups, genders, statuses = param_list(query, "age_group"), param_list(query, "gender"), param_list(query, "status")
+    if age_groups is not None:
+      mask &= df.AgeGroup.isin(age_groups).to_numpy()
+    if genders is not None:
+      mask &= np.isin(data.gender, [g.upper() for g in genders])
+    if statuses is not None:
+      mask &= df.EventStatus.isin(statuses).to_numpy()
+    index = np.flatnonzero(mask)
+
+    sort = param(query, "sort")
+    if sort is not None:
+      column = sort.lstrip("-")
+      if column not in df:
+        raise ValueError(f"Can't sort by {column}.")
+      if column in TIME_COLUMNS:
+        values = pd.Series(df[column].to_numpy(dtype=np.float64, na_value=np.nan)[index])
+        values = values.where(values > 0)
+      else:
+        values = df[column].iloc[index].reset_index(drop=True)
+      order = values.sort_values(ascending=not sort.startswith("-"), kind="stable", na_position="last").index
+      index = index[order.to_numpy()]
+
+    offset, limit = param_int(query, "offset", 0), param_int(query, "limit")
+    if offset < 0 or (limit is not None and limit < 0):
+      raise ValueError("`offset` and `limit` can't be negative.")
+    page = index[offset:] if limit is None else index[offset:offset + limit]
+
+    columns = param_list(query, "columns") or list(df.columns)
+    unknown = [c for c in columns if c not in df]
+    if unknown:
+      raise ValueError(f"Unknown columns: {unknown}")
+    rows = df.iloc[page][columns]
+
+    if param(query, "format", "rows") == "columnar":
+      return compact.encode(rows.reset_index(drop=True), len(index))
+    return {"total": len(index), "n": len(rows), "data": to_records(rows)}
+
+  def counts(self, subevent_id: str, split: str, group: str, t: np.ndarray) -> tuple[np.ndarray, np.ndarray, int]:
+    """Returns the number of times in a group that are faster than each of `t`, faster or tied, and in total.
+
+    These come from the percentile index if the subevent is in it (and hasn't changed
+    since), and from its results otherwise.
+    """
+    if self.percentiles is not None and self.percentiles.fresh(subevent_id, self.path(subevent_id)):
+      faster, faster_or_tied, n = self.percentiles.counts(self.percentiles.run_ids(subevent_id, split, group).repeat(len(t)), t)
+      return faster, faster_or_tied, int(n[0]) if len(n) else 0
+    values = self.load(subevent_id).sorted_times(split, group)
+    return np.searchsorted(values, t, side="left"), np.searchsorted(values, t, side="right"), len(values)
+
+  def percentile_query(self, query: dict[str, list[str]]) -> tuple[str, str, np.ndarray]:
+    split = param(query, "split", "FinishTime")
+    if split not in SPLIT_COLUMNS:
+      raise ValueError(f"`split` has to be one of {SPLIT_COLUMNS}.")
+    group = param(query, "group", "overall")
+    times = param_list(query, "time")
+    if not times:
+      raise ValueError("Pass at least one `time`.")
+    return split, group, np.array([parse_time(value) for value in times])
+
+  @staticmethod
+  def percentile_response(split: str, group: str, t: np.ndarray, faster: np.ndarray, faster_or_tied: np.ndarray, n: int) -> dict:
+    return {
+      "split": split,
+      "group": group,
+      "n": n,
+      "time": t.tolist(),
+      "rank": (faster + 1).tolist(),
+      "percentile": (np.round(100 * (n - faster_or_tied) / n, 2).tolist() if n > 0 else [None] * len(t)),
+    }
+
+  def get_percentile(self, subevent_id: str, query: dict[str, list[str]]) -> dict:
+    """Where one or more times (`time=4:58:10,5:10:00`) would place in a group.
+
+    These are the same times that are ranked (see `ranking.py`): every positive time,
+    whatever the status of the athlete. For each time, `rank` is 1 + the number of
+    athletes who were faster, and `percentile` is the percentage who were slower.
+    """
+    split, group, t = self.percentile_query(query)
+    return self.percentile_response(split, group, t, *self.counts(subevent_id, split, group, t))
+
+  def get_race_percentile(self, race_id: str, query: dict[str, list[str]]) -> dict:
+    """Like `get_percentile`, but pooling the times of every year of a race (or the `year`s that are given)."""
+    split, group, t = self.percentile_query(query)
+    years = param_list(query, "year")
+    subevents = [s for s in self.race(race_id)["subevents"]
+                 if s["id"] in self.paths and (years is None or str(s["year"]) in years)]
+    faster, faster_or_tied, n = np.zeros(len(t), dtype=np.int64), np.zeros(len(t), dtype=np.int64), 0
+    for s in subevents:
+      f, ft, count = self.counts(s["id"], split, group, t)
+      faster, faster_or_tied, n = faster + f, faster_or_tied + ft, n + count
+    response = self.percentile_response(split, group, t, faster, faster_or_tied, n)
+    return {"race": race_id, "years": sorted(s["year"] for s in subevents), **response}
+
+  def stats(self) -> dict:
+    return {"subevents": self.subevents.stats(), "responses": self.responses.stats(), "store": len(self.paths)}
+
+
+# Routes of the form `/subevents/<id>/<name>`. The empty name is the subevent itself.
+SUBEVENT_ROUTES = {
+  "": ResultsService.get_subevent,
+  "results": ResultsService.get_results,
+  "percentile": ResultsService.get_percentile,
+}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+  """Serves the `ResultsService` of the server as JSON.
+
+  - `GET /races?series=IRONMAN-70.3&year=2023`
+  - `GET /subevents/<id>`
+  - `GET /subevents/<id>/results?age_group=M30-34&status=Finish&sort=FinishTime&limit=50`
+  - `GET /subevents/<id>/percentile?split=BikeTime&group=f-overall&time=2:45:00`
+  - `GET /races/<id>/percentile?split=FinishTime&group=M30-34&time=4:58:10&year=2022,2023` (pooled across years)
+  - `GET /stats` (the cache statistics)
+  """
+  protocol_version = "HTTP/1.1"
+  # The headers and the body are written separately, which stalls keep-alive connections
+  # (Nagle's algorithm and delayed ACKs) unless small packets are sent right away.
+  disable_nagle_algorithm = True
+  server: "ResultsServer"
+
+  def do_GET(self):
+    service = self.server.service
+    url = urlparse(self.path)
+    query = parse_qs(url.query)
+    parts = [p for p in url.path.split("/") if p]
+
+    try:
+      if parts == ["stats"]:
+        return self.send_json(200, json.dumps(service.stats()).encode())
+      elif parts == ["races"]:
+        route, subevent_id, get = "races", None, lambda: service.get_races(query)
+      elif len(parts) == 3 and parts[0] == "races" and parts[2] == "percentile":
+        route, subevent_id, get = "race-percentile", None, lambda: service.get_race_percentile(parts[1], query)
+      elif len(parts) in (2, 3) and parts[0] == "subevents" and (parts + [""])[2] in SUBEVENT_ROUTES:
+        route, subevent_id = (parts + [""])[2], parts[1]
+        method = SUBEVENT_ROUTES[route]
+        get = lambda: method(service, subevent_id, query)
+      else:
+        return self.send_error_json(404, f"Unknown route {url.path}")
+
+      etag = service.etag(route, subevent_id, query, race_id=parts[1] if route == "race-percentile" else None)
+      if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+        return self.send_json(304, b"", etag=etag)
+
+      body = service.responses.get_or_load(etag, lambda: self.serialize(get()))
+      if "gzip" in self.headers.get("Accept-Encoding", "") and len(body) >= GZIP_MIN_BYTES:
+        body = service.responses.get_or_load((etag, "gzip"), lambda: self.compress(body))
+        return self.send_json(200, body, etag=etag, encoding="gzip")
+      return self.send_json(200, body, etag=etag)
+
+    except KeyError as e:
+      return self.send_error_json(404, e.args[0])
+    except ValueError as e:
+      return self.send_error_json(400, str(e))
+
+  @staticmethod
+  def serialize(value: dict) -> tuple[bytes, int]:
+    body = json.dumps(value, separators=(",", ":")).encode("utf-8")
+    return body, len(body)
+
+  @staticmethod
+  def compress(body: bytes) -> tuple[bytes, int]:
+    gz = gzip.compress(body, compresslevel=6, mtime=0)
+    return gz, len(gz)
+
+  def send_json(self, status: int, body: bytes, etag: str | None = None, encoding: str | None = None):
+    self.send_response(status)
+    if status != 304:
+      self.send_header("Content-Type", "application/json")
+    if etag is not None:
+      self.send_header("ETag", etag)
+      # Clients can keep the response, but have to check that it's still current.
+      self.send_header("Cache-Control", "no-cache")
+      self.send_header("Vary", "Accept-Encoding")
+    if encoding is not None:
+      self.send_header("Content-Encoding", encoding)
+    if status != 304:
+      self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    if status != 304:
+      self.wfile.write(body)
+
+  def send_error_json(self, status: int, message: str):
+    self.send_json(status, json.dumps({"error": message}).encode())
+
+  def log_message(self, format: str, *args):
+    if self.server.verbose:
+      super().log_message(format, *args)
+
+
+class ResultsServer(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address: tuple[str, int], service: ResultsService, verbose: bool = False):
+    super().__init__(address, RequestHandler)
+    self.service = service
+    self.verbose = verbose
+
+
+def main():
+  """Serve the results store over HTTP (locally)."""
+  from argparse import ArgumentParser
+  parser = ArgumentParser(description="Serve the results store over HTTP (locally).")
+  parser.add_argument("--host", type=str, default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+  parser.add_argument("--store", type=str, default=store_folder(), help="The folder of the results store")
+  parser.add_argument("--cache-mb", type=int, default=DEFAULT_CACHE_MB, help="The memory to use for subevents")
+  parser.add_argument("--response-cache-mb", type=int, default=DEFAULT_RESPONSE_CACHE_MB, help="The memory to use for responses")
+  parser.add_argument("--identifying", action="store_true", help=f"Include the identifying columns {IDENTIFYING_COLUMNS}")
+  parser.add_argument("--verbose", action="store_true", help="Log every request")
+  args = parser.parse_args()
+
+  service = ResultsService(
+    folder=args.store,
+    cache_bytes=args.cache_mb * 1_000_000,
+    response_cache_bytes=args.response_cache_mb * 1_000_000,
+    anonymized=not args.identifying,
+  )
+  server = ResultsServer((args.host, args.port), service, verbose=args.verbose)
+  print(f"Serving {len(service.paths)} subevents on http://{args.host}:{args.port}")
+
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+  print("DONE")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,133 @@
+import sys; sys.path.extend([".", "..", "../..", "../etl"])
+
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from utils.store import TIME_COLUMNS, list_subevents, to_table
+from athletes import AthleteIndex, contact_key
+from synthetic import AGE_GROUPS
+
+
+def make_corpus(folder: str, subevents: int, n: int, population: int, seed: int = 0) -> list[str]:
+  """Writes `subevents` synthetic subevents to a results store in `folder`.
+
+  The athletes are drawn from a `population`, with some of them racing much more
+  often than others, so that the same athletes show up across subevents. Returns the
+  subevent IDs.
+  """
+  rng = np.random.default_rng(seed)
+  contact_ids = np.array([f"{i:08X}-0000-0000-0000-000000000000" for i in range(population)], dtype=object)
+  names = np.array([f"Athlete {i}" for i in range(population)], dtype=object)
+  popularity = rng.pareto(1.5, size=population) + 1
+  popularity /= popularity.sum()
+
+  ids = []
+  for s in range(subevents):
+    subevent_id = f"{s:08d}-0000-0000-0000-000000000000"
+    athletes = rng.choice(population, size=n, replace=False, p=popularity)
+    df = pd.DataFrame({
+      "SubEventId": subevent_id,
+      "ContactId": contact_ids[athletes],
+      "ContactFullName": names[athletes],
+      "AgeGroup": np.char.add(rng.choice(["M", "F"], size=n), rng.choice(AGE_GROUPS, size=n)),
+      "EventStatus": "Finish",
+    })
+    for split in TIME_COLUMNS:
+      df[split] = rng.integers(100, 20000, size=n)
+    # Some results don't have a `ContactId`, and can only be found by name.
+    df.loc[rng.random(n) < 0.02, "ContactId"] = None
+
+    path = os.path.join(folder, f"series=IRONMAN/year={2000 + s % 25}/{subevent_id}.parquet")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(to_table(df), path, compression="zstd")
+    ids.append(subevent_id)
+  return ids
+
+
+def scan_for(paths: dict[str, str], contact_id: str) -> int:
+  """What finding an athlete takes without the index: read the `ContactId` of every subevent."""
+  found = 0
+  for path in paths.values():
+    found += int((pq.read_table(path, columns=["ContactId"]).column(0).to_numpy(zero_copy_only=False) == contact_id).sum())
+  return found
+
+
+def folder_bytes(folder: str) -> int:
+  return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(folder) for f in files)
+
+
+def timeit(func, args: list) -> np.ndarray:
+  """Returns the time (in seconds) of `func(*a)` for each `a` in `args`."""
+  times = np.empty(len(args))
+  for i, a in enumerate(args):
+    t0 = time.perf_counter()
+    func(*a)
+    times[i] = time.perf_counter() - t0
+  return times
+
+
+def main():
+  """Measure the cost of building the athlete index, and of looking athletes up in it."""
+  from argparse import ArgumentParser
+  parser = ArgumentParser()
+  parser.add_argument("--subevents", type=int, default=1200)
+  parser.add_argument("--n", type=int, default=1500, help="The number of results in each subevent")
+  parser.add_argument("--population", type=int, default=400_000, help="The number of distinct athletes")
+  parser.add_argument("--lookups", type=int, default=2000)
+  args = parser.parse_args()
+
+  store = tempfile.mkdtemp()
+  out = tempfile.mkdtemp()
+  t0 = time.perf_counter()
+  ids = make_corpus(store, args.subevents, args.n, args.population)
+  print(f"Wrote {args.subevents} subevents ({args.subevents * args.n} results) in {time.perf_counter() - t0:.0f}s")
+
+  # Build the index from most of the store, and then add the rest incrementally.
+  paths = list_subevents(store)
+  initial = {s: paths[s] for s in ids[:-10]}
+  index = AthleteIndex(out)
+  t0 = time.perf_counter()
+  index.update(initial)
+  build_sec = time.perf_counter() - t0
+
+  t0 = time.perf_counter()
+  index.update(paths)
+  update_sec = time.perf_counter() - t0
+
+  index = AthleteIndex(out)
+  rng = np.random.default_rng(1)
+  athletes = rng.integers(args.population, size=args.lookups)
+  by_id = timeit(index.find, [(f"{i:08X}-0000-0000-0000-000000000000",) for i in athletes])
+  by_name = timeit(lambda name: index.find(name=name), [(f"athlete {i}",) for i in athletes])
+  frames = timeit(index.results, [(f"{i:08X}-0000-0000-0000-000000000000",) for i in athletes[:200]])
+  pairs = rng.choice(ids, size=(args.lookups, 2))
+  overlap = timeit(index.overlap, [tuple(p) for p in pairs])
+
+  contact_id = f"{athletes[0]:08X}-0000-0000-0000-000000000000"
+  t0 = time.perf_counter()
+  scanned = scan_for(paths, contact_id)
+  scan_sec = time.perf_counter() - t0
+  assert scanned == len(index.find(contact_id)), "The index and the scan found a different number of results"
+
+  mean_results = np.mean([len(index.find_keys([contact_key(f"{i:08X}-0000-0000-0000-000000000000")])) for i in athletes[:200]])
+  print(f"Built the index of {args.subevents - 10} subevents in {build_sec:.1f}s, and added 10 more in {update_sec:.2f}s "
+        f"({len(index.segments)} segments, {folder_bytes(out) / 1e6:.0f}MB on disk)")
+  print()
+  print(f"{'query':32} {'p50':>9} {'p99':>9}")
+  for label, times in (
+    (f"find (ContactId, ~{mean_results:.1f} results)", by_id),
+    ("find (name)", by_name),
+    ("results (dataframe)", frames),
+    ("overlap (two subevents)", overlap),
+  ):
+    print(f"{label:32} {np.percentile(times, 50) * 1e6:>7.0f}us {np.percentile(times, 99) * 1e6:>7.0f}us")
+  print(f"{'scan every subevent':32} {scan_sec * 1000:>7.0f}ms")
+
+
+if __name__ == "__main__":
+  main()
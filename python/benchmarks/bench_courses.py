@@ -0,0 +1,70 @@
+import sys; sys.path.extend([".", "..", "../..", "../sim"])
+
+import tempfile
+import time
+
+import numpy as np
+
+from utils.paths import courses_folder
+from simulator import load_course, simulate_batch
+from compile_courses import compile_course, load_compiled, save_manifest
+from bench_simulator import random_setups
+
+
+def best_of(func, repeat: int) -> float:
+  """Returns the fastest of `repeat` runs (in seconds)."""
+  times = []
+  for _ in range(repeat):
+    t0 = time.perf_counter()
+    func()
+    times.append(time.perf_counter() - t0)
+  return min(times)
+
+
+def time_lookups(course, n: int, steps: int = 1000) -> float:
+  """Returns the time (in seconds) of one lookup for `n` riders that are spread out over the course."""
+  x = np.linspace(0, course.total_distance * 0.9, n)
+  cursor = np.zeros(n, dtype=np.int64)
+  # Get the cursors to the right place first, as they would be in a simulation.
+  _, _, _, cursor = course.lookup(x, cursor)
+
+  t0 = time.perf_counter()
+  for _ in range(steps):
+    x = x + 1.0
+    _, _, _, cursor = course.lookup(x, cursor)
+  return (time.perf_counter() - t0) / steps
+
+
+def main():
+  """Compare the raw JSON courses with the compiled courses."""
+  from argparse import ArgumentParser
+  parser = ArgumentParser()
+  parser.add_argument("--courses", nargs="+", default=["IM_Lake_Placid_140.6", "Haleakala_Climb"])
+  parser.add_argument("--n", type=int, default=500, help="The number of setups to simulate in a batch")
+  parser.add_argument("--repeat", type=int, default=5)
+  args = parser.parse_args()
+
+  folder = tempfile.mkdtemp()
+  save_manifest(folder, {name: compile_course(courses_folder(f"{name}.json"), folder) for name in args.courses})
+  setups = random_setups(args.n)
+
+  print(f"{'course':22} {'':9} {'load':>9} {'lookup':>10} {'simulate':>10} {'finish time error':>18}")
+
+  for name in args.courses:
+    raw = load_course(name)
+    compiled = load_compiled(name, folder)
+
+    results = {}
+    for label, course, load in (("json", raw, lambda: load_course(name)), ("compiled", compiled, lambda: load_compiled(name, folder))):
+      load_sec = best_of(load, args.repeat)
+      lookup_sec = min(time_lookups(course, args.n) for _ in range(args.repeat))
+      t0 = time.perf_counter()
+      results[label] = simulate_batch(course, **setups)
+      sim_sec = time.perf_counter() - t0
+      error = np.abs(results[label].finish_time - results["json"].finish_time)
+      print(f"{name:22} {label:9} {load_sec * 1000:>7.2f}ms {lookup_sec * 1e6:>8.1f}us {sim_sec:>9.1f}s "
+            f"{error.mean():>8.2f}s (mean) {error.max():.1f}s (max)")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,106 @@
+import sys; sys.path.extend([".", "..", "../..", "../etl"])
+
+import os
+import tempfile
+import time
+from functools import partial
+
+import http_cache
+import mock_api
+
+
+def timed(func) -> tuple[object, float]:
+  t0 = time.perf_counter()
+  value = func()
+  return value, time.perf_counter() - t0
+
+
+def quiet(func):
+  """Runs `func` without the URLs that the scrapers print."""
+  with open(os.devnull, "w") as devnull:
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+      return func()
+    finally:
+      sys.stdout = stdout
+
+
+def bench_discovery(urls: list[str], t: int, p: int) -> dict[str, tuple[int, float]]:
+  """Finds the subevents of every race with `crawl` on threads (like `main`), and with `crawl_all`."""
+  from job import Job, JobStatus, stream_pooled_jobs
+  from scrape_im_subevents import crawl, crawl_all
+
+  def threads():
+    results = stream_pooled_jobs([Job(crawl, (url,), dict(t=t)) for url in urls], t=t)
+    return sum(len(r.value) for r in results if r.status == JobStatus.FULFILLED)
+
+  def hybrid():
+    return sum(len(v) for v in crawl_all(urls, t=t, p=p).values() if not isinstance(v, Exception))
+
+  return {"threads": quiet(lambda: timed(threads)), "hybrid": quiet(lambda: timed(hybrid))}
+
+
+def bench_download(subevent_ids: list[str], t: int, p: int) -> dict[str, tuple[int, float]]:
+  """Downloads every subevent with `scrape_to_file` on threads, and with `fetch_pages`/`parse_pages` as hybrid jobs."""
+  from job import HybridJob, Job, JobStatus, stream_hybrid_jobs, stream_pooled_jobs
+  from scrape_im_results import fetch_pages, parse_pages, scrape_to_file
+
+  def threads():
+    folder = tempfile.mkdtemp()
+    results = stream_pooled_jobs([Job(scrape_to_file, (s,), dict(folder=folder)) for s in subevent_ids], t=t)
+    return sum(r.value["total"] for r in results if r.status == JobStatus.FULFILLED)
+
+  def hybrid():
+    # Write the files to a temporary folder rather than `data/im/json`.
+    folder = tempfile.mkdtemp()
+    parse = partial(parse_pages, folder=folder)
+    results = stream_hybrid_jobs([HybridJob(fetch_pages, parse, (s,), dict(folder=folder)) for s in subevent_ids], t=t, p=p)
+    return sum(r.value["total"] for r in results if r.status == JobStatus.FULFILLED)
+
+  return {"threads": quiet(lambda: timed(threads)), "hybrid": quiet(lambda: timed(hybrid))}
+
+
+def main():
+  """Compare downloading and parsing on threads with downloading on threads and parsing in processes."""
+  from argparse import ArgumentParser
+  parser = ArgumentParser()
+  parser.add_argument("--races", type=int, default=8, help="The number of races on the mock site")
+  parser.add_argument("--years", type=int, default=4, help="The number of subevents of each race")
+  parser.add_argument("--n", type=int, default=1500, help="The (average) number of results in each subevent")
+  parser.add_argument("--latency", type=float, default=0.02, help="Seconds the mock server waits before each response")
+  parser.add_argument("--t", type=int, default=8, help="The number of threads")
+  parser.add_argument("--p", type=int, default=None, help="The number of processes for the hybrid mode (default: one per CPU)")
+  args = parser.parse_args()
+
+  races = mock_api.make_races(args.races, args.years, args.n)
+  server, base_url = mock_api.start(races, mock_api.Faults(latency=args.latency))
+
+  # The scrapers read these when they're imported.
+  os.environ["COMPETITOR_API_URL"] = base_url
+  os.environ["IRONMAN_URL"] = base_url
+  os.environ.setdefault("API_KEY", "benchmark")
+  # Every request should go to the mock server, so that both modes do the same work.
+  http_cache.configure(mode="off")
+
+  p = args.p or os.cpu_count()
+  print(f"{len(races)} races, {sum(len(r.subevents) for r in races)} subevents, {args.t} threads, {p} processes ({os.cpu_count()} CPUs)")
+  if os.cpu_count() == 1:
+    print("NOTE: There's only one CPU, so the processes can't parse in parallel with the threads.")
+
+  try:
+    benches = {
+      "discovery": (bench_discovery([f"{base_url}/{race.slug}-results" for race in races], args.t, p), "subevents"),
+      "download": (bench_download([s[0] for race in races for s in race.subevents], args.t, p), "rows"),
+    }
+  finally:
+    server.terminate()
+
+  print(f"{'stage':10} {'mode':8} {'wall':>8} {'throughput':>16}")
+  for stage, (modes, unit) in benches.items():
+    for mode, (count, wall) in modes.items():
+      print(f"{stage:10} {mode:8} {wall:>7.2f}s {count / wall:>10.0f} {unit}/s")
+    print(f"{stage:10} {'speedup':8} {modes['threads'][1] / modes['hybrid'][1]:>7.2f}x")
+
+
+if __name__ == "__main__":
+  main()
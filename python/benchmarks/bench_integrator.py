@@ -0,0 +1,68 @@
+import sys; sys.path.extend([".", "..", "../..", "../sim"])
+
+import time
+
+import numpy as np
+
+from simulator import Params, load_course, simulate, simulate_batch
+from integrator import integrate, integrate_batch
+from bench_simulator import random_setups
+
+
+def reference_finish_times(course, setups: dict, timestep: float = 0.01) -> np.ndarray:
+  """Returns the finish times of a fine-step Euler simulation, extrapolated to a timestep of zero.
+
+  The error of Euler's method is proportional to the timestep, so running with
+  `timestep` and `2 * timestep` cancels out most of it (Richardson extrapolation).
+  """
+  fine = simulate_batch(course, Params(timestep=timestep), **setups).finish_time
+  coarse = simulate_batch(course, Params(timestep=2 * timestep), **setups).finish_time
+  return 2 * fine - coarse
+
+
+def main():
+  """Compare the fixed-timestep Euler simulation with the adaptive distance-domain integrator."""
+  from argparse import ArgumentParser
+  parser = ArgumentParser()
+  parser.add_argument("--course", type=str, default="IM_Boulder_70.3", help="The name of a course in `app/public/courses`")
+  parser.add_argument("--n", type=int, default=1000, help="The number of setups to simulate in a batch")
+  parser.add_argument("--check", type=int, default=10, help="The number of setups to check against the fine-step reference")
+  parser.add_argument("--tolerance", type=float, default=1e-4)
+  parser.add_argument("--record-every", type=float, default=100, help="The resolution (meters) of the recorded states")
+  args = parser.parse_args()
+
+  course = load_course(args.course)
+  setups = random_setups(args.n)
+  params = Params()
+
+  t0 = time.perf_counter()
+  euler = simulate_batch(course, params, **setups)
+  euler_sec = time.perf_counter() - t0
+
+  t0 = time.perf_counter()
+  adaptive = integrate_batch(course, params, tolerance=args.tolerance, **setups)
+  adaptive_sec = time.perf_counter() - t0
+
+  check = {k: v[:args.check] for k, v in setups.items()}
+  reference = reference_finish_times(course, check)
+  euler_error = np.abs(euler.finish_time[:args.check] - reference)
+  adaptive_error = np.abs(adaptive.finish_time[:args.check] - reference)
+
+  # The size of the states of one rider, at full resolution and decimated.
+  full = simulate(course, params).states
+  decimated = integrate(course, params, tolerance=args.tolerance, record_every=args.record_every)
+
+  print(f"course={course.name} n={args.n} tolerance={args.tolerance}")
+  print(f"{'method':22} {'steps':>8} {'time':>8} {'error (mean)':>13} {'error (max)':>12} {'states':>10}")
+  print(f"{'euler (dt=0.1)':22} {euler.iters:>8} {euler_sec:>7.1f}s {euler_error.mean():>12.2f}s {euler_error.max():>11.2f}s "
+        f"{full.memory_usage().sum() / 1000:>8.0f}kB")
+  print(f"{'adaptive (distance)':22} {adaptive.steps:>8} {adaptive_sec:>7.1f}s {adaptive_error.mean():>12.2f}s {adaptive_error.max():>11.2f}s "
+        f"{decimated.memory_usage().sum() / 1000:>8.0f}kB")
+  print()
+  print(f"The integrator takes {euler.iters / adaptive.steps:.0f}x fewer steps ({adaptive.rejected} rejected) "
+        f"and is {euler_sec / adaptive_sec:.1f}x faster. Its finish times are within {adaptive_error.max():.2f}s "
+        f"of the fine-step reference (vs {euler_error.max():.2f}s for Euler with dt=0.1).")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,61 @@
+import sys; sys.path.extend([".", "..", "../..", "../sim"])
+
+import tempfile
+import time
+
+import numpy as np
+
+from utils.paths import courses_folder
+from simulator import Params, load_course
+from compile_courses import compile_course, load_compiled, save_manifest
+from integrator import integrate_batch
+from pacing import DEFAULT_STEP, evaluate, make_track, optimize
+
+
+def main():
+  """Optimize the pacing of a full IRONMAN bike course, and check the plan with a fine-step simulation."""
+  from argparse import ArgumentParser
+  parser = ArgumentParser()
+  parser.add_argument("--course", type=str, default="IM_Lake_Placid_140.6", help="The name of a course in `app/public/courses`")
+  parser.add_argument("--power", type=float, default=200, help="The average power (watts)")
+  parser.add_argument("--max-np", type=float, default=210, help="The highest normalized power allowed (watts)")
+  parser.add_argument("--steps", type=float, nargs="+", default=[5, 25, 50, DEFAULT_STEP, 200], help="The steps (meters) to check the accuracy of")
+  parser.add_argument("--population", type=int, default=256)
+  parser.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args()
+
+  folder = tempfile.mkdtemp()
+  save_manifest(folder, {args.course: compile_course(courses_folder(f"{args.course}.json"), folder)})
+  course = load_compiled(args.course, folder)
+  params = Params(power_watts=args.power)
+
+  # The accuracy and speed of the evaluator, at a constant power.
+  reference = float(integrate_batch(load_course(args.course), params).finish_time)
+  print(f"course={course.name} power={args.power:.0f}W reference={reference:.1f}s (adaptive integrator)")
+  print(f"{'step':>6} {'steps':>7} {'finish time':>12} {'error':>8} {f'evaluate ({args.population} plans)':>24}")
+  for step in args.steps:
+    track = make_track(course, params, step=step)
+    plans = np.full((args.population, len(track.boundaries) - 1), args.power)
+    t0 = time.perf_counter()
+    finish_time = evaluate(track, plans).finish_time[0]
+    sec = time.perf_counter() - t0
+    print(f"{step:>5.0f}m {len(track.h):>7} {finish_time:>11.1f}s {finish_time - reference:>+7.1f}s {sec * 1000:>22.0f}ms")
+  print()
+
+  t0 = time.perf_counter()
+  track = make_track(course, params)
+  plan = optimize(track, args.power, max_normalized_power=args.max_np, population=args.population, seed=args.seed)
+  sec = time.perf_counter() - t0
+
+  # Check the plan (and the constant power baseline) with the most accurate evaluator.
+  fine = make_track(course, params, step=min(args.steps))
+  check = evaluate(fine, np.stack([plan.power, np.full_like(plan.power, args.power)]))
+  gain = check.finish_time[1] - check.finish_time[0]
+
+  print(f"Optimized {len(plan.power)} segments in {sec:.1f}s ({plan.iterations} iterations, {plan.evaluations} evaluations)")
+  print(f"At a {min(args.steps):.0f}m step: {check.finish_time[0]:.0f}s (vs {check.finish_time[1]:.0f}s at a constant {args.power:.0f}W), "
+        f"{gain:.0f}s ({100 * gain / check.finish_time[1]:.1f}%) faster with AP={check.average_power[0]:.1f}W NP={check.normalized_power[0]:.1f}W")
+
+
+if __name__ == "__main__":
+  main()
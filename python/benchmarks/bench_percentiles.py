@@ -0,0 +1,111 @@
+import sys; sys.path.extend([".", "..", "../..", "../etl"])
+
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from utils.store import list_subevents
+from percentiles import SPLIT_COLUMNS, PercentileIndex, RacePercentiles
+from bench_athletes import folder_bytes, make_corpus
+from synthetic import AGE_GROUPS
+
+
+def random_queries(races: pd.DataFrame, count: int, pooled: float = 0.2, seed: int = 0) -> pd.DataFrame:
+  """Returns (race, year, group, split, time) queries. Some of them pool every year of the race (no `year`)."""
+  rng = np.random.default_rng(seed)
+  rows = races.iloc[rng.integers(len(races), size=count)]
+  groups = np.char.add(rng.choice(["M", "F"], size=count), rng.choice(AGE_GROUPS, size=count)).astype(object)
+  groups[rng.random(count) < 0.3] = "overall"
+  year = rows.year.to_numpy(dtype=np.float64)
+  year[rng.random(count) < pooled] = np.nan
+  return pd.DataFrame({
+    "race": rows.race.to_numpy(),
+    "year": year,
+    "group": groups,
+    "split": rng.choice(SPLIT_COLUMNS, size=count),
+    "time": rng.integers(100, 20000, size=count).astype(np.float64),
+  })
+
+
+def load_and_sort(paths: dict[str, str], subevent_id: str, split: str, group: str, t: float) -> int:
+  """What answering one question takes without the index: load the subevent and sort the group."""
+  df = pq.read_table(paths[subevent_id], columns=["AgeGroup", split]).to_pandas()
+  values = df[split].to_numpy(dtype=np.float64)
+  if group != "overall":
+    values = values[(df.AgeGroup == group).to_numpy()]
+  values = np.sort(values[values > 0])
+  return int(np.searchsorted(values, t)) + 1
+
+
+def main():
+  """Measure the throughput of the percentile index, for single queries and for batches."""
+  from argparse import ArgumentParser
+  parser = ArgumentParser()
+  parser.add_argument("--subevents", type=int, default=600)
+  parser.add_argument("--n", type=int, default=1500, help="The number of results in each subevent")
+  parser.add_argument("--races", type=int, default=60, help="The subevents are spread over this many races")
+  parser.add_argument("--queries", type=int, default=20_000)
+  args = parser.parse_args()
+
+  store = tempfile.mkdtemp()
+  out = tempfile.mkdtemp()
+  ids = make_corpus(store, args.subevents, args.n, population=args.subevents * args.n // 3)
+  paths = list_subevents(store)
+  races = pd.DataFrame({
+    "race": [f"race-{i % args.races}" for i in range(len(ids))],
+    "year": [2000 + i // args.races for i in range(len(ids))],
+    "subevent_id": ids,
+  })
+
+  index = PercentileIndex(out)
+  t0 = time.perf_counter()
+  index.update(paths)
+  build_sec = time.perf_counter() - t0
+  t0 = time.perf_counter()
+  index.update(paths)
+  noop_sec = time.perf_counter() - t0
+  index = PercentileIndex(out)
+
+  queries = random_queries(races, args.queries)
+  print(f"Built the index of {len(ids)} subevents ({len(index.values)} times, {folder_bytes(out) / 1e6:.0f}MB) "
+        f"in {build_sec:.1f}s (an update with nothing to do takes {noop_sec:.2f}s)")
+  print()
+  print(f"{'':36} {'queries/sec':>12}")
+
+  # One query at a time, and in batches.
+  lookup = RacePercentiles(index, races)
+  columns = [queries[c].to_numpy() for c in ("race", "year", "group", "split", "time")]
+  for label, batch in (("one at a time", 1), ("batches of 100", 100), ("one batch", len(queries))):
+    count = min(len(queries), max(batch * 20, 2000))
+    t0 = time.perf_counter()
+    for i in range(0, count, batch):
+      lookup.lookup(*(c[i:i + batch] for c in columns))
+    print(f"{'RacePercentiles (' + label + ')':36} {count / (time.perf_counter() - t0):>12.0f}")
+
+  t0 = time.perf_counter()
+  lookup.query(queries)
+  print(f"{'RacePercentiles.query (dataframe)':36} {len(queries) / (time.perf_counter() - t0):>12.0f}")
+
+  # The vectorized lookup, by subevent ID (skipping the race -> subevent mapping).
+  single = queries[queries.year.notna()].merge(races, on=["race", "year"])
+  args_ = (single.subevent_id.to_numpy(), single.split.to_numpy(), single.group.to_numpy(), single.time.to_numpy())
+  t0 = time.perf_counter()
+  index.lookup(*args_)
+  print(f"{'lookup (one batch, by subevent)':36} {len(single) / (time.perf_counter() - t0):>12.0f}")
+
+  t0 = time.perf_counter()
+  for row in single.head(50).itertuples():
+    load_and_sort(paths, row.subevent_id, row.split, row.group, row.time)
+  print(f"{'load and sort (no index)':36} {50 / (time.perf_counter() - t0):>12.0f}")
+
+  # Check a sample against the brute force.
+  result = index.lookup(*(a[:200] for a in args_))
+  expected = [load_and_sort(paths, *a) for a in zip(*(a[:200] for a in args_))]
+  assert (result["rank"].to_numpy() == expected).all(), "The index and the brute force disagree"
+
+
+if __name__ == "__main__":
+  main()
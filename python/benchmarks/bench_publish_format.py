@@ -0,0 +1,78 @@
+import sys; sys.path.extend([".", "..", "../..", "../etl"])
+
+import gzip
+import json
+import time
+
+import brotli
+import pandas as pd
+
+import compact
+from ranking import rank_frame
+from synthetic import generate_results
+
+
+def best_of(func, repeat: int) -> float:
+  """Returns the fastest of `repeat` runs (in seconds)."""
+  times = []
+  for _ in range(repeat):
+    t0 = time.perf_counter()
+    func()
+    times.append(time.perf_counter() - t0)
+  return min(times)
+
+
+def main():
+  """Compare the size and parse time of the `rows` and `columnar` publish formats."""
+  from argparse import ArgumentParser
+  parser = ArgumentParser()
+  parser.add_argument("--n", type=int, default=3000, help="The number of results in the (synthetic) subevent")
+  parser.add_argument("--path", type=str, default=None, help="Use a results JSON file instead of synthetic data")
+  parser.add_argument("--repeat", type=int, default=5)
+  args = parser.parse_args()
+
+  if args.path:
+    with open(args.path, "r") as f:
+      data = json.load(f)
+  else:
+    data = dict(total=args.n, data=generate_results(args.n))
+    # Real results have some null nested objects (which `rank_frame` fills with -1).
+    data["data"][0]["Contact"] = None
+
+  df = rank_frame(pd.DataFrame(data["data"]))
+  rows = dict(total=data["total"], data=df.to_dict(orient="records"))
+
+  bodies = {
+    # This is what `publish.py --format rows` writes.
+    "rows": json.dumps(rows, indent=2).encode("utf-8"),
+    "rows (minified)": json.dumps(rows, separators=(",", ":")).encode("utf-8"),
+    "columnar": compact.dumps(compact.encode(df, data["total"])),
+  }
+
+  assert compact.decode(json.loads(bodies["columnar"]))["data"] == json.loads(bodies["rows"])["data"], \
+    "The columnar format doesn't decode to the same rows!"
+
+  print(f"n={len(df)}")
+  print(f"{'format':16} {'raw':>10} {'gzip':>10} {'brotli':>10} {'parse':>10}")
+
+  baseline = None
+  for name, body in bodies.items():
+    gz = len(gzip.compress(body, compresslevel=9))
+    br = len(brotli.compress(body, quality=11))
+    parse = best_of(lambda: json.loads(body), args.repeat)
+    print(f"{name:16} {len(body) / 1000:>8.1f}kB {gz / 1000:>8.1f}kB {br / 1000:>8.1f}kB {parse * 1000:>8.2f}ms")
+    baseline = baseline or (len(body), gz, br, parse)
+
+  body = bodies["columnar"]
+  decode = best_of(lambda: compact.decode(json.loads(body)), args.repeat)
+  print(f"{'columnar + rows':16} {'':>10} {'':>10} {'':>10} {decode * 1000:>8.2f}ms  (parse and decode back to row objects)")
+
+  raw, gz, br, parse = baseline
+  print()
+  print(f"The columnar format is {raw / len(body):.1f}x smaller raw, "
+        f"{gz / len(gzip.compress(body, compresslevel=9)):.1f}x smaller gzipped and "
+        f"parses {parse / best_of(lambda: json.loads(body), args.repeat):.1f}x faster than the rows format.")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,80 @@
+import sys; sys.path.extend([".", "..", "../..", "../etl"])
+
+import time
+import pandas as pd
+
+from ranking import rank_frame, rank_splits
+from synthetic import generate_results
+
+
+def rank_frame_pandas(df: pd.DataFrame) -> pd.DataFrame:
+  """The previous implementation of `rank_frame`, with one groupby per split and grouping."""
+  df["Gender"] = df.AgeGroup.map(lambda ag: ag[0] if not pd.isna(ag) else pd.NA)
+  df["FinishRankGroup"] = df[df.FinishTime > 0].groupby(by=["AgeGroup"])["FinishTime"].rank(method="min", ascending=True)
+  df["SwimRankGroup"] = df[df.SwimTime > 0].groupby(by=["AgeGroup"])["SwimTime"].rank(method="min", ascending=True)
+  df["BikeRankGroup"] = df[df.BikeTime > 0].groupby(by=["AgeGroup"])["BikeTime"].rank(method="min", ascending=True)
+  df["RunRankGroup"] = df[df.RunTime > 0].groupby(by=["AgeGroup"])["RunTime"].rank(method="min", ascending=True)
+
+  df["FinishRankGender"] = df[df.FinishTime > 0].groupby(by=["Gender"])["FinishTime"].rank(method="min", ascending=True)
+  df["SwimRankGender"] = df[df.SwimTime > 0].groupby(by=["Gender"])["SwimTime"].rank(method="min", ascending=True)
+  df["BikeRankGender"] = df[df.BikeTime > 0].groupby(by=["Gender"])["BikeTime"].rank(method="min", ascending=True)
+  df["RunRankGender"] = df[df.RunTime > 0].groupby(by=["Gender"])["RunTime"].rank(method="min", ascending=True)
+
+  df["FinishRankOverall"] = df[df.FinishTime > 0]["FinishTime"].rank(method="min", ascending=True)
+  df["SwimRankOverall"] = df[df.SwimTime > 0]["SwimTime"].rank(method="min", ascending=True)
+  df["BikeRankOverall"] = df[df.BikeTime > 0]["BikeTime"].rank(method="min", ascending=True)
+  df["RunRankOverall"] = df[df.RunTime > 0]["RunTime"].rank(method="min", ascending=True)
+
+  df.fillna(-1, inplace=True)
+
+  return df
+
+
+def rank_splits_pandas(data: list[dict]) -> list[dict]:
+  """The previous implementation of `rank_splits`."""
+  return rank_frame_pandas(pd.DataFrame(data)).to_dict(orient="records")
+
+
+def best_of(func, make_input, repeat: int) -> float:
+  """Returns the fastest of `repeat` runs (in seconds), not counting `make_input`."""
+  times = []
+  for _ in range(repeat):
+    x = make_input()
+    t0 = time.perf_counter()
+    func(x)
+    times.append(time.perf_counter() - t0)
+  return min(times)
+
+
+def main():
+  """Compare `rank_splits` with the previous pandas implementation on a large subevent."""
+  from argparse import ArgumentParser
+  parser = ArgumentParser()
+  parser.add_argument("--n", type=int, default=50000, help="The number of results in the subevent")
+  parser.add_argument("--repeat", type=int, default=5)
+  args = parser.parse_args()
+
+  data = generate_results(args.n)
+
+  expected = rank_splits_pandas(data)
+  actual = rank_splits(data)
+  assert actual == expected, "The outputs don't match!"
+
+  df = pd.DataFrame(data)
+
+  # The ranking on its own (dataframe in, ranked dataframe out).
+  before = best_of(rank_frame_pandas, df.copy, args.repeat)
+  after = best_of(rank_frame, df.copy, args.repeat)
+
+  # Including the conversion from and to a list of records (i.e what `publish.py` does).
+  before_total = best_of(rank_splits_pandas, lambda: data, args.repeat)
+  after_total = best_of(rank_splits, lambda: data, args.repeat)
+
+  print(f"n={args.n}")
+  print(f"{'':12} {'pandas':>10} {'vectorized':>10} {'speedup':>8}")
+  print(f"{'rank_frame':12} {before * 1000:>8.1f}ms {after * 1000:>8.1f}ms {before / after:>7.2f}x")
+  print(f"{'rank_splits':12} {before_total * 1000:>8.1f}ms {after_total * 1000:>8.1f}ms {before_total / after_total:>7.2f}x")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,110 @@
+import sys; sys.path.extend([".", "..", "../..", "../etl"])
+
+import json
+import os
+import tempfile
+import time
+import urllib.request
+
+import http_cache
+import mock_api
+import ratelimit
+from metrics import METRICS
+
+
+def mock_stats(base_url: str) -> dict:
+  with urllib.request.urlopen(f"{base_url}/stats") as response:
+    return json.load(response)
+
+
+def bench_download(subevent_ids: list[str], base_url: str, t: int, retries: int) -> dict:
+  """Downloads every subevent with `scrape_to_file` on `t` threads (like `scrape_im_results.py`)."""
+  from job import Backoff, Job, JobStatus, stream_pooled_jobs
+  from scrape_im_results import scrape_to_file
+
+  METRICS.drain()
+  before = mock_stats(base_url)
+  folder = tempfile.mkdtemp()
+  jobs = [Job(scrape_to_file, (s,), dict(folder=folder)) for s in subevent_ids]
+
+  # `scrape_to_file` prints every page it downloads.
+  with open(os.devnull, "w") as devnull:
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+      t0 = time.perf_counter()
+      results = list(stream_pooled_jobs(jobs, t=t, backoff=Backoff(retries=retries, delay=0.5)))
+      wall = time.perf_counter() - t0
+    finally:
+      sys.stdout = stdout
+
+  after = mock_stats(base_url)
+  report = METRICS.report()
+  rows = sum(r.value["total"] for r in results if r.status == JobStatus.FULFILLED)
+  return {
+    "wall_sec": wall,
+    "rows_per_sec": rows / wall,
+    "failed": sum(r.status != JobStatus.FULFILLED for r in results),
+    "throttled": after["throttled"] - before["throttled"],
+    "hedged": sum(report["counters"].get("ratelimit_hedges_total", {}).values()),
+    "concurrency": next(iter(report["gauges"].get("ratelimit_concurrency", {}).values()), None),
+  }
+
+
+def main():
+  """Compare fixed thread counts with the adaptive concurrency of `ratelimit.py`, against a rate-limited mock server."""
+  from argparse import ArgumentParser
+  parser = ArgumentParser()
+  parser.add_argument("--races", type=int, default=6, help="The number of races on the mock site")
+  parser.add_argument("--years", type=int, default=4, help="The number of subevents of each race")
+  parser.add_argument("--n", type=int, default=1500, help="The (average) number of results in each subevent")
+  parser.add_argument("--latency", type=float, default=0.02, help="Seconds the mock server waits before each response")
+  parser.add_argument("--jitter", type=float, default=0.01)
+  parser.add_argument("--rate-limit", type=float, default=150, help="The mock server responds with a 429 past this many requests per second")
+  parser.add_argument("--capacity", type=int, default=8, help="The mock server slows down past this many requests in flight")
+  parser.add_argument("--sigma", type=float, default=0.6,
+                      help="The sigma of the lognormal latency in the heavy-tailed run (typical of a web API)")
+  parser.add_argument("--fixed", type=int, nargs="+", default=[4, 32], help="The fixed thread counts to compare with")
+  parser.add_argument("--max-concurrency", type=int, default=ratelimit.DEFAULT_MAX_CONCURRENCY)
+  parser.add_argument("--retries", type=int, default=5, help="How many times a job is retried (with backoff)")
+  args = parser.parse_args()
+
+  races = mock_api.make_races(args.races, args.years, args.n)
+  subevent_ids = [s[0] for race in races for s in race.subevents]
+  os.environ.setdefault("API_KEY", "benchmark")
+  http_cache.configure(mode="off")
+
+  # The same server with a steady latency, and with a heavy-tailed one (where a
+  # single slow response says nothing about congestion).
+  scenarios = {
+    "steady": mock_api.Faults(latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit, capacity=args.capacity),
+    f"sigma={args.sigma}": mock_api.Faults(latency=args.latency, sigma=args.sigma, rate_limit=args.rate_limit, capacity=args.capacity),
+  }
+
+  print(f"{len(subevent_ids)} subevents, rate limit {args.rate_limit:.0f}/s, capacity {args.capacity}")
+  print(f"{'latency':10} {'mode':14} {'wall':>8} {'rows/s':>10} {'failed':>7} {'429s':>6} {'hedged':>7} {'limit':>6}")
+
+  for scenario, faults in scenarios.items():
+    server, base_url = mock_api.start(races, faults)
+    # The scrapers read this when they're imported, so point the module at each server.
+    os.environ["COMPETITOR_API_URL"] = base_url
+    import scrape_im_results
+    scrape_im_results.COMPETITOR_API_URL = base_url
+
+    try:
+      modes = {}
+      for t in args.fixed:
+        # Like before: `t` requests in flight, and a throttled request fails its job (which is retried with backoff).
+        ratelimit.configure(max_concurrency=t, adaptive=False, retries=0, hedge_budget=0)
+        modes[f"fixed t={t}"] = bench_download(subevent_ids, base_url, t, args.retries)
+      ratelimit.configure(max_concurrency=args.max_concurrency)
+      modes["adaptive"] = bench_download(subevent_ids, base_url, args.max_concurrency, args.retries)
+    finally:
+      server.terminate()
+
+    for mode, r in modes.items():
+      limit = f"{r['concurrency']:.1f}" if r["concurrency"] is not None else "-"
+      print(f"{scenario:10} {mode:14} {r['wall_sec']:>7.2f}s {r['rows_per_sec']:>10.0f} {r['failed']:>7} {r['throttled']:>6} {r['hedged']:>7.0f} {limit:>6}")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,158 @@
+import sys; sys.path.extend([".", "..", "../..", "../etl", "../api"])
+
+import http.client
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process, Queue
+
+import numpy as np
+import pyarrow.parquet as pq
+
+from utils.store import to_table
+from create_im_csv import flatten
+from synthetic import AGE_GROUPS, generate_results
+from server import ResultsServer, ResultsService
+
+
+def make_store(folder: str, subevents: int, n: int) -> list[str]:
+  """Writes synthetic subevents to a results store in `folder` (and their JSON files to `folder/json`).
+
+  Returns the subevent IDs.
+  """
+  ids = []
+  for i in range(subevents):
+    subevent_id = f"{i:08d}-0000-0000-0000-000000000000"
+    results = generate_results(n, seed=i, subevent_id=subevent_id)
+
+    path = os.path.join(folder, f"series=IRONMAN-70.3/year={2000 + i}/{subevent_id}.parquet")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(to_table(flatten(results)), path, compression="zstd")
+
+    os.makedirs(os.path.join(folder, "json"), exist_ok=True)
+    with open(os.path.join(folder, "json", f"{subevent_id}.json"), "w") as f:
+      json.dump({"total": n, "data": results}, f)
+    ids.append(subevent_id)
+  return ids
+
+
+def random_queries(ids: list[str], count: int, seed: int = 0) -> list[str]:
+  """Returns a mix of results, slice and percentile queries. Most of them go to a few "hot" subevents."""
+  rng = np.random.default_rng(seed)
+  hot = ids[:max(1, len(ids) // 10)]
+  queries = []
+  for _ in range(count):
+    subevent_id = rng.choice(hot) if rng.random() < 0.8 else rng.choice(ids)
+    age_group = rng.choice(["M", "F"]) + rng.choice(AGE_GROUPS)
+    kind = rng.integers(3)
+    if kind == 0:
+      queries.append(f"/subevents/{subevent_id}/results?age_group={age_group}&status=Finish&sort=FinishTime")
+    elif kind == 1:
+      queries.append(f"/subevents/{subevent_id}/results?gender={rng.choice(['M', 'F'])}&sort=BikeTime&limit=100")
+    else:
+      queries.append(f"/subevents/{subevent_id}/percentile?group={age_group}&time={int(rng.integers(14000, 24000))}")
+  return queries
+
+
+def run_clients(port: int, queries: list[str], clients: int, headers: dict, etags: dict | None = None) -> np.ndarray:
+  """Sends the queries from `clients` threads (with keep-alive connections). Returns the latency of each one.
+
+  If `etags` are given, the requests are conditional (`If-None-Match`).
+  """
+  local = threading.local()
+
+  def send(path: str) -> float:
+    if not hasattr(local, "connection"):
+      local.connection = http.client.HTTPConnection("127.0.0.1", port)
+    t0 = time.perf_counter()
+    local.connection.request("GET", path, headers=headers if etags is None else {**headers, "If-None-Match": etags[path]})
+    response = local.connection.getresponse()
+    response.read()
+    assert response.status in (200, 304), response.status
+    return time.perf_counter() - t0
+
+  with ThreadPoolExecutor(clients) as pool:
+    return np.array(list(pool.map(send, queries)))
+
+
+def reread_json(folder: str, path: str):
+  """What consumers do without the service: read the raw JSON file and filter it with pandas."""
+  subevent_id = path.split("/")[2]
+  with open(os.path.join(folder, "json", f"{subevent_id}.json")) as f:
+    df = flatten(json.load(f)["data"])
+  return df[(df.AgeGroup == "M30-34") & (df.EventStatus == "Finish")].sort_values("FinishTime")
+
+
+def serve(folder: str, cache_mb: int, ports: Queue):
+  """Runs the service on `folder` (in its own process, so that it doesn't share a GIL with the clients)."""
+  service = ResultsService(folder=folder, subevents_csv=os.path.join(folder, "subevents.csv"),
+                           catalog_path=os.path.join(folder, "catalog.json"), cache_bytes=cache_mb * 1_000_000)
+  server = ResultsServer(("127.0.0.1", 0), service)
+  ports.put(server.server_address[1])
+  server.serve_forever()
+
+
+def main():
+  """Measure the latency of the results service under concurrent load."""
+  from argparse import ArgumentParser
+  parser = ArgumentParser()
+  parser.add_argument("--subevents", type=int, default=40)
+  parser.add_argument("--n", type=int, default=2500, help="The number of results in each subevent")
+  parser.add_argument("--queries", type=int, default=4000)
+  parser.add_argument("--clients", type=int, default=8, help="The number of concurrent clients")
+  parser.add_argument("--cache-mb", type=int, default=64)
+  args = parser.parse_args()
+
+  folder = tempfile.mkdtemp()
+  ids = make_store(folder, args.subevents, args.n)
+  queries = random_queries(ids, args.queries)
+
+  ports = Queue()
+  server = Process(target=serve, args=(folder, args.cache_mb, ports), daemon=True)
+  server.start()
+  port = ports.get()
+
+  t0 = time.perf_counter()
+  for path in queries[:50]:
+    reread_json(folder, path)
+  reread = (time.perf_counter() - t0) / 50
+
+  print(f"subevents={args.subevents} n={args.n} queries={args.queries} clients={args.clients}")
+  print(f"{'':28} {'p50':>8} {'p99':>8} {'throughput':>14}")
+  print(f"{'re-read JSON (one client)':28} {reread * 1000:>6.1f}ms {'':>8} {1 / reread:>10.0f}/sec")
+
+  for label, headers in (
+    ("cold (first time)", {}),
+    ("warm", {}),
+    ("warm (gzip)", {"Accept-Encoding": "gzip"}),
+  ):
+    t0 = time.perf_counter()
+    latency = run_clients(port, queries, args.clients, headers)
+    sec = time.perf_counter() - t0
+    print(f"{label:28} {np.percentile(latency, 50) * 1000:>6.2f}ms {np.percentile(latency, 99) * 1000:>6.2f}ms {len(queries) / sec:>10.0f}/sec")
+
+  # Conditional requests: the ETag is checked before anything is loaded or serialized.
+  connection = http.client.HTTPConnection("127.0.0.1", port)
+  etags = {}
+  for path in set(queries):
+    connection.request("GET", path)
+    response = connection.getresponse()
+    response.read()
+    etags[path] = response.getheader("ETag")
+
+  t0 = time.perf_counter()
+  latency = run_clients(port, queries, args.clients, {}, etags=etags)
+  sec = time.perf_counter() - t0
+  print(f"{'revalidate (304)':28} {np.percentile(latency, 50) * 1000:>6.2f}ms {np.percentile(latency, 99) * 1000:>6.2f}ms {len(queries) / sec:>10.0f}/sec")
+
+  connection.request("GET", "/stats")
+  print()
+  print(json.dumps(json.loads(connection.getresponse().read()), indent=2))
+  server.terminate()
+
+
+if __name__ == "__main__":
+  main()
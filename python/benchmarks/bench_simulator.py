@@ -0,0 +1,58 @@
+import sys; sys.path.extend([".", "..", "../..", "../sim"])
+
+import time
+
+import numpy as np
+
+from simulator import Params, load_course, simulate, simulate_batch
+
+
+def random_setups(n: int, seed: int = 0) -> dict[str, np.ndarray]:
+  """Returns `n` random (power, CdA, Crr, mass, temperature, humidity) combinations."""
+  rng = np.random.default_rng(seed)
+  return dict(
+    power_watts=rng.uniform(150, 350, n),
+    cda=rng.uniform(0.2, 0.32, n),
+    crr=rng.uniform(0.003, 0.005, n),
+    mass_rider_kg=rng.uniform(55, 95, n),
+    temp_celsius=rng.uniform(-5, 35, n),
+    relative_humidity=rng.uniform(0, 100, n),
+  )
+
+
+def main():
+  """Compare simulating setups one at a time with simulating them in one batch."""
+  from argparse import ArgumentParser
+  parser = ArgumentParser()
+  parser.add_argument("--course", type=str, default="IM_Boulder_70.3", help="The name of a course in `app/public/courses`")
+  parser.add_argument("--n", type=int, default=1000, help="The number of setups to simulate in a batch")
+  parser.add_argument("--scalar", type=int, default=5, help="The number of setups to simulate one at a time")
+  parser.add_argument("--timestep", type=float, default=0.1)
+  args = parser.parse_args()
+
+  course = load_course(args.course)
+  setups = random_setups(args.n)
+  params = Params(timestep=args.timestep)
+
+  t0 = time.perf_counter()
+  batch = simulate_batch(course, params, **setups)
+  batch_sec = time.perf_counter() - t0
+
+  t0 = time.perf_counter()
+  scalar = [simulate(course, Params(timestep=args.timestep, **{k: v[i] for k, v in setups.items()})) for i in range(args.scalar)]
+  scalar_sec = (time.perf_counter() - t0) / args.scalar
+
+  # The batch only differs in the order of some floating point operations.
+  error = max(abs(r.finish_time - batch.finish_time[i]) for i, r in enumerate(scalar))
+  assert error <= args.timestep, f"The batched finish times are off by {error:.3f}s!"
+
+  print(f"course={course.name} n={args.n} timestep={args.timestep} iters={batch.iters}")
+  print(f"{'method':10} {'total':>10} {'per setup':>12} {'setups/s':>10}")
+  print(f"{'scalar':10} {scalar_sec * args.n:>9.1f}s {scalar_sec * 1000:>10.2f}ms {1 / scalar_sec:>10.1f}  (estimated from {args.scalar} setups)")
+  print(f"{'batch':10} {batch_sec:>9.1f}s {batch_sec / args.n * 1000:>10.2f}ms {args.n / batch_sec:>10.1f}")
+  print()
+  print(f"The batch is {scalar_sec * args.n / batch_sec:.1f}x faster, and its finish times are within {error:.2g}s of the scalar simulation.")
+
+
+if __name__ == "__main__":
+  main()
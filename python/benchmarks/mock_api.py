@@ -0,0 +1,324 @@
+import sys; sys.path.extend([".", "..", "../..", "../etl"])
+
+import json
+import random
+import time
+import zlib
+from dataclasses import dataclass, field
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Process, Queue
+from threading import Lock
+from urllib.parse import parse_qs, urlparse
+
+from synthetic import generate_results
+
+
+DEFAULT_PORT = 8766
+
+# The <iframe> on each results tab points here (only the last part of the URL is used).
+IFRAME_URL = "https://labs-v2.competitor.com/results/event"
+
+
+@dataclass
+class MockRace:
+  """A race on the mock site, with one subevent (of `n` results) per year."""
+  name: str
+  series: str
+  slug: str # the race page is `/<slug>-results`
+  subevents: list[tuple[str, int, int]] # (subevent ID, year, n)
+
+
+def make_races(races: int, years: int, n: int, seed: int = 0) -> list[MockRace]:
+  """Returns `races` synthetic races, each held for `years` years. Subevents have about `n` results."""
+  rng = random.Random(seed)
+  out = []
+  for r in range(races):
+    series = "IRONMAN-70.3" if r % 3 else "IRONMAN"
+    subevents = []
+    for y in range(years):
+      subevent_id = f"{r:08X}-{y:04X}-0000-0000-000000000000"
+      subevents.append((subevent_id, 2024 - y, max(1, int(n * rng.uniform(0.5, 1.5)))))
+    out.append(MockRace(f"Race {r}", series, f"{'im703' if r % 3 else 'im'}-race-{r}", subevents))
+  return out
+
+
+@dataclass
+class Faults:
+  """What can go wrong with a request to the mock server.
+
+  Every request waits `latency` seconds (plus up to `jitter` more). If `sigma` is
+  set, the latency is heavy-tailed instead: `latency` times a lognormal with that
+  sigma (so `latency` is the median), like a real web API. A fraction
+  `error_rate` of them fail with `error_status` (with a `Retry-After` header for
+  429 and 503), and a fraction `drop_rate` have their connection closed without a
+  response.
+
+  Like a real API, the server can also be overloaded: past `rate_limit` requests in
+  a second, it responds with a 429 (and `Retry-After`), and with more than `capacity`
+  requests in flight, each one gets proportionally slower. 0 turns either off.
+  """
+  latency: float = 0.0
+  jitter: float = 0.0
+  error_rate: float = 0.0
+  error_status: int = 503
+  retry_after: int = 1
+  drop_rate: float = 0.0
+  seed: int = 0
+  rate_limit: float = 0.0
+  capacity: int = 0
+  sigma: float = 0.0
+
+
+@dataclass
+class MockStats:
+  requests: int = 0
+  errors: int = 0
+  dropped: int = 0
+  not_modified: int = 0
+  throttled: int = 0
+  max_in_flight: int = 0
+  rows: int = 0
+  routes: dict[str, int] = field(default_factory=dict)
+
+
+class MockSite:
+  """The synthetic races, subevents and results that the mock server serves."""
+  def __init__(self, races: list[MockRace], distance: str = "70.3"):
+    self.races = {race.slug: race for race in races}
+    self.distance = distance
+    self.subevents = {s[0]: (race, s[1], s[2]) for race in races for s in race.subevents}
+    # Every race has a tab for each year, and one "TriClub" tab without an <iframe>.
+    self.tabs: list[str | None] = []
+    self.race_tabs: dict[str, list[int]] = {}
+    for race in races:
+      self.race_tabs[race.slug] = []
+      for subevent_id in [s[0] for s in race.subevents] + [None]:
+        self.race_tabs[race.slug].append(len(self.tabs))
+        self.tabs.append(subevent_id)
+
+  @lru_cache(maxsize=256)
+  def results(self, subevent_id: str) -> list[dict]:
+    """The results of a subevent (generated the first time they're requested)."""
+    _, _, n = self.subevents[subevent_id]
+    return generate_results(n, seed=zlib.crc32(subevent_id.encode()), subevent_id=subevent_id, distance=self.distance)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+  """Mimics the parts of the Competitor API and ironman.com that the scrapers use.
+
+  - `GET /public/result/subevent/<id>?$limit=100&$skip=0&$sort[FinishRankOverall]=1&AgeGroup=M30-34`
+  - `GET /public/events/<id>` (the `EventYear` of a subevent)
+  - `GET /<race>-results` (a race page, with a "tab-remote" link for each year)
+  - `GET /layout_container/show_layout_tab?tab_element_id=<n>` (a tab, with the subevent in an <iframe>)
+  - `GET /discontinued-races`
+  - `GET /stats` (the number of requests, errors and rows served)
+
+  Every 200 has an `ETag`, so that cached responses can be revalidated.
+  """
+  protocol_version = "HTTP/1.1"
+  disable_nagle_algorithm = True
+  server: "MockServer"
+
+  def do_GET(self):
+    server = self.server
+    url = urlparse(self.path)
+    query = parse_qs(url.query)
+    parts = [p for p in url.path.split("/") if p]
+    route = "race" if len(parts) == 1 and parts[0].endswith("-results") else "/".join(parts[:2])
+
+    if parts == ["stats"]:
+      return self.send_body(200, json.dumps(server.stats.__dict__).encode(), "application/json")
+
+    with server.lock:
+      server.stats.requests += 1
+      server.stats.routes[route] = server.stats.routes.get(route, 0) + 1
+      delay = server.faults.latency + server.faults.jitter * server.rng.random()
+      if server.faults.sigma:
+        delay = server.faults.latency * server.rng.lognormvariate(0, server.faults.sigma)
+      fail, drop = server.rng.random() < server.faults.error_rate, server.rng.random() < server.faults.drop_rate
+      throttled = server.over_rate_limit()
+      server.in_flight += 1
+      server.stats.max_in_flight = max(server.stats.max_in_flight, server.in_flight)
+      if server.faults.capacity and server.in_flight > server.faults.capacity:
+        delay *= server.in_flight / server.faults.capacity
+
+    try:
+      if throttled:
+        with server.lock:
+          server.stats.throttled += 1
+        return self.send_body(429, b'{"error": "rate limited"}', "application/json", {"Retry-After": "1"})
+      if delay > 0:
+        time.sleep(delay)
+      self.respond(parts, query, drop, fail)
+    finally:
+      with server.lock:
+        server.in_flight -= 1
+
+  def respond(self, parts: list[str], query: dict[str, list[str]], drop: bool, fail: bool):
+    server = self.server
+
+    if drop:
+      with server.lock:
+        server.stats.dropped += 1
+      self.close_connection = True
+      return
+    if fail:
+      with server.lock:
+        server.stats.errors += 1
+      headers = {"Retry-After": str(server.faults.retry_after)} if server.faults.error_status in (429, 503) else {}
+      return self.send_body(server.faults.error_status, json.dumps({"error": "injected"}).encode(), "application/json", headers)
+
+    site = server.site
+    try:
+      if parts[:3] == ["public", "result", "subevent"] and len(parts) == 4:
+        if "wtc_priv_key" not in self.headers:
+          return self.send_body(401, b'{"error": "missing key"}', "application/json")
+        return self.send_results(parts[3], query)
+      if parts[:2] == ["public", "events"] and len(parts) == 3:
+        _, year, _ = site.subevents[parts[2]]
+        return self.send_body(200, json.dumps({"EventId": parts[2], "EventYear": year}).encode(), "application/json")
+      if len(parts) == 1 and parts[0].endswith("-results"):
+        return self.send_body(200, self.race_page(parts[0][:-len("-results")]).encode(), "text/html")
+      if parts == ["layout_container", "show_layout_tab"]:
+        subevent_id = site.tabs[int(query["tab_element_id"][0])]
+        iframe = f'<iframe src="{IFRAME_URL}/{subevent_id}"></iframe>' if subevent_id else "<p>TriClub results</p>"
+        return self.send_body(200, f"<html><body><div>{iframe}</div></body></html>".encode(), "text/html")
+      if parts == ["discontinued-races"]:
+        return self.send_body(200, self.discontinued_page().encode(), "text/html")
+    except (KeyError, IndexError, ValueError):
+      pass
+    return self.send_body(404, b"Not found", "text/plain")
+
+  def send_results(self, subevent_id: str, query: dict[str, list[str]]):
+    """A page of results, like the Competitor API."""
+    results = self.server.site.results(subevent_id)
+    if "AgeGroup" in query:
+      results = [r for r in results if r["AgeGroup"] == query["AgeGroup"][0]]
+    sort = next((k[len("$sort["):-1] for k in query if k.startswith("$sort[")), None)
+    if sort is not None and results and sort in results[0]:
+      results = sorted(results, key=lambda r: r[sort])
+    skip, limit = int(query.get("$skip", ["0"])[0]), int(query.get("$limit", ["10"])[0])
+    page = results[skip:skip + limit]
+    with self.server.lock:
+      self.server.stats.rows += len(page)
+    body = json.dumps({"total": len(results), "limit": limit, "skip": skip, "data": page}).encode()
+    self.send_body(200, body, "application/json")
+
+  def race_page(self, slug: str) -> str:
+    tabs = "".join(
+      f'<a class="tab-remote" href="/layout_container/show_layout_tab?layout_container_id=1&tab_element_id={tab}">{tab}</a>'
+      for tab in self.server.site.race_tabs[slug]
+    )
+    return f"<html><body><h1>{self.server.site.races[slug].name}</h1><div class='tabs'>{tabs}</div></body></html>"
+
+  def discontinued_page(self) -> str:
+    labels = {"IRONMAN-70.3": "IRONMAN 70.3", "IRONMAN": "IRONMAN"}
+    sections = ""
+    for series, label in labels.items():
+      links = "".join(f'<a href="/{r.slug}-results">{r.name}</a>' for r in self.server.site.races.values() if r.series == series)
+      sections += f"<div><h3><span>{label}</span></h3>{links}</div>"
+    return f"<html><body>{sections}</body></html>"
+
+  def send_body(self, status: int, body: bytes, content_type: str, headers: dict | None = None):
+    # Like a real server, a 200 has an `ETag`, and an `If-None-Match` with the same tag gets an empty 304.
+    if status == 200:
+      etag = f'"{zlib.crc32(body):08x}"'
+      headers = {**(headers or {}), "ETag": etag}
+      if self.headers.get("If-None-Match") == etag and self.path != "/stats":
+        with self.server.lock:
+          self.server.stats.not_modified += 1
+        status, body = 304, b""
+    self.send_response(status)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    for key, value in (headers or {}).items():
+      self.send_header(key, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format: str, *args):
+    if self.server.verbose:
+      super().log_message(format, *args)
+
+
+class MockServer(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address: tuple[str, int], site: MockSite, faults: Faults = Faults(), verbose: bool = False):
+    super().__init__(address, MockHandler)
+    self.site = site
+    self.faults = faults
+    self.verbose = verbose
+    self.rng = random.Random(faults.seed)
+    self.lock = Lock()
+    self.stats = MockStats()
+    self.in_flight = 0
+    self.window = (0, 0) # (the current second, the requests in it)
+
+  def over_rate_limit(self) -> bool:
+    """Counts a request against the rate limit, and returns True if it's over (call with the lock held)."""
+    if not self.faults.rate_limit:
+      return False
+    second, count = self.window
+    now = int(time.time())
+    count = count + 1 if now == second else 1
+    self.window = (now, count)
+    return count > self.faults.rate_limit
+
+
+def serve(races: list[MockRace], faults: Faults, distance: str, ports: Queue):
+  server = MockServer(("127.0.0.1", 0), MockSite(races, distance=distance), faults)
+  ports.put(server.server_address[1])
+  server.serve_forever()
+
+
+def start(races: list[MockRace], faults: Faults = Faults(), distance: str = "70.3") -> tuple[Process, str]:
+  """Runs a mock server in its own process (so that it doesn't share a GIL with the scrapers).
+
+  Returns the process (terminate it when you're done) and the base URL of the server.
+  """
+  ports = Queue()
+  process = Process(target=serve, args=(races, faults, distance, ports), daemon=True)
+  process.start()
+  return process, f"http://127.0.0.1:{ports.get()}"
+
+
+def main():
+  """Serve a mock Competitor API and ironman.com, to run the scrapers against."""
+  from argparse import ArgumentParser
+  parser = ArgumentParser(description="Serve a mock Competitor API and ironman.com, to run the scrapers against.")
+  parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+  parser.add_argument("--races", type=int, default=20)
+  parser.add_argument("--years", type=int, default=5)
+  parser.add_argument("--n", type=int, default=2000, help="The (average) number of results in each subevent")
+  parser.add_argument("--distance", choices=["70.3", "140.6"], default="70.3")
+  parser.add_argument("--latency", type=float, default=0.05, help="Seconds to wait before each response")
+  parser.add_argument("--jitter", type=float, default=0.02, help="Up to this many extra seconds (uniformly random)")
+  parser.add_argument("--error-rate", type=float, default=0.0, help="The fraction of requests that fail")
+  parser.add_argument("--error-status", type=int, default=503)
+  parser.add_argument("--drop-rate", type=float, default=0.0, help="The fraction of connections that are closed without a response")
+  parser.add_argument("--rate-limit", type=float, default=0.0, help="Respond with a 429 to the requests past this many per second")
+  parser.add_argument("--capacity", type=int, default=0, help="Slow down when more than this many requests are in flight")
+  parser.add_argument("--sigma", type=float, default=0.0, help="Make the latency lognormal with this sigma (--latency is the median)")
+  parser.add_argument("--verbose", action="store_true", help="Log every request")
+  args = parser.parse_args()
+
+  races = make_races(args.races, args.years, args.n)
+  faults = Faults(args.latency, args.jitter, args.error_rate, args.error_status, drop_rate=args.drop_rate,
+                  rate_limit=args.rate_limit, capacity=args.capacity, sigma=args.sigma)
+  server = MockServer(("127.0.0.1", args.port), MockSite(races, distance=args.distance), faults, verbose=args.verbose)
+
+  print(f"Serving {len(races)} races ({sum(len(r.subevents) for r in races)} subevents) on http://127.0.0.1:{args.port}")
+  print(f"Run the scrapers with COMPETITOR_API_URL=http://127.0.0.1:{args.port} IRONMAN_URL=http://127.0.0.1:{args.port}")
+  print(f"The races are at http://127.0.0.1:{args.port}/<slug>-results, e.g /{races[0].slug}-results")
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,294 @@
+import sys; sys.path.extend([".", "..", "../..", "../etl"])
+
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import urllib.request
+from datetime import datetime, timezone
+
+import http_cache
+import mock_api
+from metrics import METRICS
+from synthetic import generate_results
+
+
+# Bump this if the format of the output changes.
+OUTPUT_VERSION = 1
+
+STAGES = ["scrape", "scrape_async", "crawl", "crawl_cached", "create_csv", "rank_splits", "publish"]
+
+# The metric of each stage that is compared between runs (higher is better).
+THROUGHPUT = {
+  "scrape": "rows_per_sec",
+  "scrape_async": "rows_per_sec",
+  "crawl": "subevents_per_sec",
+  "crawl_cached": "subevents_per_sec",
+  "create_csv": "rows_per_sec",
+  "rank_splits": "rows_per_sec",
+  "publish": "rows_per_sec",
+}
+
+
+def measure(func, *args, **kwargs) -> tuple[object, dict]:
+  """Runs `func`, and returns its value and its wall and CPU time (of this process)."""
+  wall, cpu = time.perf_counter(), time.process_time()
+  value = func(*args, **kwargs)
+  return value, {"wall_sec": time.perf_counter() - wall, "cpu_sec": time.process_time() - cpu}
+
+
+def bench_scrape(races: list, t: int, retries: int) -> dict:
+  """Scrapes every subevent of the mock server with `scrape_im_results.scrape`, on `t` threads (like its `main`)."""
+  from job import Backoff, Job, JobStatus, stream_pooled_jobs
+  from scrape_im_results import scrape
+
+  subevent_ids = [s[0] for race in races for s in race.subevents]
+  jobs = [Job(scrape, (subevent_id,)) for subevent_id in subevent_ids]
+  results, timing = measure(lambda: list(stream_pooled_jobs(jobs, t=t, backoff=Backoff(retries=retries, delay=0.1))))
+
+  rows = sum(len(r.value["data"]) for r in results if r.status == JobStatus.FULFILLED)
+  failed = sum(r.status != JobStatus.FULFILLED for r in results)
+  return {**timing, "subevents": len(jobs), "failed": failed, "rows": rows, "rows_per_sec": rows / timing["wall_sec"], "threads": t}
+
+
+def bench_scrape_async(races: list, connections: int, retries: int) -> dict:
+  """Scrapes every subevent of the mock server with `scrape_im_results.scrape_async` and one pooled client."""
+  import aiohttp
+  from job import Backoff
+  from scrape_im_results import scrape_async
+
+  subevent_ids = [s[0] for race in races for s in race.subevents]
+
+  async def run():
+    connector = aiohttp.TCPConnector(limit=connections)
+    semaphore = asyncio.Semaphore(connections)
+    async with aiohttp.ClientSession(connector=connector) as session:
+      async def one(subevent_id: str):
+        async with semaphore:
+          # Retry each page like `bench_scrape` retries each job.
+          return await scrape_async(session, subevent_id, backoff=Backoff(retries=retries, delay=0.1))
+      return await asyncio.gather(*[one(s) for s in subevent_ids], return_exceptions=True)
+
+  results, timing = measure(lambda: asyncio.run(run()))
+  ok = [r for r in results if isinstance(r, dict)]
+  rows = sum(len(r["data"]) for r in ok)
+  return {**timing, "subevents": len(results), "failed": len(results) - len(ok), "rows": rows,
+          "rows_per_sec": rows / timing["wall_sec"], "connections": connections}
+
+
+def bench_crawl(races: list, base_url: str, t: int, warm: bool = False) -> dict:
+  """Finds the subevents of every race on the mock site with `scrape_im_subevents.crawl`.
+
+  If `warm`, every race is crawled once first (untimed), so that the timed crawl
+  reads the pages from the HTTP cache.
+  """
+  from scrape_im_subevents import crawl
+
+  def run():
+    found, failed = 0, 0
+    for race in races:
+      try:
+        found += len(crawl(f"{base_url}/{race.slug}-results", t=t))
+      except Exception:
+        failed += 1
+    return found, failed
+
+  # `crawl` prints every URL it visits.
+  with open(os.devnull, "w") as devnull:
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+      if warm:
+        run()
+        METRICS.drain()
+      (found, failed), timing = measure(run)
+    finally:
+      sys.stdout = stdout
+
+  cache = METRICS.report()["counters"].get("http_cache_total", {})
+  hits = sum(v for labels, v in cache.items() if labels.endswith(("result=hit", "result=revalidated")))
+  expected = sum(len(race.subevents) for race in races)
+  return {**timing, "races": len(races), "failed": failed, "subevents": found, "expected": expected,
+          "subevents_per_sec": found / timing["wall_sec"], "threads": t,
+          "cache_hit_ratio": hits / sum(cache.values()) if cache else 0.0}
+
+
+def write_json_files(folder: str, subevents: int, n: int) -> dict[str, str]:
+  """Writes synthetic results JSON files (like `PartialResults.finalize`). Returns {subevent ID: path}."""
+  os.makedirs(folder, exist_ok=True)
+  paths = {}
+  for i in range(subevents):
+    subevent_id = f"{i:08d}-0000-0000-0000-000000000000"
+    paths[subevent_id] = os.path.join(folder, f"{subevent_id}.json")
+    with open(paths[subevent_id], "w") as f:
+      json.dump({"total": n, "data": generate_results(n, seed=i, subevent_id=subevent_id)}, f, indent=2)
+  return paths
+
+
+def bench_create_csv(paths: dict[str, str]) -> dict:
+  """Parses the JSON files into dataframes with `create_im_csv.create_csv`."""
+  from create_im_csv import create_csv
+
+  rows, timing = measure(lambda: sum(len(create_csv(path)) for path in paths.values()))
+  return {**timing, "files": len(paths), "rows": rows, "rows_per_sec": rows / timing["wall_sec"]}
+
+
+def bench_rank_splits(n: int, repeat: int) -> dict:
+  """Ranks one large subevent with `ranking.rank_splits` (the best of `repeat` runs)."""
+  from ranking import rank_splits
+
+  data = generate_results(n)
+  timings = [measure(rank_splits, data)[1] for _ in range(repeat)]
+  best = min(timings, key=lambda t: t["wall_sec"])
+  return {**best, "rows": n, "rows_per_sec": n / best["wall_sec"], "repeat": repeat}
+
+
+def bench_publish(paths: dict[str, str], n: int, format: str) -> dict:
+  """Ranks and writes the JSON files with `publish.publish_subevent` (with the aggregates)."""
+  from publish import publish_subevent
+
+  out = tempfile.mkdtemp()
+
+  def run():
+    total = 0
+    for subevent_id, path in paths.items():
+      written = publish_subevent(subevent_id, os.path.join(out, f"{subevent_id}.json"), format=format,
+                                 aggregates_path=os.path.join(out, f"{subevent_id}.aggregates.json"), json_path=path)
+      total += written["columnar"]["bytes"] if format == "columnar" else written["bytes"]
+    return total
+
+  written, timing = measure(run)
+  rows = len(paths) * n
+  return {**timing, "files": len(paths), "rows": rows, "bytes": written, "rows_per_sec": rows / timing["wall_sec"], "format": format}
+
+
+def breakdown() -> dict:
+  """Where the time of the last stage went (see `etl/metrics.py`): the wall and CPU time of each step, and the requests."""
+  report = METRICS.report()
+  cpu = report["counters"].get("stage_cpu_seconds_total", {})
+  return {
+    "steps": {labels.split("=")[1]: {"wall_sec": wall, "cpu_sec": cpu.get(labels, 0.0)}
+              for labels, wall in report["counters"].get("stage_wall_seconds_total", {}).items()},
+    "requests": {labels.split("=")[1]: {"count": h["count"], "p50_sec": h["p50"], "p99_sec": h["p99"]}
+                 for labels, h in report["histograms"].get("request_seconds", {}).items()},
+    "request_bytes": sum(report["counters"].get("request_bytes_total", {}).values()),
+  }
+
+
+def git_commit() -> str | None:
+  try:
+    return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def compare(current: dict, previous: dict, threshold: float) -> list[str]:
+  """Prints the change in throughput of each stage since a `previous` run. Returns the stages that regressed."""
+  regressed = []
+  print()
+  print(f"{'stage':14} {'metric':18} {'previous':>12} {'current':>12} {'change':>8}")
+  for stage, result in current["stages"].items():
+    metric = THROUGHPUT[stage]
+    before = previous.get("stages", {}).get(stage, {}).get(metric)
+    if before is None:
+      continue
+    change = result[metric] / before - 1
+    flag = " REGRESSED" if change < -threshold else ""
+    if flag:
+      regressed.append(stage)
+    print(f"{stage:14} {metric:18} {before:>12.0f} {result[metric]:>12.0f} {change:>+7.0%}{flag}")
+  return regressed
+
+
+def main():
+  """Benchmark each stage of the ETL offline (against a mock server), and write the results as JSON."""
+  from argparse import ArgumentParser
+  parser = ArgumentParser(description="Benchmark each stage of the ETL offline (against a mock server), and write the results as JSON.")
+  parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+  parser.add_argument("--races", type=int, default=8, help="The number of races on the mock site")
+  parser.add_argument("--years", type=int, default=4, help="The number of subevents of each race")
+  parser.add_argument("--n", type=int, default=1500, help="The (average) number of results in each subevent")
+  parser.add_argument("--rank-n", type=int, default=50_000, help="The number of results to rank")
+  parser.add_argument("--files", type=int, default=10, help="The number of JSON files to convert and publish")
+  parser.add_argument("--latency", type=float, default=0.02, help="Seconds the mock server waits before each response")
+  parser.add_argument("--jitter", type=float, default=0.01)
+  parser.add_argument("--error-rate", type=float, default=0.0, help="The fraction of requests to the mock server that fail")
+  parser.add_argument("--t", type=int, default=4, help="The number of threads for `scrape` and `crawl`")
+  parser.add_argument("--connections", type=int, default=16, help="The size of the connection pool for `scrape_async`")
+  parser.add_argument("--retries", type=int, default=2)
+  parser.add_argument("--format", choices=["rows", "columnar"], default="rows", help="The format to publish")
+  parser.add_argument("--repeat", type=int, default=3)
+  parser.add_argument("--out", type=str, default=None, help="Write the results to this JSON file")
+  parser.add_argument("--compare", type=str, default=None, help="Compare with the results of a previous run")
+  parser.add_argument("--threshold", type=float, default=0.2, help="A drop in throughput larger than this is a regression")
+  args = parser.parse_args()
+
+  races = mock_api.make_races(args.races, args.years, args.n)
+  faults = mock_api.Faults(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+  server, base_url = mock_api.start(races, faults)
+
+  # The scrapers read these when they're imported (in the stages below).
+  os.environ["COMPETITOR_API_URL"] = base_url
+  os.environ["IRONMAN_URL"] = base_url
+  os.environ.setdefault("API_KEY", "benchmark")
+  # Keep the responses out of `data/im/http_cache`, and start every run with an empty cache.
+  http_cache.configure(folder=tempfile.mkdtemp(), autosave=0)
+
+  folder = tempfile.mkdtemp()
+  paths = write_json_files(folder, args.files, args.n) if {"create_csv", "publish"} & set(args.stages) else {}
+
+  stages = {}
+  try:
+    for stage in args.stages:
+      METRICS.drain()
+      if stage == "scrape":
+        stages[stage] = bench_scrape(races, args.t, args.retries)
+      elif stage == "scrape_async":
+        stages[stage] = bench_scrape_async(races, args.connections, args.retries)
+      elif stage == "crawl":
+        stages[stage] = bench_crawl(races, base_url, args.t)
+      elif stage == "crawl_cached":
+        stages[stage] = bench_crawl(races, base_url, args.t, warm=True)
+      elif stage == "create_csv":
+        stages[stage] = bench_create_csv(paths)
+      elif stage == "rank_splits":
+        stages[stage] = bench_rank_splits(args.rank_n, args.repeat)
+      elif stage == "publish":
+        stages[stage] = bench_publish(paths, args.n, args.format)
+      stages[stage]["breakdown"] = breakdown()
+      print(f"{stage:14} {stages[stage]['wall_sec']:>8.2f}s {stages[stage][THROUGHPUT[stage]]:>12.0f} {THROUGHPUT[stage]}")
+
+    with urllib.request.urlopen(f"{base_url}/stats") as response:
+      mock_stats = json.load(response)
+  finally:
+    server.terminate()
+
+  result = {
+    "v": OUTPUT_VERSION,
+    "timestamp": datetime.now(timezone.utc).isoformat(),
+    "commit": git_commit(),
+    "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+    "config": vars(args),
+    "mock": mock_stats,
+    "stages": stages,
+  }
+
+  if args.out:
+    with open(args.out, "w") as f:
+      json.dump(result, f, indent=2)
+    print(f"Wrote {args.out}")
+  else:
+    print(json.dumps(result, indent=2))
+
+  if args.compare:
+    with open(args.compare, "r") as f:
+      regressed = compare(result, json.load(f), args.threshold)
+    if regressed:
+      print(f"Regressions: {', '.join(regressed)}")
+      sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
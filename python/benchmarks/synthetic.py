@@ -0,0 +1,85 @@
+import numpy as np
+
+
+AGE_GROUPS = ["18-24", "25-29", "30-34", "35-39", "40-44", "45-49", "50-54", "55-59", "60-64", "65-69", "70-74", "75-79"]
+
+# Roughly how the athletes are spread over the age groups (most are in their late 30s and 40s).
+AGE_GROUP_WEIGHTS = [0.04, 0.08, 0.12, 0.15, 0.17, 0.15, 0.12, 0.08, 0.05, 0.025, 0.01, 0.005]
+
+# The fraction of athletes that race as professionals (in the "MPRO" and "FPRO" groups).
+PRO_FRACTION = 0.01
+
+# Roughly how the statuses are distributed in a real subevent.
+EVENT_STATUSES = {"Finish": 0.88, "DNF": 0.06, "DNS": 0.05, "DQ": 0.01}
+
+# More athletes drop out of a full distance race.
+EVENT_STATUSES_FULL = {"Finish": 0.82, "DNF": 0.10, "DNS": 0.07, "DQ": 0.01}
+
+# The median (age group) split times of each distance, in seconds: swim, T1, bike, T2, run.
+DISTANCES = {
+  "70.3": (2400, 240, 10800, 180, 7200),
+  "140.6": (4500, 420, 22000, 300, 15500),
+}
+
+
+def generate_results(
+  n: int,
+  seed: int = 0,
+  subevent_id: str = "00000000-0000-0000-0000-000000000000",
+  distance: str = "70.3",
+) -> list[dict]:
+  """Generate `n` synthetic results in the same format as the Competitor API.
+
+  The split times are in seconds and look like a race of the given `distance`.
+  Each athlete has an ability that carries across their splits, older age groups
+  and women are slower on average, and the pros are much faster. Athletes that
+  didn't finish have a time of 0 for the splits they didn't complete.
+  """
+  rng = np.random.default_rng(seed)
+
+  gender = rng.choice(["M", "F"], size=n, p=[0.7, 0.3])
+  age = rng.choice(len(AGE_GROUPS), size=n, p=np.array(AGE_GROUP_WEIGHTS) / sum(AGE_GROUP_WEIGHTS))
+  pro = rng.random(n) < PRO_FRACTION
+  age_group = np.where(pro, np.char.add(gender, "PRO"), np.char.add(gender, np.array(AGE_GROUPS)[age]))
+  statuses = EVENT_STATUSES_FULL if distance == "140.6" else EVENT_STATUSES
+  status = rng.choice(list(statuses.keys()), size=n, p=list(statuses.values()))
+
+  # Slower with age (from the late 30s), for women, and much faster for the pros.
+  factor = np.exp(rng.normal(0, 0.12, size=n))
+  factor *= 1 + 0.03 * np.maximum(age - 3, 0) + 0.08 * (gender == "F")
+  factor = np.where(pro, 0.72 + 0.04 * (gender == "F"), factor)
+
+  splits = []
+  for median, spread in zip(DISTANCES[distance], (0.12, 0.25, 0.08, 0.25, 0.12)):
+    splits.append((median * factor * np.exp(rng.normal(0, spread, size=n))).astype(int).clip(1))
+  swim, t1, bike, t2, run = splits
+
+  # DNS athletes have no splits, and DNF athletes stop somewhere along the way.
+  stopped = np.where(status == "DNS", 0, np.where(status == "Finish", 5, rng.integers(1, 5, size=n)))
+  swim = np.where(stopped >= 1, swim, 0)
+  bike = np.where(stopped >= 3, bike, 0)
+  run = np.where(stopped >= 5, run, 0)
+  finish = np.where(status == "Finish", swim + t1 + bike + t2 + run, 0)
+
+  results = []
+  for i in range(n):
+    results.append({
+      "SubEventId": subevent_id,
+      "ResultId": f"{subevent_id[:-8]}{i:08d}",
+      "ContactId": f"{seed:08d}-0000-0000-0000-{i:012d}",
+      "AgeGroup": str(age_group[i]),
+      "CountryISO2": "US",
+      "BibNumber": i + 1,
+      "EventStatus": str(status[i]),
+      "SwimTime": int(swim[i]),
+      "Transition1Time": int(t1[i]) if stopped[i] >= 2 else 0,
+      "BikeTime": int(bike[i]),
+      "Transition2Time": int(t2[i]) if stopped[i] >= 4 else 0,
+      "RunTime": int(run[i]),
+      "FinishTime": int(finish[i]),
+      "Contact": {"FullName": f"Athlete {i}", "Gender": str(gender[i])},
+      "Country": {"ISO2": "US"},
+      "Subevent": {"SubEvent": f"Synthetic {distance}"},
+    })
+
+  return results
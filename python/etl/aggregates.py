@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+
+
+# Bump this if the layout of the aggregates changes.
+FORMAT_VERSION = 1
+
+# The width (in seconds) of the histogram bins for each split. These match the charts in the app.
+BIN_WIDTHS = {
+  "FinishTime": 5 * 60,
+  "SwimTime": 1 * 60,
+  "BikeTime": 2.5 * 60,
+  "RunTime": 2.5 * 60,
+  "Transition1Time": 0.5 * 60,
+  "Transition2Time": 0.5 * 60,
+}
+
+QUANTILES = {"p10": 0.1, "p25": 0.25, "p50": 0.5, "p75": 0.75, "p90": 0.9}
+
+# Times outside of [q1 - k * IQR, q3 + k * IQR] are treated as outliers (the app uses the same rule).
+OUTLIER_IQR_MULTIPLE = 4
+
+
+def quantile_sorted(values: np.ndarray, q: float) -> float:
+  """Returns the `q` quantile of sorted `values` (with linear interpolation, like `d3.quantile`)."""
+  i = (len(values) - 1) * q
+  lo = int(np.floor(i))
+  hi = min(lo + 1, len(values) - 1)
+  return round(float(values[lo] + (values[hi] - values[lo]) * (i - lo)), 1)
+
+
+def histogram(values: np.ndarray, width: float) -> dict:
+  """Counts `values` in bins of a fixed `width`.
+
+  The first bin starts at a multiple of `width`, so the histograms of different
+  groups line up and can be added together.
+  """
+  if len(values) == 0:
+    return {"x0": 0, "width": width, "counts": []}
+
+  x0 = np.floor(values.min() / width) * width
+  x1 = np.ceil(values.max() / width) * width
+  bins = max(1, int(round((x1 - x0) / width)))
+
+  # The last bin includes its upper edge.
+  index = np.minimum(((values - x0) // width).astype(np.int64), bins - 1)
+  return {"x0": float(x0), "width": width, "counts": np.bincount(index, minlength=bins).tolist()}
+
+
+def summarize(values: np.ndarray, width: float) -> dict:
+  """Summarizes the sorted (positive) times of one group."""
+  if len(values) == 0:
+    return {"n": 0, "quantiles": None, "bounds": None, "histogram": histogram(values, width)}
+
+  quantiles = {name: quantile_sorted(values, q) for name, q in QUANTILES.items()}
+  iqr = quantiles["p75"] - quantiles["p25"]
+  lo = quantiles["p25"] - OUTLIER_IQR_MULTIPLE * iqr
+  hi = quantiles["p75"] + OUTLIER_IQR_MULTIPLE * iqr
+
+  # The values are sorted, so the inliers are a contiguous slice.
+  inliers = values[np.searchsorted(values, lo, side="left"):np.searchsorted(values, hi, side="right")]
+
+  return {
+    "n": len(values),
+    "min": float(values[0]),
+    "max": float(values[-1]),
+    "quantiles": quantiles,
+    "bounds": [round(lo, 1), round(hi, 1)],
+    "histogram": histogram(inliers, width),
+  }
+
+
+def compute_aggregates(df: pd.DataFrame) -> dict:
+  """Computes the histograms and quantiles that the charts need for each split and group.
+
+  Only finishers are included. The groups are "overall", "m-overall", "f-overall"
+  and each age group, to match the options in the app. The histograms leave out
+  outliers, while the quantiles, min and max include everyone.
+
+  ```json
+  {"v": 1, "n": 1587, "splits": {"FinishTime": {"overall": {"n": 1587, "quantiles": {"p10": ...}, "bounds": [...], "histogram": {...}}, ...}}}
+  ```
+  """
+  finishers = df[df.EventStatus == "Finish"]
+
+  codes, age_groups = pd.factorize(finishers.AgeGroup)
+  age_groups = [str(ag) for ag in age_groups]
+  gender = np.array([ag[:1] for ag in age_groups] + [""])[codes]
+
+  groups = {
+    "overall": np.ones(len(finishers), dtype=bool),
+    "m-overall": gender == "M",
+    "f-overall": gender == "F",
+  }
+
+  out = {}
+
+  for split, width in BIN_WIDTHS.items():
+    if split not in finishers:
+      continue
+
+    values = finishers[split].to_numpy(dtype=np.float64, na_value=np.nan)
+    valid = values > 0
+
+    # Sort by (age group, time) once, so each age group is a sorted, contiguous slice.
+    order = np.lexsort((values, codes))
+    order = order[valid[order] & (codes[order] >= 0)]
+    sorted_codes = codes[order]
+    sorted_values = values[order]
+    starts = np.searchsorted(sorted_codes, np.arange(len(age_groups)), side="left")
+    ends = np.searchsorted(sorted_codes, np.arange(len(age_groups)), side="right")
+
+    summaries = {name: summarize(np.sort(values[mask & valid]), width) for name, mask in groups.items()}
+    for i, ag in enumerate(age_groups):
+      summaries[ag] = summarize(sorted_values[starts[i]:ends[i]], width)
+
+    out[split] = summaries
+
+  return {"v": FORMAT_VERSION, "n": len(finishers), "splits": out}
@@ -0,0 +1,375 @@
+import sys; sys.path.extend([".", "..", "../.."])
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import unicodedata
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from utils.paths import data_folder, make_directory
+from utils.store import TIME_COLUMNS, list_subevents, store_folder
+
+
+# Bump this if the layout of the index changes, so that it gets rebuilt.
+INDEX_VERSION = 1
+
+MANIFEST_FILENAME = "index.json"
+
+# When there are more segments than this, the smallest `MERGE_FANIN` are merged into one.
+MAX_SEGMENTS = 8
+MERGE_FANIN = 4
+
+# One row per result, sorted by the key of the athlete. The row is the offset of the
+# result in its subevent's file in the results store.
+POSTING = np.dtype([("subevent", "<i4"), ("row", "<i4"), ("splits", "<i4", (len(TIME_COLUMNS),))])
+
+# The files of a segment. `forward` lists the (unique) athletes of each subevent, for overlaps.
+SEGMENT_FILES = ["keys", "postings", "name_keys", "name_postings", "forward", "forward_subevents", "forward_offsets"]
+
+
+def index_folder(relative_path: str = "") -> str:
+  """Returns a path relative to the folder of the athlete index."""
+  return data_folder(os.path.join("im/athletes", relative_path))
+
+
+def normalize_name(name: str) -> str:
+  """Normalizes a name so that small differences in how it was entered don't matter.
+
+  Accents, punctuation, case and the order of the words are ignored, so "Müller, Anna"
+  and "anna muller" are the same.
+  """
+  name = unicodedata.normalize("NFKD", str(name))
+  name = "".join(c for c in name if not unicodedata.combining(c)).casefold()
+  return " ".join(sorted(re.sub(r"[^\w\s]", " ", name).split()))
+
+
+def hash_key(value: str) -> int:
+  """Hashes a string to a (stable) 64-bit key."""
+  return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def hash_keys(values) -> np.ndarray:
+  return np.fromiter((hash_key(v) for v in values), dtype=np.uint64, count=len(values))
+
+
+def contact_key(contact_id: str) -> int:
+  return hash_key("id:" + contact_id.strip().upper())
+
+
+def name_key(name: str) -> int:
+  return hash_key("name:" + normalize_name(name))
+
+
+def athlete_keys(df: pd.DataFrame, source: str = "") -> tuple[np.ndarray, np.ndarray]:
+  """Returns the athlete key and the name key of each result.
+
+  The athlete key comes from the `ContactId`. If a result doesn't have one, it falls
+  back to the (normalized) name, so that the result can still be found. A result with
+  neither is its own athlete (keyed by `source` and its row).
+  """
+  names = "name:" + df.ContactFullName.fillna("").astype(str).map(normalize_name)
+  ids = df.ContactId.fillna("").astype(str).str.strip().str.upper()
+  anonymous = f"row:{source}:" + pd.Series(np.arange(len(df)).astype(str), index=df.index)
+  keys = np.where(ids != "", "id:" + ids, np.where(names != "name:", names, anonymous))
+  return hash_keys(keys), hash_keys(names.to_numpy(dtype=object))
+
+
+def read_postings(path: str, subevent: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+  """Reads the results of one subevent from the store. Returns their athlete keys, name keys and postings."""
+  df = pq.read_table(path, columns=["ContactId", "ContactFullName"] + TIME_COLUMNS).to_pandas()
+  keys, name_keys = athlete_keys(df, source=os.path.basename(path))
+  postings = np.zeros(len(df), dtype=POSTING)
+  postings["subevent"] = subevent
+  postings["row"] = np.arange(len(df))
+  for i, split in enumerate(TIME_COLUMNS):
+    postings["splits"][:, i] = pd.to_numeric(df[split], errors="coerce").fillna(0).to_numpy(dtype=np.int32)
+  return keys, name_keys, postings
+
+
+def write_segment(folder: str, keys: np.ndarray, name_keys: np.ndarray, postings: np.ndarray):
+  """Sorts the postings of a segment by key, and writes it to `folder`."""
+  order = np.argsort(keys, kind="stable")
+  keys, name_keys, postings = keys[order], name_keys[order], postings[order]
+
+  name_order = np.argsort(name_keys, kind="stable")
+
+  # The unique athletes of each subevent, sorted by (subevent, key).
+  forward_order = np.lexsort((keys, postings["subevent"]))
+  subevents, forward = postings["subevent"][forward_order], keys[forward_order]
+  unique = np.ones(len(forward), dtype=bool)
+  unique[1:] = (subevents[1:] != subevents[:-1]) | (forward[1:] != forward[:-1])
+  subevents, forward = subevents[unique], forward[unique]
+  forward_subevents, starts = np.unique(subevents, return_index=True)
+
+  arrays = {
+    "keys": keys,
+    "postings": postings,
+    "name_keys": name_keys[name_order],
+    "name_postings": name_order.astype(np.int32),
+    "forward": forward,
+    "forward_subevents": forward_subevents,
+    "forward_offsets": np.append(starts, len(forward)).astype(np.int64),
+  }
+
+  tmp = folder + ".tmp"
+  shutil.rmtree(tmp, ignore_errors=True)
+  os.makedirs(tmp)
+  for name, array in arrays.items():
+    np.save(os.path.join(tmp, f"{name}.npy"), array)
+  os.replace(tmp, folder)
+
+
+class Segment:
+  """The (memory-mapped) arrays of one segment of the index."""
+  def __init__(self, folder: str, number: int):
+    self.number = number
+    for name in SEGMENT_FILES:
+      # Plain array views of the memory maps (indexing an `np.memmap` is much slower).
+      setattr(self, name, np.asarray(np.load(os.path.join(folder, f"{name}.npy"), mmap_mode="r")))
+
+  def __len__(self) -> int:
+    return len(self.keys)
+
+  def find(self, keys: np.ndarray) -> np.ndarray:
+    """Returns the positions of the postings of every key in (sorted) `keys`."""
+    lo, hi = np.searchsorted(self.keys, keys, side="left"), np.searchsorted(self.keys, keys, side="right")
+    return ranges(lo, hi)
+
+  def find_names(self, name_keys: np.ndarray) -> np.ndarray:
+    lo, hi = np.searchsorted(self.name_keys, name_keys, side="left"), np.searchsorted(self.name_keys, name_keys, side="right")
+    return self.name_postings[ranges(lo, hi)]
+
+  def athletes(self, subevent: int) -> np.ndarray:
+    """Returns the (sorted, unique) keys of the athletes in a subevent."""
+    i = np.searchsorted(self.forward_subevents, subevent)
+    if i == len(self.forward_subevents) or self.forward_subevents[i] != subevent:
+      return np.empty(0, dtype=np.uint64)
+    return self.forward[self.forward_offsets[i]:self.forward_offsets[i + 1]]
+
+
+def ranges(lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+  """Returns the concatenation of `range(lo[i], hi[i])` for each `i`."""
+  if len(lo) == 1:
+    return np.arange(lo[0], hi[0])
+  counts = hi - lo
+  if counts.sum() == 0:
+    return np.empty(0, dtype=np.int64)
+  starts = np.repeat(lo - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts)
+  return starts + np.arange(counts.sum())
+
+
+class AthleteIndex:
+  """An index of every result of each athlete, across all of the subevents in the results store.
+
+  Athletes are identified by their `ContactId` (or their normalized name, if a result
+  doesn't have one, see `athlete_keys`). The index is a list of segments, each of which
+  is a set of memory-mapped arrays, sorted by the key of the athlete. Lookups are a
+  binary search in each segment, so they don't need any of the index in memory.
+
+  `update` adds the subevents that are new (or changed) since the last update as a new
+  segment, and merges the smallest segments when there are too many. The postings of a
+  subevent that was indexed again are ignored in its older segment, and dropped when
+  that segment is merged.
+
+  The manifest (`index.json`) has:
+  - `subevents`: for each subevent ID, its number (`code`) in the postings, the
+    segment its postings are in, and the size and modification time of its file
+  - `segments`: the number and size of each segment
+  """
+  def __init__(self, folder: str = index_folder()):
+    self.folder = folder
+    path = os.path.join(folder, MANIFEST_FILENAME)
+    manifest = {}
+    if os.path.exists(path):
+      with open(path, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("v") != INDEX_VERSION:
+      manifest = {"v": INDEX_VERSION, "subevents": {}, "segments": [], "next_segment": 0}
+
+    self.manifest = manifest
+    self.subevent_ids = [None] * len(manifest["subevents"])
+    for subevent_id, entry in manifest["subevents"].items():
+      self.subevent_ids[entry["code"]] = subevent_id
+    self._open()
+
+  def _open(self):
+    self.segments = [Segment(self.segment_folder(s["number"]), s["number"]) for s in self.manifest["segments"]]
+    # The segment that holds the current postings of each subevent (by code), or -1.
+    self.live = np.full(len(self.subevent_ids), -1, dtype=np.int64)
+    for entry in self.manifest["subevents"].values():
+      self.live[entry["code"]] = entry["segment"]
+
+  def segment_folder(self, number: int) -> str:
+    return os.path.join(self.folder, f"segment-{number:06d}")
+
+  def code(self, subevent_id: str) -> int:
+    entry = self.manifest["subevents"].get(subevent_id)
+    if entry is None:
+      raise KeyError(f"{subevent_id} isn't in the athlete index.")
+    return entry["code"]
+
+  def stale(self, subevent_id: str, path: str) -> bool:
+    """Returns whether a subevent has to be indexed (again): it's new, it was dropped, or its file changed."""
+    entry = self.manifest["subevents"].get(subevent_id)
+    if entry is None or entry["segment"] == -1:
+      return True
+    stat = os.stat(path)
+    return entry.get("source") != {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+  def update(self, paths: dict[str, str] | None = None, force: bool = False) -> int:
+    """Indexes the subevents in the store that are new or changed (or all of them, if `force`).
+
+    `paths` maps the ID of every subevent in the store to its file (the whole results
+    store by default). Subevents that aren't in it anymore are dropped. Returns the number of subevents that
+    were indexed.
+    """
+    paths = list_subevents() if paths is None else paths
+    subevents = self.manifest["subevents"]
+
+    for subevent_id in [s for s in subevents if s not in paths]:
+      # It keeps its code, but has to be indexed again if it comes back (even if its file didn't change).
+      subevents[subevent_id]["segment"] = -1
+      subevents[subevent_id].pop("source", None)
+
+    todo = sorted(s for s, path in paths.items() if force or self.stale(s, path))
+    if todo:
+      number = self.manifest["next_segment"]
+      parts = []
+      for subevent_id in todo:
+        if subevent_id not in subevents:
+          subevents[subevent_id] = {"code": len(self.subevent_ids)}
+          self.subevent_ids.append(subevent_id)
+        stat = os.stat(paths[subevent_id])
+        subevents[subevent_id].update(segment=number, source={"size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+        parts.append(read_postings(paths[subevent_id], subevents[subevent_id]["code"]))
+
+      write_segment(self.segment_folder(number), *(np.concatenate(arrays) for arrays in zip(*parts)))
+      self.manifest["segments"].append({"number": number, "size": int(sum(len(p[0]) for p in parts))})
+      self.manifest["next_segment"] = number + 1
+
+    self._open()
+    while len(self.segments) > MAX_SEGMENTS:
+      smallest = sorted(self.manifest["segments"], key=lambda s: s["size"])[:MERGE_FANIN]
+      self.merge([s["number"] for s in smallest])
+
+    self.save()
+    return len(todo)
+
+  def merge(self, numbers: list[int] | None = None):
+    """Merges segments (all of them by default) into one, leaving out the postings that aren't live.
+
+    Only the segments that are merged are read into memory.
+    """
+    numbers = numbers if numbers is not None else [s.number for s in self.segments]
+    merging = [s for s in self.segments if s.number in numbers]
+    number = self.manifest["next_segment"]
+
+    parts = []
+    for segment in merging:
+      live = self.live[segment.postings["subevent"]] == segment.number
+      name_keys = np.empty_like(segment.name_keys)
+      name_keys[segment.name_postings] = segment.name_keys
+      parts.append((segment.keys[live], name_keys[live], segment.postings[live]))
+
+    write_segment(self.segment_folder(number), *(np.concatenate(arrays) for arrays in zip(*parts)))
+    for entry in self.manifest["subevents"].values():
+      if entry["segment"] in numbers:
+        entry["segment"] = number
+
+    self.manifest["segments"] = [s for s in self.manifest["segments"] if s["number"] not in numbers]
+    self.manifest["segments"].append({"number": number, "size": int(sum(len(p[0]) for p in parts))})
+    self.manifest["next_segment"] = number + 1
+
+    # Save the manifest before removing the old segments, so that it never points to a missing one.
+    self.save()
+    self._open()
+    for n in numbers:
+      shutil.rmtree(self.segment_folder(n), ignore_errors=True)
+
+  def save(self):
+    """Writes the manifest (through a temporary file)."""
+    path = os.path.join(self.folder, MANIFEST_FILENAME)
+    make_directory(path)
+    with open(path + ".tmp", "w") as f:
+      json.dump(self.manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+  def _live_postings(self, segment: Segment, positions: np.ndarray) -> np.ndarray:
+    postings = segment.postings[positions]
+    return postings[self.live[postings["subevent"]] == segment.number]
+
+  def find_keys(self, keys) -> np.ndarray:
+    """Returns the postings of every athlete key in `keys` (see `POSTING`)."""
+    keys = np.unique(np.asarray(keys, dtype=np.uint64))
+    found = [self._live_postings(s, s.find(keys)) for s in self.segments]
+    return np.concatenate(found) if found else np.empty(0, dtype=POSTING)
+
+  def find(self, contact_id: str | None = None, name: str | None = None) -> np.ndarray:
+    """Returns the postings of an athlete, given their `ContactId` or their name.
+
+    A name matches every result with the same normalized name, whatever its `ContactId`.
+    """
+    if contact_id is not None:
+      return self.find_keys([contact_key(contact_id)])
+    if name is None:
+      raise ValueError("Pass a `contact_id` or a `name`.")
+    key = np.array([name_key(name)], dtype=np.uint64)
+    found = [self._live_postings(s, s.find_names(key)) for s in self.segments]
+    return np.concatenate(found) if found else np.empty(0, dtype=POSTING)
+
+  def results(self, contact_id: str | None = None, name: str | None = None) -> pd.DataFrame:
+    """Returns every result of an athlete (see `find`) as a dataframe, with a column per split."""
+    postings = self.find(contact_id, name)
+    df = pd.DataFrame({
+      "SubEventId": [self.subevent_ids[code] for code in postings["subevent"]],
+      "row": postings["row"],
+    })
+    for i, split in enumerate(TIME_COLUMNS):
+      df[split] = postings["splits"][:, i]
+    return df
+
+  def athletes(self, subevent_id: str) -> np.ndarray:
+    """Returns the (sorted, unique) keys of the athletes in a subevent."""
+    code = self.code(subevent_id)
+    for segment in self.segments:
+      if segment.number == self.live[code]:
+        return segment.athletes(code)
+    return np.empty(0, dtype=np.uint64)
+
+  def overlap(self, a: str | list[str], b: str | list[str]) -> np.ndarray:
+    """Returns the keys of the athletes who raced in both `a` and `b` (subevent IDs, or lists of them).
+
+    Pass the keys to `find_keys` to get their results.
+    """
+    a, b = [a] if isinstance(a, str) else a, [b] if isinstance(b, str) else b
+    keys_a = np.unique(np.concatenate([self.athletes(s) for s in a])) if len(a) > 1 else self.athletes(a[0])
+    keys_b = np.unique(np.concatenate([self.athletes(s) for s in b])) if len(b) > 1 else self.athletes(b[0])
+    return np.intersect1d(keys_a, keys_b, assume_unique=True)
+
+
+def main():
+  """Build (or update) the index of every athlete's results across the results store."""
+  parser = argparse.ArgumentParser(description="Build (or update) the index of every athlete's results across the results store.")
+  parser.add_argument("--store", type=str, default=store_folder(), help="The folder of the results store")
+  parser.add_argument("--out", type=str, default=index_folder(), help="Where to put the index")
+  parser.add_argument("--force", action="store_true", help="Index every subevent, even if it hasn't changed")
+  parser.add_argument("--merge", action="store_true", help="Merge all of the segments into one")
+  args = parser.parse_args()
+
+  index = AthleteIndex(args.out)
+  updated = index.update(list_subevents(args.store), force=args.force)
+  if args.merge and len(index.segments) > 1:
+    index.merge()
+
+  print(f"Indexed {updated} subevents ({len(index.manifest['subevents'])} in total, {len(index.segments)} segments).")
+  print("DONE")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,201 @@
+import sys; sys.path.extend([".", "..", "../.."])
+
+import argparse
+import json
+import os
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from utils.paths import data_folder, tasks_folder, make_directory
+from job import Job, JobStatus, stream_pooled_jobs
+from create_im_csv import iter_chunks
+
+
+# Bump this if the layout of the entries changes, so that they all get rebuilt.
+CATALOG_VERSION = 1
+
+SPLIT_COLUMNS = ["SwimTime", "Transition1Time", "BikeTime", "Transition2Time", "RunTime", "FinishTime"]
+
+# A subevent where more than this fraction of the athletes have the same gender is
+# treated as a men's or women's race (e.g the split World Championships).
+GENDER_THRESHOLD = 0.9
+
+
+def gender_mode(genders: dict[str, int]) -> str:
+  """Returns "F", "M" or "MF" (mixed) given the number of athletes of each gender."""
+  F = genders.get("F", 0)
+  M = genders.get("M", 0)
+  if F + M == 0:
+    return "MF"
+  if F / (F + M) > GENDER_THRESHOLD:
+    return "F"
+  elif M / (F + M) > GENDER_THRESHOLD:
+    return "M"
+  return "MF"
+
+
+def source_signature(path: str) -> dict:
+  """Returns the size and modification time of a results file, used to tell if it changed."""
+  stat = os.stat(path)
+  return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def summarize(path: str, chunksize: int = 5000) -> dict:
+  """Summarizes a results file in one (streaming) pass.
+
+  The split statistics include every positive time, so e.g the swim times of
+  athletes who didn't finish are counted too.
+  """
+  genders, age_groups, statuses = Counter(), Counter(), Counter()
+  times = {split: [] for split in SPLIT_COLUMNS}
+
+  for df in iter_chunks(path, chunksize=chunksize):
+    genders.update(df.ContactGender.replace("", "unknown").value_counts().to_dict())
+    if "AgeGroup" in df:
+      age_groups.update(df.AgeGroup.dropna().value_counts().to_dict())
+    if "EventStatus" in df:
+      statuses.update(df.EventStatus.dropna().value_counts().to_dict())
+    for split in SPLIT_COLUMNS:
+      if split in df:
+        values = pd.to_numeric(df[split], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+        times[split].append(values[values > 0])
+
+  splits = {}
+  for split, chunks in times.items():
+    values = np.concatenate(chunks) if chunks else np.empty(0)
+    if len(values) == 0:
+      splits[split] = None
+    else:
+      splits[split] = {"min": float(values.min()), "median": float(np.median(values)), "max": float(values.max())}
+
+  genders = {k: int(v) for k, v in genders.items()}
+
+  return {
+    "v": CATALOG_VERSION,
+    "source": source_signature(path),
+    "participants": int(sum(genders.values())),
+    "finishers": int(statuses.get("Finish", 0)),
+    "gender": gender_mode(genders),
+    "genders": genders,
+    "age_groups": {k: int(v) for k, v in sorted(age_groups.items())},
+    "statuses": {k: int(v) for k, v in sorted(statuses.items())},
+    "splits": splits,
+  }
+
+
+class Catalog:
+  """Summary statistics for each subevent, so that questions like "is this a women's
+  race?" or "how many people finished?" don't need a scan of the results.
+
+  Each entry (keyed by subevent ID) has:
+  - `participants` and `finishers`: the number of results, and of those with a status of "Finish"
+  - `gender`: "F", "M" or "MF" (see `gender_mode`)
+  - `genders`, `age_groups`, `statuses`: the number of results with each value
+  - `splits`: the min, median and max of each split time (in seconds)
+  - `source`: the size and modification time of the results file the entry was built from
+
+  Use `update` to (re)build the entries of subevents whose results file changed.
+  """
+  def __init__(self, path: str = tasks_folder("im/catalog.json")):
+    self.path = path
+
+    if os.path.exists(path):
+      with open(path, "r") as file:
+        self.entries: dict[str, dict] = json.load(file)
+    else:
+      self.entries = {}
+
+  def get(self, subevent_id: str) -> dict | None:
+    """Returns the catalog entry for a subevent (if there is one)."""
+    return self.entries.get(subevent_id)
+
+  def gender(self, subevent_id: str) -> str | None:
+    """Returns the gender mode of a subevent ("F", "M" or "MF")."""
+    entry = self.get(subevent_id)
+    return entry["gender"] if entry is not None else None
+
+  def stale(self, subevent_id: str) -> bool:
+    """Returns True if the results of a subevent changed since its entry was built."""
+    filepath = data_folder(f"im/json/{subevent_id}.json")
+    if not os.path.exists(filepath):
+      return False
+    entry = self.get(subevent_id)
+    return entry is None or entry.get("v") != CATALOG_VERSION or entry["source"] != source_signature(filepath)
+
+  def add(self, subevent_id: str, entry: dict):
+    self.entries[subevent_id] = entry
+
+  def update(self, subevent_ids: list[str], p: int = 1, force: bool = False) -> int:
+    """Rebuilds the entries of the subevents that are stale (or all of them, if `force`).
+
+    Returns the number of entries that were rebuilt.
+    """
+    todo = [id for id in subevent_ids if (force and os.path.exists(data_folder(f"im/json/{id}.json"))) or self.stale(id)]
+    jobs = [Job(summarize, (data_folder(f"im/json/{id}.json"),)) for id in todo]
+
+    updated = 0
+    for i, r in enumerate(stream_pooled_jobs(jobs, t=p, processes=p > 1), start=1):
+      subevent_id = os.path.basename(r.args[0]).replace(".json", "")
+      if r.status != JobStatus.FULFILLED:
+        print(f"[{i}/{len(jobs)}] Failed to summarize {subevent_id}: {r.reason}")
+        continue
+      self.add(subevent_id, r.value)
+      updated += 1
+
+    return updated
+
+  def to_frame(self) -> pd.DataFrame:
+    """Returns one row per subevent, with the counts and split medians as columns."""
+    rows = []
+    for subevent_id, entry in self.entries.items():
+      row = {
+        "subevent_id": subevent_id,
+        "participants": entry["participants"],
+        "finishers": entry["finishers"],
+        "gender": entry["gender"],
+        "F": entry["genders"].get("F", 0),
+        "M": entry["genders"].get("M", 0),
+      }
+      for split, stats in entry["splits"].items():
+        row[f"{split}Median"] = stats["median"] if stats is not None else np.nan
+      rows.append(row)
+    columns = ["subevent_id", "participants", "finishers", "gender", "F", "M"] + [f"{split}Median" for split in SPLIT_COLUMNS]
+    return pd.DataFrame(rows, columns=columns)
+
+  def save(self):
+    """Writes the catalog to disk (through a temporary file, like the manifest)."""
+    make_directory(self.path)
+    tmp = self.path + ".tmp"
+    with open(tmp, "w") as file:
+      json.dump(self.entries, file, indent=2, sort_keys=True)
+    os.replace(tmp, self.path)
+
+
+def load_catalog(path: str = tasks_folder("im/catalog.json")) -> pd.DataFrame:
+  """Loads the catalog as a dataframe (see `Catalog.to_frame`)."""
+  return Catalog(path).to_frame()
+
+
+def main():
+  """Build (or update) the catalog of subevents."""
+  parser = argparse.ArgumentParser(description="Build (or update) the catalog of subevents.")
+  parser.add_argument("--p", type=int, default=os.cpu_count(), help="The number of processes to use")
+  parser.add_argument("--force", action="store_true", help="Rebuild every entry, even if its results haven't changed")
+  args = parser.parse_args()
+
+  df = pd.read_csv(tasks_folder("im/subevents.csv"))
+  catalog = Catalog()
+
+  try:
+    updated = catalog.update(list(df.subevent_id.unique()), p=args.p, force=args.force)
+  finally:
+    catalog.save()
+
+  print(f"Updated {updated} of {len(catalog.entries)} entries.")
+  print("DONE")
+
+
+if __name__ == "__main__":
+  main()
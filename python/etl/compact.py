@@ -0,0 +1,163 @@
+import gzip
+import hashlib
+import json
+
+import brotli
+import numpy as np
+import pandas as pd
+
+
+# Bump this if the layout of the compact format changes.
+FORMAT_VERSION = 2
+
+# Short names for the columns of a published file. Columns that aren't listed here
+# keep their full name. The mapping is also written to each file (see `encode`).
+KEYS = {
+  "ResultId": "id",
+  "ContactId": "cid",
+  "Contact": "c",
+  "Country": "co",
+  "Subevent": "se",
+  "SubEventId": "sid",
+  "SubeventName": "sn",
+  "AgeGroup": "ag",
+  "Gender": "g",
+  "CountryISO2": "cc",
+  "CountryRepresentingISONumeric": "ccn",
+  "BibNumber": "bib",
+  "EventStatus": "es",
+  "StatusCode": "sc",
+  "RankPoints": "rp",
+  "SyncDate": "sd",
+  "FinishTime": "ft",
+  "SwimTime": "swt",
+  "Transition1Time": "t1",
+  "BikeTime": "bt",
+  "Transition2Time": "t2",
+  "RunTime": "rt",
+  "FinishTimeConverted": "ftc",
+  "SwimTimeConverted": "swtc",
+  "Transition1TimeConverted": "t1c",
+  "BikeTimeConverted": "btc",
+  "Transition2TimeConverted": "t2c",
+  "RunTimeConverted": "rtc",
+  "FinishRankGroup": "frg",
+  "FinishRankGender": "frs",
+  "FinishRankOverall": "fro",
+  "SwimRankGroup": "srg",
+  "SwimRankGender": "srs",
+  "SwimRankOverall": "sro",
+  "BikeRankGroup": "brg",
+  "BikeRankGender": "brs",
+  "BikeRankOverall": "bro",
+  "RunRankGroup": "rrg",
+  "RunRankGender": "rrs",
+  "RunRankOverall": "rro",
+  # Fields of the nested objects.
+  "FullName": "n",
+  "ISO2": "i2",
+  "SubEvent": "sev",
+}
+
+# Columns with fewer distinct values than this fraction of the rows are dictionary-encoded.
+DICTIONARY_RATIO = 0.5
+
+
+def encode_column(values: list | pd.Series, used: set[str] | None = None):
+  """Encodes one column of a published file.
+
+  - Numbers that are all whole become a list of ints (e.g ranks are 3 instead of 3.0).
+  - Columns of objects (e.g `Contact`) are encoded recursively as `{"o": {key: column}}`.
+    Rows where the object is missing (e.g null, or -1 after `rank_frame`) are listed
+    with their value in `"m": [[row, value], ...]`.
+  - Columns with few distinct values become `{"d": [distinct values], "i": [index of each value]}`.
+  - Anything else is left as a list.
+
+  The (long) names of the nested fields are added to `used`.
+  """
+  s = pd.Series(values)
+
+  if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+    array = s.to_numpy(dtype=np.float64)
+    if np.isfinite(array).all() and (array == np.round(array)).all():
+      return array.astype(np.int64).tolist()
+    return [None if np.isnan(x) else x for x in array.tolist()]
+
+  is_dict = s.map(lambda v: isinstance(v, dict))
+  if is_dict.any() and not s[~is_dict].map(lambda v: isinstance(v, (list, tuple))).any():
+    objects = [v if isinstance(v, dict) else {} for v in s]
+    keys = list(dict.fromkeys(k for v in objects for k in v))
+    if used is not None:
+      used.update(keys)
+    column = {"o": {KEYS.get(k, k): encode_column([v.get(k) for v in objects], used) for k in keys}}
+    if not is_dict.all():
+      column["m"] = [[i, None if isinstance(v, float) and np.isnan(v) else v] for i, v in enumerate(s) if not isinstance(v, dict)]
+    return column
+
+  codes, uniques = pd.factorize(s, use_na_sentinel=False)
+  if len(uniques) < DICTIONARY_RATIO * len(s):
+    return {"d": uniques.tolist(), "i": codes.tolist()}
+
+  return s.tolist()
+
+
+def decode_column(column, n: int, keys: dict[str, str]) -> list:
+  """Decodes a column that was encoded with `encode_column`."""
+  if isinstance(column, list):
+    return column
+
+  if "o" in column:
+    fields = {keys.get(k, k): decode_column(v, n, keys) for k, v in column["o"].items()}
+    rows = [{k: fields[k][i] for k in fields} for i in range(n)]
+    for i, value in column.get("m", []):
+      rows[i] = value
+    return rows
+
+  return [column["d"][i] for i in column["i"]]
+
+
+def encode(df: pd.DataFrame, total: int) -> dict:
+  """Encodes a (ranked) dataframe of results as struct-of-arrays JSON.
+
+  ```json
+  {"v": 2, "total": 1587, "n": 1587, "keys": {"ft": "FinishTime", ...}, "cols": {"ft": [14335, ...], ...}}
+  ```
+  """
+  used = set(df.columns)
+  cols = {KEYS.get(c, c): encode_column(df[c], used) for c in df.columns}
+  keys = {short: long for long, short in KEYS.items() if long in used}
+  return {"v": FORMAT_VERSION, "total": total, "n": len(df), "keys": keys, "cols": cols}
+
+
+def decode(payload: dict) -> dict:
+  """Decodes a compact file back into `{"total": ..., "data": [...]}` (row objects)."""
+  n = payload["n"]
+  keys = payload["keys"]
+  columns = {keys.get(k, k): decode_column(v, n, keys) for k, v in payload["cols"].items()}
+  data = [{k: columns[k][i] for k in columns} for i in range(n)]
+  return {"total": payload["total"], "data": data}
+
+
+def dumps(payload: dict) -> bytes:
+  """Serializes a payload without any whitespace."""
+  return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+
+def write_precompressed(path: str, body: bytes) -> dict:
+  """Writes `body` to `path`, along with `.gz` and `.br` copies.
+
+  Returns the size of each file and the hash of the (uncompressed) body.
+  """
+  gz = gzip.compress(body, compresslevel=9, mtime=0)
+  br = brotli.compress(body, quality=11)
+
+  for p, b in ((path, body), (path + ".gz", gz), (path + ".br", br)):
+    with open(p, "wb") as f:
+      f.write(b)
+
+  return {
+    "bytes": len(body),
+    "gz_bytes": len(gz),
+    "br_bytes": len(br),
+    "sha256": hashlib.sha256(body).hexdigest(),
+  }
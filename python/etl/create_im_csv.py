@@ -1,66 +1,195 @@
 import sys; sys.path.extend([".", "..", "../.."])
 
+import csv
 import glob
-import json
+import os
+import ijson
+import numpy as np
 import pandas as pd
+from itertools import islice
+from typing import Iterator
 
 from utils.paths import data_folder
+from job import Job, JobStatus, stream_pooled_jobs
+from metrics import METRICS, metrics_path
+
+
+# These columns could identify a person, so they're left out of the anonymized CSV.
+IDENTIFYING_COLUMNS = ["ContactFullName", "BibNumber", "ContactId"]
+
+
+def flatten(data: list[dict]) -> pd.DataFrame:
+  """Create a dataframe from a list of results, flattening the nested fields.
+
+  The nested fields are flattened column-wise rather than one record at a time.
+  """
+  df = pd.DataFrame(data)
+
+  contact = df.pop("Contact") if "Contact" in df else pd.Series(None, index=df.index, dtype=object)
+  country = df.pop("Country") if "Country" in df else pd.Series(None, index=df.index, dtype=object)
+  df.drop(columns=["Subevent"], inplace=True, errors="ignore")
+
+  # Flatten the contact nested field. Note that `.str.get` returns NaN if the field is None.
+  df["ContactFullName"] = contact.str.get("FullName").fillna("")
+  df["ContactGender"] = contact.str.get("Gender").fillna("")
+  df["CountryISO2"] = country.str.get("ISO2").fillna("")
+
+  return df
+
+
+def normalize_numbers(df: pd.DataFrame) -> pd.DataFrame:
+  """Makes each number print the same way whichever chunk it's in (in place).
+
+  pandas picks the type of each column per chunk, so a column with a null in one
+  chunk would be written as `5000.0` there and as `5000` in the next. Instead, whole
+  numbers are always written as ints, other numbers as floats, and nulls as empty.
+  """
+  for c in df.columns:
+    s = df[c]
+    if not pd.api.types.is_float_dtype(s):
+      continue
+    a = s.to_numpy(dtype=np.float64)
+    null = np.isnan(a)
+    whole = ~null & (a == np.round(a))
+    if (whole | null).all():
+      df[c] = s.astype("Int64")
+    else:
+      out = s.astype(object)
+      out[whole] = a[whole].astype(np.int64)
+      out[null] = None
+      df[c] = out
+  return df
+
+
+def iter_chunks(path: str, chunksize: int = 5000) -> Iterator[pd.DataFrame]:
+  """Stream the results in a JSON file as (flattened) dataframes of up to `chunksize` rows.
+
+  The file is parsed incrementally, so only one chunk of results is held in memory at a time.
+  """
+  with open(path, "rb") as file:
+    items = ijson.items(file, "data.item", use_float=True)
+    while True:
+      with METRICS.stage("parse"):
+        chunk = list(islice(items, chunksize))
+      if len(chunk) == 0:
+        break
+      with METRICS.stage("flatten"):
+        df = flatten(chunk)
+      yield df
 
 
 def create_csv(path: str, anonymized: bool = True) -> pd.DataFrame:
   """Create a CSV file from a given path.
-  
+
   If `anonymized` is True, the CSV will not contain information that could identify the person.
   """
-  with open(path, "r") as file:
-    data = json.load(file)["data"]
+  chunks = list(iter_chunks(path))
 
-  if len(data) == 0:
+  if len(chunks) == 0:
     return None
-  
-  for d in data:
-    # Flatten the contact nested field.
-    d["ContactFullName"] = (d.get("Contact", {}) or {}).get("FullName", "")
-    d["ContactGender"] = (d.get("Contact", {}) or {}).get("Gender", "")
-    d["CountryISO2"] = (d.get("Country", {}) or {}).get("ISO2", "")
-
-    # Delete the nested fields.
-    del d["Contact"]
-    del d["Country"]
-    del d["Subevent"]
 
-  df = pd.DataFrame(data)
+  df = pd.concat(chunks, ignore_index=True)
 
   if anonymized:
-    df.drop(columns=["ContactFullName", "BibNumber", "ContactId"], inplace=True)
+    df.drop(columns=IDENTIFYING_COLUMNS, inplace=True)
 
   return df
 
 
-def main():
-  """Create CSV files from the results JSON files."""
-  filenames = glob.glob(data_folder("im/json/*.json"))
+def pad_csv(path: str, header: list[str]):
+  """Rewrites the header of a CSV, and pads its rows to the length of the new `header` (with empty values).
+
+  The rows are streamed, so this doesn't hold the file in memory.
+  """
+  with open(path, "r", newline="") as src, open(path + ".pad", "w", newline="") as dst:
+    reader, writer = csv.reader(src), csv.writer(dst, lineterminator="\n")
+    next(reader)
+    writer.writerow(header)
+    for row in reader:
+      writer.writerow(row + [""] * (len(header) - len(row)))
+  os.replace(path + ".pad", path)
+
+
+def convert(path: str, chunksize: int = 5000) -> int:
+  """Create both the anonymized and the full CSV file for a JSON results file.
+
+  The file is parsed once, and each chunk of results is appended to both CSVs. They
+  are written to temporary files first, and moved into place (the full CSV last)
+  once they're complete, so an interrupted conversion never leaves a truncated CSV
+  that looks newer than its JSON. A field that first appears in a later chunk is
+  added as a column at the end (and empty in the rows before it). Returns the
+  number of rows that were written.
+  """
+  csv = path.replace("json", "csv")
+  anon_csv = csv.replace(".csv", ".anon.csv")
+
+  columns = None
+  grew = False
+  rows = 0
+
+  for df in iter_chunks(path, chunksize=chunksize):
+    if columns is None:
+      columns = list(df.columns)
+    else:
+      # Later chunks must line up with the columns that were written before them.
+      added = [c for c in df.columns if c not in columns]
+      if added:
+        columns += added
+        grew = True
+      df = df.reindex(columns=columns)
+
+    mode, header = ("w", True) if rows == 0 else ("a", False)
+    with METRICS.stage("serialize"):
+      normalize_numbers(df)
+      df.drop(columns=IDENTIFYING_COLUMNS).to_csv(anon_csv + ".tmp", mode=mode, header=header, index=False)
+      df.to_csv(csv + ".tmp", mode=mode, header=header, index=False)
+    rows += len(df)
+
+  if grew:
+    # The header was written with the columns of the first chunk.
+    with METRICS.stage("serialize"):
+      pad_csv(anon_csv + ".tmp", [c for c in columns if c not in IDENTIFYING_COLUMNS])
+      pad_csv(csv + ".tmp", columns)
+
+  if rows > 0:
+    os.replace(anon_csv + ".tmp", anon_csv)
+    os.replace(csv + ".tmp", csv)
+
+  METRICS.set("subevent_rows", rows, subevent=os.path.basename(path).replace(".json", ""))
+  METRICS.inc("rows_total", rows)
+  return rows
 
-  for filename in filenames:
-    print(filename)
-    print(f"Processing {filename.split("/")[-1]}...")
 
-    # Output to the csv folder.
-    csv = filename.replace("json", "csv")
+def main():
+  """Create CSV files from the results JSON files."""
+  from argparse import ArgumentParser
+  parser = ArgumentParser()
+  parser.add_argument("--p", type=int, default=os.cpu_count(), help="The number of processes to use")
+  parser.add_argument("--metrics", type=str, default=metrics_path("create_im_csv"),
+                      help="Where to write the metrics of the run (Prometheus text if it ends in .prom, JSON otherwise)")
+  args = parser.parse_args()
 
-    df = create_csv(filename, anonymized=True)
+  filenames = glob.glob(data_folder("im/json/*.json"))
 
-    if df is None:
-      print("No data found! Skipping...")
-      continue
+  print(f"Converting {len(filenames)} files using {args.p} processes.")
 
-    df.to_csv(csv.replace(".csv", ".anon.csv"), index=False)
+  jobs = [Job(convert, (filename,)) for filename in filenames]
 
-    df = create_csv(filename, anonymized=False)
-    df.to_csv(csv, index=False)
+  try:
+    for i, r in enumerate(stream_pooled_jobs(jobs, t=args.p, processes=True, name="convert"), start=1):
+      name = os.path.basename(r.args[0])
+      if r.status != JobStatus.FULFILLED:
+        print(f"[{i}/{len(jobs)}] Failed to convert {name}: {r.reason}")
+      elif r.value == 0:
+        print(f"[{i}/{len(jobs)}] No data found in {name}! Skipping...")
+      else:
+        print(f"[{i}/{len(jobs)}] Processed {name} ({r.value} rows)")
+  finally:
+    METRICS.write(args.metrics)
+    print(METRICS.summary())
 
   print("DONE")
 
 
 if __name__ == "__main__":
-  main()
\ No newline at end of file
+  main()
@@ -0,0 +1,54 @@
+import sys; sys.path.extend([".", "..", "../.."])
+
+import os
+import pandas as pd
+
+from utils.paths import data_folder, tasks_folder
+from utils.store import store_path, write_subevent
+from create_im_csv import create_csv
+
+
+def main():
+  """Add the results JSON files to the columnar (Parquet) results store.
+
+  The store is partitioned by series and year, so it can be read with `utils.store.read_results`.
+  Subevents whose Parquet file is newer than their JSON file are skipped.
+  """
+  from argparse import ArgumentParser
+  parser = ArgumentParser()
+  parser.add_argument("--overwrite", action="store_true", help="Rewrite subevents that are already in the store")
+  args = parser.parse_args()
+
+  df = pd.read_csv(tasks_folder("im/subevents.csv"))
+  df = df.drop_duplicates(subset=["subevent_id"])
+
+  written, skipped = 0, 0
+
+  for row in df.itertuples():
+    filename = data_folder(f"im/json/{row.subevent_id}.json")
+    if not os.path.exists(filename):
+      continue
+
+    path = store_path(row.subevent_id, row.series, row.year)
+    if not args.overwrite and os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(filename):
+      skipped += 1
+      continue
+
+    print(f"Processing {row.subevent_id}...")
+
+    # The anonymized view is a projection of the store, so we only need to write one copy.
+    results = create_csv(filename, anonymized=False)
+
+    if results is None:
+      print("No data found! Skipping...")
+      continue
+
+    write_subevent(results, row.subevent_id, row.series, row.year)
+    written += 1
+
+  print(f"Wrote {written} subevents to the store ({skipped} were already up to date).")
+  print("DONE")
+
+
+if __name__ == "__main__":
+  main()
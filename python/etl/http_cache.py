@@ -0,0 +1,384 @@
+import sys; sys.path.extend([".", "..", "../.."])
+
+import hashlib
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Callable
+
+import requests
+
+from utils.paths import data_folder, make_directory
+from metrics import METRICS
+import ratelimit
+
+
+DAY = 24 * 60 * 60
+
+# How long (in seconds) a response from each endpoint can be used without checking
+# that it's still current. None means forever, and 0 means it's always revalidated.
+DEFAULT_TTLS = {
+  "event": None, # the `EventYear` of a subevent never changes once it's set
+  "tab": 30 * DAY, # a results tab always points at the same subevent
+  "race_page": DAY, # a tab is added each time the race is held
+  "discontinued": 7 * DAY,
+  "sheets": DAY,
+  "result_page": 0, # results can be corrected at any time
+}
+DEFAULT_TTL = 0
+
+DEFAULT_MAX_MB = 2048
+
+# The share of the cache that the responses of an endpoint can take (the others share
+# all of it). Results pages are revalidated every time, and a backfill downloads far
+# more of them than fit, so they're kept from evicting the responses that never expire.
+DEFAULT_BUDGETS = {
+  "result_page": 0.25,
+}
+
+# - "on": use fresh responses, and revalidate stale ones
+# - "refresh": revalidate every response, even if it's fresh
+# - "offline": replay responses from the cache, and never touch the network
+# - "off": don't read or write the cache
+MODES = ("on", "refresh", "offline", "off")
+
+# The headers of a response that are kept (the ones needed to revalidate and decode it).
+KEPT_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+
+def http_cache_folder(relative_path: str = "") -> str:
+  """Returns a path relative to the folder of the HTTP cache."""
+  return data_folder(os.path.join("im/http_cache", relative_path))
+
+
+class CacheMiss(KeyError):
+  """Raised in offline mode when a request isn't in the cache."""
+
+
+@dataclass
+class CachedResponse:
+  """The parts of a `requests.Response` that the scrapers use.
+
+  `source` says where it came from: "network", "cache" (fresh), "revalidated" (a 304)
+  or "replay" (offline).
+  """
+  url: str
+  status_code: int
+  content: bytes
+  headers: dict[str, str] = field(default_factory=dict)
+  source: str = "network"
+
+  @property
+  def text(self) -> str:
+    content_type = self.headers.get("Content-Type", "")
+    charset = content_type.split("charset=")[-1].split(";")[0].strip() if "charset=" in content_type else "utf-8"
+    return self.content.decode(charset, errors="replace")
+
+  def json(self):
+    return json.loads(self.content)
+
+
+class HttpCache:
+  """A content-addressed cache of HTTP responses on disk, shared by the scrapers.
+
+  Each response body is stored once under its SHA-256 (in `blobs`), and the index
+  maps each request (its full URL, without headers) to a body, its `ETag` and
+  `Last-Modified` headers, and when it was fetched and last used.
+
+  A response is used without a request for the TTL of its endpoint. After that, it
+  is revalidated with `If-None-Match`/`If-Modified-Since`, so an unchanged page
+  costs a 304 rather than a download. Only 200 responses are kept. When the bodies
+  take more than `max_bytes`, the least recently used responses are evicted. An
+  endpoint with a budget (a share of `max_bytes`) only evicts its own responses
+  once it's over it.
+
+  The index is shared between threads, so all access goes through a lock. Like the
+  manifest, it's saved every `autosave` updates (new or revalidated responses, not
+  hits) and when `save` is called.
+  """
+  def __init__(
+    self,
+    folder: str = http_cache_folder(),
+    max_bytes: int = DEFAULT_MAX_MB * 1_000_000,
+    ttls: dict[str, float | None] = DEFAULT_TTLS,
+    budgets: dict[str, float] = DEFAULT_BUDGETS,
+    mode: str = "on",
+    autosave: int = 200,
+  ):
+    if mode not in MODES:
+      raise ValueError(f"The cache mode has to be one of {MODES}.")
+    self.folder = folder
+    self.max_bytes = max_bytes
+    self.ttls = ttls
+    self.budgets = budgets
+    self.mode = mode
+    self.autosave = autosave
+    self._lock = Lock()
+    self._save_lock = Lock()
+    self._updates = 0
+
+    path = os.path.join(folder, "index.json")
+    if os.path.exists(path):
+      with open(path, "r") as f:
+        self.entries: dict[str, dict] = json.load(f)
+    else:
+      self.entries = {}
+
+    # Bodies can be shared by several requests, so they're only deleted once nothing uses them.
+    self.refs: dict[str, int] = {}
+    self.sizes: dict[str, int] = {}
+    # The bytes of the responses of each endpoint (counting a shared body once per response).
+    self.endpoint_bytes: dict[str, int] = {}
+    for entry in self.entries.values():
+      self.refs[entry["sha256"]] = self.refs.get(entry["sha256"], 0) + 1
+      self.sizes[entry["sha256"]] = entry["size"]
+      self.endpoint_bytes[entry["endpoint"]] = self.endpoint_bytes.get(entry["endpoint"], 0) + entry["size"]
+    self.nbytes = sum(self.sizes.values())
+
+  @staticmethod
+  def key(url: str, params: dict | None = None) -> str:
+    """Returns the full URL of a request (with its parameters encoded, like `requests` does)."""
+    return requests.Request("GET", url, params=params).prepare().url
+
+  def blob_path(self, sha256: str) -> str:
+    return os.path.join(self.folder, "blobs", sha256[:2], sha256)
+
+  def ttl(self, endpoint: str) -> float | None:
+    return self.ttls.get(endpoint, DEFAULT_TTL)
+
+  def budget(self, endpoint: str) -> float:
+    """Returns how many bytes the responses of an endpoint can take."""
+    return self.budgets.get(endpoint, 1) * self.max_bytes
+
+  def lookup(self, url: str) -> tuple[dict, bytes] | None:
+    """Returns the index entry and body of a cached request (or None)."""
+    with self._lock:
+      entry = self.entries.get(url)
+      entry = dict(entry) if entry is not None else None
+    if entry is None:
+      return None
+    try:
+      with open(self.blob_path(entry["sha256"]), "rb") as f:
+        return entry, f.read()
+    except FileNotFoundError:
+      return None
+
+  def get(
+    self,
+    url: str,
+    params: dict | None = None,
+    headers: dict | None = None,
+    endpoint: str = "default",
+    timeout: float | None = None,
+    keep: Callable[[CachedResponse], bool] | None = None,
+  ) -> CachedResponse:
+    """Gets a URL, from the cache if possible.
+
+    The `headers` (e.g an API key) are sent, but aren't part of the cache key. If
+    `keep` is given, a response is only cached if `keep(response)` is True (e.g if
+    it has the field that never changes). Raises a `CacheMiss` in offline mode if
+    the request isn't cached.
+    """
+    url = self.key(url, params)
+
+    if self.mode == "off":
+      return self.fetch(url, headers, endpoint, timeout)
+
+    cached = self.lookup(url)
+    now = time.time()
+
+    if self.mode == "offline":
+      if cached is None:
+        METRICS.inc("http_cache_total", endpoint=endpoint, result="offline_miss")
+        raise CacheMiss(f"{url} isn't in the cache (and the cache is offline).")
+      self.touch(url, now)
+      METRICS.inc("http_cache_total", endpoint=endpoint, result="replay")
+      return self.response(url, cached, "replay")
+
+    if cached is not None:
+      entry, _ = cached
+      ttl = self.ttl(endpoint)
+      if self.mode != "refresh" and (ttl is None or now - entry["fetched_at"] < ttl):
+        self.touch(url, now)
+        METRICS.inc("http_cache_total", endpoint=endpoint, result="hit")
+        METRICS.inc("http_cache_bytes_saved_total", entry["size"], endpoint=endpoint)
+        return self.response(url, cached, "cache")
+
+    # Revalidate what we have, if the server told us how to.
+    conditional = dict(headers or {})
+    if cached is not None:
+      entry, _ = cached
+      if entry["headers"].get("ETag"):
+        conditional["If-None-Match"] = entry["headers"]["ETag"]
+      if entry["headers"].get("Last-Modified"):
+        conditional["If-Modified-Since"] = entry["headers"]["Last-Modified"]
+
+    response = self.fetch(url, conditional, endpoint, timeout)
+
+    if response.status_code == 304 and cached is not None:
+      self.touch(url, now, fetched=True)
+      METRICS.inc("http_cache_total", endpoint=endpoint, result="revalidated")
+      METRICS.inc("http_cache_bytes_saved_total", cached[0]["size"], endpoint=endpoint)
+      return self.response(url, cached, "revalidated")
+
+    METRICS.inc("http_cache_total", endpoint=endpoint, result="miss" if cached is None else "changed")
+    if response.status_code == 200 and (keep is None or keep(response)):
+      self.put(url, endpoint, response, now)
+    return response
+
+  def fetch(self, url: str, headers: dict | None, endpoint: str, timeout: float | None) -> CachedResponse:
+    # The request waits for its turn with the host (see `ratelimit.py`), and is retried if it's throttled. It goes
+    # through the host's pooled session, so a miss or a revalidation doesn't pay for a new TCP and TLS handshake.
+    r = ratelimit.get(url, headers=headers, timeout=timeout, endpoint=endpoint)
+    kept = {k: r.headers[k] for k in KEPT_HEADERS if k in r.headers}
+    return CachedResponse(url, r.status_code, r.content, kept, "network")
+
+  @staticmethod
+  def response(url: str, cached: tuple[dict, bytes], source: str) -> CachedResponse:
+    entry, content = cached
+    return CachedResponse(url, entry["status"], content, dict(entry["headers"]), source)
+
+  def put(self, url: str, endpoint: str, response: CachedResponse, now: float):
+    """Stores a response, and evicts the least recently used ones if the cache is too big."""
+    sha256 = hashlib.sha256(response.content).hexdigest()
+    path = self.blob_path(sha256)
+    if not os.path.exists(path):
+      make_directory(path)
+      # Write to a temporary file first, so that a body is never half-written.
+      tmp = f"{path}.{os.getpid()}.{id(response)}.tmp"
+      with open(tmp, "wb") as f:
+        f.write(response.content)
+      os.replace(tmp, path)
+
+    entry = dict(
+      endpoint=endpoint,
+      sha256=sha256,
+      size=len(response.content),
+      status=response.status_code,
+      headers=response.headers,
+      fetched_at=now,
+      used_at=now,
+    )
+    with self._lock:
+      previous = self.entries.get(url)
+      self.entries[url] = entry
+      self._ref(sha256, len(response.content))
+      self.endpoint_bytes[endpoint] = self.endpoint_bytes.get(endpoint, 0) + entry["size"]
+      if previous is not None:
+        self._unref(previous["sha256"])
+        self.endpoint_bytes[previous["endpoint"]] -= previous["size"]
+      if self.endpoint_bytes[endpoint] > self.budget(endpoint):
+        self._evict(self.budget(endpoint), endpoint)
+      if self.nbytes > self.max_bytes:
+        self._evict(self.max_bytes)
+    self._update()
+
+  def touch(self, url: str, now: float, fetched: bool = False):
+    """Records that a cached response was used (or revalidated, if `fetched`).
+
+    Only a revalidation counts towards `autosave`: if a hit isn't saved, the response
+    just looks a little less recently used.
+    """
+    with self._lock:
+      entry = self.entries.get(url)
+      if entry is None:
+        return
+      entry["used_at"] = now
+      if fetched:
+        entry["fetched_at"] = now
+    if fetched:
+      self._update()
+
+  def _ref(self, sha256: str, size: int):
+    if sha256 not in self.refs:
+      self.refs[sha256] = 0
+      self.sizes[sha256] = size
+      self.nbytes += size
+    self.refs[sha256] += 1
+
+  def _unref(self, sha256: str):
+    self.refs[sha256] -= 1
+    if self.refs[sha256] == 0:
+      del self.refs[sha256]
+      self.nbytes -= self.sizes.pop(sha256)
+      try:
+        os.remove(self.blob_path(sha256))
+      except FileNotFoundError:
+        pass
+
+  def _evict(self, max_bytes: float, endpoint: str | None = None):
+    """Evicts the least recently used responses until they take under 90% of `max_bytes` (call with the lock held).
+
+    If `endpoint` is given, only its responses are evicted (and counted).
+    """
+    urls = [u for u in self.entries if endpoint is None or self.entries[u]["endpoint"] == endpoint]
+    for url in sorted(urls, key=lambda u: self.entries[u]["used_at"]):
+      if (self.nbytes if endpoint is None else self.endpoint_bytes[endpoint]) <= 0.9 * max_bytes:
+        break
+      entry = self.entries.pop(url)
+      self._unref(entry["sha256"])
+      self.endpoint_bytes[entry["endpoint"]] -= entry["size"]
+      METRICS.inc("http_cache_evictions_total", endpoint=entry["endpoint"])
+
+  def stats(self) -> dict:
+    with self._lock:
+      return {
+        "entries": len(self.entries),
+        "bodies": len(self.refs),
+        "bytes": self.nbytes,
+        "endpoint_bytes": dict(self.endpoint_bytes),
+        "max_bytes": self.max_bytes,
+        "mode": self.mode,
+      }
+
+  def save(self):
+    """Writes the index to disk (through a temporary file, like `Manifest.save`).
+
+    Only a snapshot of the index is taken under the lock, so the other threads can
+    keep using the cache while it's written. Entries are replaced rather than
+    resized once they're in the index, so the snapshot is a shallow copy.
+    """
+    if self.mode == "off":
+      return
+    with self._lock:
+      snapshot = dict(self.entries)
+      self._updates = 0
+    # One save at a time, so that they don't write to the same temporary file.
+    with self._save_lock:
+      path = os.path.join(self.folder, "index.json")
+      make_directory(path)
+      with open(path + ".tmp", "w") as f:
+        json.dump(snapshot, f, separators=(",", ":"))
+      os.replace(path + ".tmp", path)
+
+  def _update(self):
+    with self._lock:
+      self._updates += 1
+      should_save = self.autosave and self._updates >= self.autosave
+    if should_save:
+      self.save()
+
+
+_default: HttpCache | None = None
+_default_lock = Lock()
+
+
+def default_cache() -> HttpCache:
+  """Returns the cache that the scrapers share (in the mode of the `HTTP_CACHE` environment variable)."""
+  global _default
+  with _default_lock:
+    if _default is None:
+      _default = HttpCache(mode=os.getenv("HTTP_CACHE", "on"))
+    return _default
+
+
+def configure(**kwargs) -> HttpCache:
+  """Replaces the shared cache, e.g `configure(mode="offline")` or `configure(folder=...)`."""
+  global _default
+  with _default_lock:
+    if _default is not None:
+      _default.save()
+    _default = HttpCache(**kwargs)
+    return _default
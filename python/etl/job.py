@@ -1,9 +1,13 @@
+import os
+import time
 from enum import Enum
 
 from dataclasses import dataclass
-from typing import Any, Callable, Tuple, Optional
+from typing import Any, Callable, Iterator, Tuple, Optional
 
-from concurrent.futures import ThreadPoolExecutor, wait
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from metrics import DEPTH_BUCKETS, METRICS, Metrics
 
 
 class JobStatus(Enum):
@@ -39,6 +43,73 @@ class JobResult:
   value: Optional[Any] = None
   reason: Optional[Exception] = None
   args: Tuple[Any, ...] = ()
+  started_at: Optional[float] = None
+  finished_at: Optional[float] = None
+  attempts: int = 1
+  submitted_at: Optional[float] = None
+  # The metrics that the job recorded in a worker process (see `metrics.Metrics.drain`).
+  metrics: Optional[dict] = None
+
+  @property
+  def elapsed(self) -> Optional[float]:
+    """The wall time (in seconds) from the first attempt until the job finished."""
+    if self.started_at is None or self.finished_at is None:
+      return None
+    return self.finished_at - self.started_at
+
+  @property
+  def queued(self) -> Optional[float]:
+    """The wall time (in seconds) that the job waited for a worker."""
+    if self.submitted_at is None or self.started_at is None:
+      return None
+    return max(self.started_at - self.submitted_at, 0.0)
+
+
+@dataclass
+class Backoff:
+  """Controls how failed jobs are retried.
+
+  The n-th retry waits `min(delay * factor**(n-1), max_delay)` seconds.
+  """
+  retries: int = 0
+  delay: float = 1.0
+  factor: float = 2.0
+  max_delay: float = 60.0
+
+  def wait(self, attempt: int) -> float:
+    """Returns the number of seconds to wait before retrying after `attempt` failed."""
+    return min(self.delay * self.factor ** (attempt - 1), self.max_delay)
+
+
+def execute_with_retries(job: Job, backoff: Backoff, collect_metrics: bool = False) -> JobResult:
+  """Execute a job, retrying it if it raises an exception.
+
+  The exception from the last attempt is returned in the result. If `collect_metrics`
+  is True (i.e in a worker process), the metrics that the job recorded are returned too.
+  """
+  if collect_metrics:
+    # Forget anything this worker inherited from the parent process (when it was forked).
+    METRICS.drain()
+
+  started_at = time.time()
+  attempt = 0
+  while True:
+    attempt += 1
+    try:
+      value = job.execute()
+      result = JobResult(args=job.args, status=JobStatus.FULFILLED, value=value,
+                         started_at=started_at, finished_at=time.time(), attempts=attempt)
+      break
+    except Exception as e:
+      if attempt > backoff.retries:
+        result = JobResult(args=job.args, status=JobStatus.REJECTED, reason=e,
+                           started_at=started_at, finished_at=time.time(), attempts=attempt)
+        break
+      time.sleep(backoff.wait(attempt))
+
+  if collect_metrics:
+    result.metrics = METRICS.drain()
+  return result
 
 
 def await_pooled_jobs(jobs: list[Job], t: int = 4) -> list[JobResult]:
@@ -61,4 +132,193 @@ def await_pooled_jobs(jobs: list[Job], t: int = 4) -> list[JobResult]:
       else:
         results.append(JobResult(args=futures[future], status=JobStatus.FULFILLED, value=future.result()))
 
-    return results
\ No newline at end of file
+    return results
+
+
+def stream_pooled_jobs(
+  jobs: list[Job],
+  t: int = 4,
+  max_in_flight: Optional[int] = None,
+  backoff: Optional[Backoff] = None,
+  processes: bool = False,
+  metrics: Optional[Metrics] = None,
+  name: str = "jobs",
+) -> Iterator[JobResult]:
+  """Execute a list of jobs and yield the results as they complete.
+
+  Unlike `await_pooled_jobs`, results are yielded in completion order, so the
+  caller can report progress and save outputs while the other jobs are running.
+  At most `max_in_flight` jobs (default: `2 * t`) are submitted to the executor
+  at once, and failed jobs are retried according to `backoff`.
+
+  If `processes` is True, the jobs run on a pool of `t` processes instead of
+  threads. Use this for CPU-bound jobs. The job's function and arguments must be
+  picklable (e.g a function defined at the top level of a module).
+
+  The time each job waited and ran, the number of jobs waiting for a worker, and
+  the utilization of the workers are recorded in `metrics` (labelled with `name`).
+  Metrics that the jobs record in worker processes are merged into it as well.
+  """
+  backoff = backoff or Backoff()
+  max_in_flight = max_in_flight or 2 * t
+  metrics = metrics or METRICS
+  jobs = iter(jobs)
+  Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+
+  started_at = time.time()
+  busy = 0.0
+  submitted_at = {}
+
+  with Executor(max_workers=t) as executor:
+    pending = set()
+
+    def submit_next() -> bool:
+      job = next(jobs, None)
+      if job is None:
+        return False
+      future = executor.submit(execute_with_retries, job, backoff, processes)
+      submitted_at[future] = time.time()
+      pending.add(future)
+      return True
+
+    while len(pending) < max_in_flight and submit_next():
+      pass
+
+    try:
+      while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        # Top up the queue before handing control back to the caller.
+        for _ in done:
+          submit_next()
+        metrics.observe("pool_queue_depth", sum(not f.running() for f in pending), DEPTH_BUCKETS, pool=name)
+
+        for future in done:
+          result = future.result()
+          result.submitted_at = submitted_at.pop(future)
+          if result.metrics is not None:
+            metrics.merge(result.metrics)
+            result.metrics = None
+          busy += result.elapsed
+          metrics.observe("pool_queue_seconds", result.queued, pool=name)
+          metrics.observe("pool_job_seconds", result.elapsed, pool=name)
+          metrics.inc("pool_jobs_total", pool=name, status=result.status.value)
+          yield result
+    finally:
+      # The fraction of the time that the workers were busy (including retries).
+      metrics.set("pool_workers", t, pool=name)
+      metrics.set("pool_utilization", busy / (t * max(time.time() - started_at, 1e-9)), pool=name)
+
+
+@dataclass
+class HybridJob:
+  """A job with an I/O phase and a CPU phase (see `stream_hybrid_jobs`).
+
+  `fetch(*args, **kwargs)` runs on a thread, and should only wait on the network or
+  the disk (e.g return the raw bytes of a response). Its value is passed to
+  `parse(value, *args)`, which runs in a worker process, so that decoding and
+  flattening don't hold the GIL while the other threads are downloading. If `then`
+  is given, `then(parsed, *args)` runs on a thread afterwards (e.g a request that
+  needs the parsed value).
+
+  `parse` and the values passed between the phases must be picklable. Pass raw
+  `bytes` to `parse` rather than decoded objects: they're copied to the worker in
+  one piece rather than pickled object by object. Likewise, return a summary from
+  `parse` (e.g write the file there) rather than a large decoded object.
+  """
+  fetch: Callable[..., Any]
+  parse: Callable[..., Any]
+  args: Tuple[Any, ...] = ()
+  kwargs: dict[str, Any] = None
+  then: Optional[Callable[..., Any]] = None
+
+
+def stream_hybrid_jobs(
+  jobs: list[HybridJob],
+  t: int = 8,
+  p: Optional[int] = None,
+  max_in_flight: Optional[int] = None,
+  backoff: Optional[Backoff] = None,
+  metrics: Optional[Metrics] = None,
+  name: str = "jobs",
+) -> Iterator[JobResult]:
+  """Execute a list of `HybridJob`s and yield the results as they complete.
+
+  The I/O phases run on `t` threads and the CPU phases on `p` processes (default:
+  one per CPU), so the threads keep downloading while the processes parse. Only the
+  I/O phases are retried (according to `backoff`). At most `max_in_flight` jobs
+  (default: `2 * (t + p)`) are in progress at once.
+
+  The phases are recorded in `metrics` like the pools of `stream_pooled_jobs`, as
+  `<name>_fetch` and `<name>_parse`. The result of a job has the `args`, the time
+  from the start of its first phase to the end of its last, and the number of
+  attempts of its fetch.
+  """
+  p = p or os.cpu_count()
+  backoff = backoff or Backoff()
+  max_in_flight = max_in_flight or 2 * (t + p)
+  metrics = metrics or METRICS
+  jobs = iter(jobs)
+
+  started_at = time.time()
+  busy = {"fetch": 0.0, "parse": 0.0}
+
+  with ProcessPoolExecutor(max_workers=p) as processes, ThreadPoolExecutor(max_workers=t) as threads:
+    # Start the worker processes now, before there are any threads to fork from.
+    list(processes.map(int, range(p)))
+
+    # Maps each future to (phase, job, the result of the fetch, when it was submitted).
+    pending: dict = {}
+
+    def submit_next() -> bool:
+      job = next(jobs, None)
+      if job is None:
+        return False
+      future = threads.submit(execute_with_retries, Job(job.fetch, job.args, job.kwargs), backoff)
+      pending[future] = ("fetch", job, None, time.time())
+      return True
+
+    while len(pending) < max_in_flight and submit_next():
+      pass
+
+    try:
+      while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        metrics.observe("pool_queue_depth", sum(not f.running() and not f.done() for f in pending), DEPTH_BUCKETS, pool=name)
+
+        for future in done:
+          phase, job, fetched, submitted_at = pending.pop(future)
+          result = future.result()
+          result.submitted_at = submitted_at
+          if result.metrics is not None:
+            metrics.merge(result.metrics)
+            result.metrics = None
+
+          kind = "parse" if phase == "parse" else "fetch"
+          busy[kind] += result.elapsed
+          metrics.observe("pool_queue_seconds", result.queued, pool=f"{name}_{kind}")
+          metrics.observe("pool_job_seconds", result.elapsed, pool=f"{name}_{kind}")
+          metrics.inc("pool_jobs_total", pool=f"{name}_{kind}", status=result.status.value)
+          fetched = fetched or result
+
+          # Move on to the next phase of the job.
+          if result.status == JobStatus.FULFILLED and phase == "fetch":
+            args = (result.value,) + tuple(job.args)
+            pending[processes.submit(execute_with_retries, Job(job.parse, args), Backoff(), True)] = ("parse", job, fetched, time.time())
+            continue
+          if result.status == JobStatus.FULFILLED and phase == "parse" and job.then is not None:
+            args = (result.value,) + tuple(job.args)
+            pending[threads.submit(execute_with_retries, Job(job.then, args), backoff)] = ("then", job, fetched, time.time())
+            continue
+
+          # Top up the queue before handing control back to the caller.
+          submit_next()
+          yield JobResult(
+            status=result.status, value=result.value, reason=result.reason, args=job.args,
+            started_at=fetched.started_at, finished_at=result.finished_at,
+            attempts=fetched.attempts, submitted_at=fetched.submitted_at,
+          )
+    finally:
+      elapsed = max(time.time() - started_at, 1e-9)
+      for kind, workers in (("fetch", t), ("parse", p)):
+        metrics.set("pool_workers", workers, pool=f"{name}_{kind}")
+        metrics.set("pool_utilization", busy[kind] / (workers * elapsed), pool=f"{name}_{kind}")
@@ -0,0 +1,164 @@
+import sys; sys.path.extend([".", "..", "../.."])
+
+import hashlib
+import json
+import os
+import time
+from threading import Lock
+
+from utils.paths import data_folder, make_directory
+
+
+def content_hash(rows: list[dict]) -> str:
+  """Returns a stable hash of a list of result rows."""
+  encoded = json.dumps(rows, sort_keys=True, separators=(",", ":")).encode("utf-8")
+  return hashlib.sha256(encoded).hexdigest()
+
+
+class ContentHasher:
+  """Computes `content_hash` of rows that arrive a page at a time (without holding all of them)."""
+  def __init__(self):
+    self.digest = hashlib.sha256(b"[")
+    self.rows = 0
+
+  def update(self, rows: list[dict]):
+    for row in rows:
+      if self.rows > 0:
+        self.digest.update(b",")
+      self.digest.update(json.dumps(row, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+      self.rows += 1
+
+  def hexdigest(self) -> str:
+    digest = self.digest.copy()
+    digest.update(b"]")
+    return digest.hexdigest()
+
+
+class Manifest:
+  """Keeps track of what we know about each scraped subevent.
+
+  For each subevent ID, the manifest records:
+  - `scraped_at`: when the results were last downloaded (unix time)
+  - `checked_at`: when we last checked the API for changes (unix time)
+  - `total`: the `total` reported by the API
+  - `pages`: the number of pages that were downloaded
+  - `limit`: the page size that was used
+  - `hash`: a hash of all of the results
+  - `first_page_hash`: a hash of the first page of results
+
+  This lets us refresh a subevent by requesting the first page only, and skip
+  the rest of the download if neither `total` nor the first page changed.
+
+  The manifest is shared between threads, so all access goes through a lock.
+  """
+  def __init__(self, path: str = data_folder("im/manifest.json"), autosave: int = 50):
+    self.path = path
+    self.autosave = autosave
+    self._lock = Lock()
+    self._updates = 0
+
+    if os.path.exists(path):
+      with open(path, "r") as file:
+        self.entries: dict[str, dict] = json.load(file)
+    else:
+      self.entries = {}
+
+  def get(self, subevent_id: str) -> dict | None:
+    """Returns the manifest entry for a subevent (if there is one)."""
+    with self._lock:
+      entry = self.entries.get(subevent_id)
+      return dict(entry) if entry is not None else None
+
+  def record(self, subevent_id: str, results: dict, limit: int = 100, scraped_at: float | None = None):
+    """Records the results of a (complete) scrape of a subevent."""
+    self.record_hashes(
+      subevent_id,
+      total=results["total"],
+      hash=content_hash(results["data"]),
+      first_page_hash=content_hash(results["data"][:limit]),
+      limit=limit,
+      scraped_at=scraped_at,
+    )
+
+  def record_hashes(
+    self,
+    subevent_id: str,
+    total: int,
+    hash: str,
+    first_page_hash: str,
+    limit: int = 100,
+    scraped_at: float | None = None,
+  ):
+    """Same as `record`, for results that were hashed as they were streamed to disk (see `ContentHasher`)."""
+    now = time.time()
+    entry = dict(
+      scraped_at=scraped_at or now,
+      checked_at=now,
+      total=total,
+      pages=max(1, -(-total // limit)),
+      limit=limit,
+      hash=hash,
+      first_page_hash=first_page_hash,
+    )
+    self._update(subevent_id, entry)
+
+  def touch(self, subevent_id: str):
+    """Records that we checked a subevent for changes and found none."""
+    with self._lock:
+      self.entries[subevent_id]["checked_at"] = time.time()
+    self._update(subevent_id, None)
+
+  def unchanged(self, subevent_id: str, first: dict, limit: int = 100) -> bool:
+    """Returns True if the first page of results matches what we scraped last time.
+
+    If there is no entry for the subevent, but its results file exists (i.e it was
+    scraped before the manifest existed), the entry is rebuilt from the file.
+    """
+    entry = self.get(subevent_id)
+
+    if entry is None:
+      entry = self.bootstrap(subevent_id, limit=limit)
+
+    if entry is None or entry["limit"] != limit:
+      return False
+
+    return entry["total"] == first["total"] and entry["first_page_hash"] == content_hash(first["data"])
+
+  def bootstrap(self, subevent_id: str, limit: int = 100) -> dict | None:
+    """Creates a manifest entry from an existing results file."""
+    filepath = data_folder(f"im/json/{subevent_id}.json")
+    if not os.path.exists(filepath):
+      return None
+
+    with open(filepath, "r") as file:
+      results = json.load(file)
+
+    if results is None:
+      return None
+
+    self.record(subevent_id, results, limit=limit, scraped_at=os.path.getmtime(filepath))
+    return self.get(subevent_id)
+
+  def save(self):
+    """Writes the manifest to disk.
+
+    We write to a temporary file first so that an interrupted run can't leave a
+    half-written manifest behind.
+    """
+    with self._lock:
+      make_directory(self.path)
+      tmp = self.path + ".tmp"
+      with open(tmp, "w") as file:
+        json.dump(self.entries, file, indent=2, sort_keys=True)
+      os.replace(tmp, self.path)
+      self._updates = 0
+
+  def _update(self, subevent_id: str, entry: dict | None):
+    with self._lock:
+      if entry is not None:
+        self.entries[subevent_id] = entry
+      self._updates += 1
+      should_save = self.autosave and self._updates >= self.autosave
+
+    if should_save:
+      self.save()
@@ -0,0 +1,259 @@
+import sys; sys.path.extend([".", "..", "../.."])
+
+import bisect
+import json
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import Lock
+from typing import Iterator
+
+from utils.paths import data_folder, make_directory
+
+
+# The names of the metrics are prefixed with this in the Prometheus report.
+PREFIX = "etl"
+
+# The upper bounds (in seconds) of the latency buckets.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# The upper bounds of the buckets for the number of queued jobs.
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+# A metric is identified by its name and its (sorted) labels.
+Key = tuple[str, tuple[tuple[str, str], ...]]
+
+
+def metrics_path(script: str) -> str:
+  """Where a script writes the report of its last run (by default)."""
+  return data_folder(f"im/metrics/{script}.json")
+
+
+def make_key(name: str, labels: dict) -> Key:
+  return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def format_number(value: float) -> str:
+  return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Histogram:
+  """Counts observations in buckets (like a Prometheus histogram). The last bucket is +Inf."""
+  def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+    self.buckets = tuple(buckets)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.sum = 0.0
+    self.count = 0
+    self.max = 0.0
+
+  def observe(self, value: float):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+    self.max = max(self.max, value)
+
+  def merge(self, other: "Histogram"):
+    assert self.buckets == other.buckets, "Can't merge histograms with different buckets"
+    self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+    self.sum += other.sum
+    self.count += other.count
+    self.max = max(self.max, other.max)
+
+  def quantile(self, q: float) -> float | None:
+    """Estimates a quantile by interpolating within its bucket (like Prometheus' `histogram_quantile`)."""
+    if self.count == 0:
+      return None
+    rank = q * self.count
+    seen = 0
+    for i, count in enumerate(self.counts):
+      if seen + count >= rank and count > 0:
+        lower = self.buckets[i - 1] if i > 0 else 0.0
+        upper = self.buckets[i] if i < len(self.buckets) else self.max
+        return lower + (upper - lower) * (rank - seen) / count
+      seen += count
+    return self.max
+
+  def to_dict(self) -> dict:
+    return {
+      "count": self.count,
+      "sum": self.sum,
+      "mean": self.sum / self.count if self.count else None,
+      "p50": self.quantile(0.5),
+      "p90": self.quantile(0.9),
+      "p99": self.quantile(0.99),
+      "max": self.max,
+      "buckets": {str(b): c for b, c in zip(list(self.buckets) + ["+Inf"], self.counts)},
+    }
+
+
+@dataclass
+class Request:
+  """Filled in by the caller of `Metrics.request`."""
+  endpoint: str
+  status: int | str | None = None
+  bytes: int = 0
+
+
+class Metrics:
+  """Counters, gauges and histograms for a run of an ETL script. Safe to use from many threads.
+
+  - `request` times a request to an endpoint (and counts its bytes and status)
+  - `stage` times a stage of the work (wall and CPU time of the thread)
+  - `inc`, `set` and `observe` record anything else
+
+  At the end of a run, `write` saves a JSON or Prometheus text report. Metrics that
+  were recorded in other processes can be combined with `drain` and `merge`.
+  """
+  def __init__(self):
+    self._lock = Lock()
+    self.started_at = time.time()
+    self.counters: dict[Key, float] = {}
+    self.gauges: dict[Key, float] = {}
+    self.histograms: dict[Key, Histogram] = {}
+
+  def inc(self, name: str, value: float = 1, **labels):
+    key = make_key(name, labels)
+    with self._lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def set(self, name: str, value: float, **labels):
+    with self._lock:
+      self.gauges[make_key(name, labels)] = value
+
+  def observe(self, name: str, value: float, buckets: tuple[float, ...] = LATENCY_BUCKETS, **labels):
+    key = make_key(name, labels)
+    with self._lock:
+      if key not in self.histograms:
+        self.histograms[key] = Histogram(buckets)
+      self.histograms[key].observe(value)
+
+  @contextmanager
+  def request(self, endpoint: str) -> Iterator[Request]:
+    """Times a request. Set the `status` and `bytes` of the yielded `Request` before the block ends."""
+    request = Request(endpoint)
+    t0 = time.perf_counter()
+    try:
+      yield request
+    except Exception as e:
+      request.status = request.status or type(e).__name__
+      raise
+    finally:
+      self.observe("request_seconds", time.perf_counter() - t0, endpoint=endpoint)
+      self.inc("requests_total", endpoint=endpoint, status=request.status)
+      self.inc("request_bytes_total", request.bytes, endpoint=endpoint)
+
+  @contextmanager
+  def stage(self, name: str) -> Iterator[None]:
+    """Times a stage of the work (e.g "parse" or "rank"), in wall time and in the CPU time of this thread.
+
+    If the wall time is much higher than the CPU time, the stage is waiting (on the
+    network, the disk or another thread) rather than computing.
+    """
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+      yield
+    finally:
+      wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+      self.observe("stage_seconds", wall, stage=name)
+      self.inc("stage_wall_seconds_total", wall, stage=name)
+      self.inc("stage_cpu_seconds_total", cpu, stage=name)
+
+  def drain(self) -> dict:
+    """Returns everything that was recorded (in a form that can be pickled), and resets it."""
+    with self._lock:
+      snapshot = {"counters": self.counters, "gauges": self.gauges, "histograms": self.histograms}
+      self.counters, self.gauges, self.histograms = {}, {}, {}
+    return snapshot
+
+  def merge(self, snapshot: dict):
+    """Adds the metrics from a `drain` (e.g of a worker process) to these."""
+    with self._lock:
+      for key, value in snapshot["counters"].items():
+        self.counters[key] = self.counters.get(key, 0) + value
+      self.gauges.update(snapshot["gauges"])
+      for key, histogram in snapshot["histograms"].items():
+        if key in self.histograms:
+          self.histograms[key].merge(histogram)
+        else:
+          self.histograms[key] = histogram
+
+  def report(self) -> dict:
+    """Returns all of the metrics, grouped by name (and then by their labels)."""
+    def group(items) -> dict:
+      out = {}
+      for (name, labels), value in sorted(items, key=lambda kv: kv[0]):
+        out.setdefault(name, {})[",".join(f"{k}={v}" for k, v in labels)] = value
+      return out
+
+    with self._lock:
+      return {
+        "started_at": self.started_at,
+        "elapsed_sec": time.time() - self.started_at,
+        "counters": group(self.counters.items()),
+        "gauges": group(self.gauges.items()),
+        "histograms": group((k, h.to_dict()) for k, h in self.histograms.items()),
+      }
+
+  def to_prometheus(self) -> str:
+    """Returns the metrics in the Prometheus text format."""
+    def labels(pairs, extra: tuple = ()) -> str:
+      pairs = list(pairs) + list(extra)
+      if not pairs:
+        return ""
+      escaped = [(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs]
+      return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+    lines = []
+    with self._lock:
+      for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+        for name in sorted({name for name, _ in metrics}):
+          lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+          for (n, pairs), value in sorted(metrics.items()):
+            if n == name:
+              lines.append(f"{PREFIX}_{name}{labels(pairs)} {format_number(value)}")
+      for name in sorted({name for name, _ in self.histograms}):
+        lines.append(f"# TYPE {PREFIX}_{name} histogram")
+        for (n, pairs), h in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+          if n != name:
+            continue
+          cumulative = 0
+          for bound, count in zip(list(h.buckets) + ["+Inf"], h.counts):
+            cumulative += count
+            lines.append(f"{PREFIX}_{name}_bucket{labels(pairs, (('le', str(bound)),))} {cumulative}")
+          lines.append(f"{PREFIX}_{name}_sum{labels(pairs)} {format_number(h.sum)}")
+          lines.append(f"{PREFIX}_{name}_count{labels(pairs)} {h.count}")
+    return "\n".join(lines) + "\n"
+
+  def write(self, path: str):
+    """Writes the report to `path` (as Prometheus text if it ends in `.prom`, and as JSON otherwise)."""
+    make_directory(path)
+    with open(path + ".tmp", "w") as f:
+      if path.endswith(".prom"):
+        f.write(self.to_prometheus())
+      else:
+        json.dump(self.report(), f, indent=2)
+    os.replace(path + ".tmp", path)
+
+  def summary(self) -> str:
+    """A few lines that tell where the time went: the requests of each endpoint, and each stage."""
+    report = self.report()
+    lines = []
+    for labels, h in report["histograms"].get("request_seconds", {}).items():
+      nbytes = report["counters"].get("request_bytes_total", {}).get(labels, 0)
+      lines.append(f"{labels:32} {h['count']:>8} requests  p50={h['p50'] * 1000:.0f}ms p99={h['p99'] * 1000:.0f}ms  {nbytes / 1e6:.1f}MB")
+    cpu = report["counters"].get("stage_cpu_seconds_total", {})
+    for labels, wall in report["counters"].get("stage_wall_seconds_total", {}).items():
+      lines.append(f"{labels:32} {wall:>8.1f}s wall  {cpu.get(labels, 0):.1f}s cpu")
+    for labels, value in report["gauges"].get("pool_utilization", {}).items():
+      lines.append(f"{labels:32} {value:>8.0%} utilization")
+    responses = report["counters"].get("ratelimit_responses_total", {})
+    hedges = report["counters"].get("ratelimit_hedges_total", {})
+    for labels, value in report["gauges"].get("ratelimit_concurrency", {}).items():
+      n = sum(responses.get(f"{labels},status={status}", 0) for status in (429, 503))
+      lines.append(f"{labels:32} {value:>8.1f} concurrency  {n:.0f} throttled  {hedges.get(labels, 0):.0f} hedged")
+    return "\n".join(lines)
+
+
+# The metrics of the current run, which the ETL scripts record to.
+METRICS = Metrics()
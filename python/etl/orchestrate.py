@@ -0,0 +1,450 @@
+import sys; sys.path.extend([".", "..", "../.."])
+
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from typing import Any, Callable, Iterable
+
+import pandas as pd
+
+from utils.paths import data_folder, make_directory, tasks_folder
+import http_cache
+from job import Backoff, Job, JobStatus, execute_with_retries
+from metrics import DEPTH_BUCKETS, METRICS, Metrics, metrics_path
+
+
+# Bump this if the format of the checkpoint changes (an old checkpoint is ignored).
+CHECKPOINT_VERSION = 1
+
+STAGES = ["discover", "download", "convert", "publish"]
+
+# Each stage passes its items on to the running stages of the next level (e.g both `convert` and `publish` take the downloads).
+LEVELS = [["discover"], ["download"], ["convert", "publish"]]
+
+# Put in a stage's queue once everything upstream of it has finished.
+DONE = object()
+
+
+class Stopped(Exception):
+  """Raised in a worker when the pipeline is stopped (e.g by Ctrl-C)."""
+
+
+class Checkpoint:
+  """Records which items each stage has finished, so that an interrupted run can resume.
+
+  For each stage, the checkpoint maps the key of each finished item (a race name or
+  a subevent ID) to the items that it passed on to the next stages. When the run is
+  resumed, finished items are passed on again without redoing the work.
+
+  Like the manifest, it's shared between threads, saved every `autosave` updates,
+  and written through a temporary file.
+  """
+  def __init__(self, path: str = data_folder("im/orchestrate.json"), autosave: int = 50):
+    self.path = path
+    self.autosave = autosave
+    self._lock = Lock()
+    self._updates = 0
+
+    self.stages: dict[str, dict[str, list[dict]]] = {}
+    if os.path.exists(path):
+      with open(path, "r") as file:
+        saved = json.load(file)
+      if saved.get("v") == CHECKPOINT_VERSION:
+        self.stages = saved["stages"]
+
+  def get(self, stage: str, key: str) -> list[dict] | None:
+    """Returns the outputs of an item that the stage already finished (or None)."""
+    with self._lock:
+      return self.stages.get(stage, {}).get(key)
+
+  def record(self, stage: str, key: str, outputs: list[dict]):
+    with self._lock:
+      self.stages.setdefault(stage, {})[key] = outputs
+      self._updates += 1
+      should_save = self.autosave and self._updates >= self.autosave
+    if should_save:
+      self.save()
+
+  def finished(self) -> dict[str, int]:
+    with self._lock:
+      return {stage: len(items) for stage, items in self.stages.items()}
+
+  def save(self):
+    with self._lock:
+      make_directory(self.path)
+      with open(self.path + ".tmp", "w") as file:
+        json.dump({"v": CHECKPOINT_VERSION, "stages": self.stages}, file, sort_keys=True)
+      os.replace(self.path + ".tmp", self.path)
+      self._updates = 0
+
+  def clear(self):
+    """Deletes the checkpoint (once a run finishes everything, the next run starts over)."""
+    with self._lock:
+      self.stages = {}
+      if os.path.exists(self.path):
+        os.remove(self.path)
+
+
+@dataclass
+class Stage:
+  """A step of the pipeline, run on its own pool of `workers` threads.
+
+  `func(item)` does the work for one item, and returns the items to pass on to the
+  `downstream` stages. Items wait in a queue of at most `queue_size`, so a slow
+  stage holds back the stages before it rather than piling up work in memory.
+  """
+  name: str
+  func: Callable[[dict], list[dict]]
+  workers: int = 4
+  downstream: list[str] = field(default_factory=list)
+  queue_size: int = 64
+  key: str = "subevent_id"
+
+
+class Pipeline:
+  """Runs linked stages concurrently, so each item moves on as soon as a stage is done with it.
+
+  CPU-bound work can be sent to a pool of `p` processes with `run_in_process`. The
+  time each item took, the depth of each queue and the utilization of each stage are
+  recorded in `metrics` (labelled with the stage name, like the pools of `job.py`).
+  """
+  def __init__(
+    self,
+    stages: list[Stage],
+    checkpoint: Checkpoint,
+    backoff: Backoff | None = None,
+    p: int = 0,
+    metrics: Metrics | None = None,
+  ):
+    self.stages = {stage.name: stage for stage in stages}
+    self.queues = {stage.name: Queue(maxsize=stage.queue_size) for stage in stages}
+    self.checkpoint = checkpoint
+    self.backoff = backoff or Backoff()
+    self.metrics = metrics or METRICS
+    self.stopped = Event()
+    self.error: BaseException | None = None
+    self._lock = Lock()
+
+    # The number of stages (or sources) that still feed each stage, and the live workers of each stage.
+    self.upstream = {name: 0 for name in self.stages}
+    for stage in stages:
+      for name in stage.downstream:
+        self.upstream[name] += 1
+    self.live = {name: 0 for name in self.stages}
+    self.busy = {name: 0.0 for name in self.stages}
+    self.counts = {name: {"done": 0, "resumed": 0, "failed": 0} for name in self.stages}
+
+    self.pool = ProcessPoolExecutor(max_workers=p) if p > 0 else None
+    if self.pool is not None:
+      # Start the worker processes now, before there are any threads to fork from.
+      list(self.pool.map(int, range(p)))
+
+  def run_in_process(self, func: Callable, *args, **kwargs) -> Any:
+    """Runs `func` in the process pool (or in this thread if there isn't one), and merges the metrics it recorded."""
+    if self.pool is None:
+      return func(*args, **kwargs)
+    result = self.pool.submit(execute_with_retries, Job(func, args, kwargs), Backoff(), True).result()
+    self.metrics.merge(result.metrics)
+    if result.status != JobStatus.FULFILLED:
+      raise result.reason
+    return result.value
+
+  def put(self, name: str, item: Any):
+    """Adds an item to a stage's queue, waiting while it's full (unless the pipeline is stopped)."""
+    while True:
+      if self.stopped.is_set():
+        raise Stopped()
+      try:
+        self.queues[name].put(item, timeout=0.1)
+        return
+      except Full:
+        pass
+
+  def get(self, name: str) -> Any:
+    while True:
+      if self.stopped.is_set():
+        raise Stopped()
+      try:
+        return self.queues[name].get(timeout=0.1)
+      except Empty:
+        pass
+
+  def close(self, name: str):
+    """Called when a stage (or source) that feeds `name` has finished."""
+    with self._lock:
+      self.upstream[name] -= 1
+      last = self.upstream[name] == 0
+    if last:
+      self.put(name, DONE)
+
+  def work(self, stage: Stage):
+    """The loop of each worker thread of a stage."""
+    try:
+      while True:
+        item = self.get(stage.name)
+        if item is DONE:
+          # Let the other workers of this stage see it too.
+          self.put(stage.name, DONE)
+          break
+        self.metrics.observe("pool_queue_depth", self.queues[stage.name].qsize(), DEPTH_BUCKETS, pool=stage.name)
+
+        key = str(item[stage.key])
+        outputs = self.checkpoint.get(stage.name, key)
+        if outputs is not None:
+          status = "resumed"
+        else:
+          result = execute_with_retries(Job(stage.func, (item,)), self.backoff)
+          with self._lock:
+            self.busy[stage.name] += result.elapsed
+          self.metrics.observe("pool_job_seconds", result.elapsed, pool=stage.name)
+          if result.status == JobStatus.FULFILLED:
+            status, outputs = "done", list(result.value or [])
+            self.checkpoint.record(stage.name, key, outputs)
+          else:
+            status, outputs = "failed", []
+            print(f"[{stage.name}] {key} failed after {result.attempts} attempts with exception: {result.reason}.")
+
+        self.metrics.inc("pool_jobs_total", pool=stage.name, status=status)
+        with self._lock:
+          self.counts[stage.name][status] += 1
+
+        for name in stage.downstream:
+          for output in outputs:
+            self.put(name, output)
+    except Stopped:
+      return
+    except BaseException as e:
+      # Something went wrong outside of a job (e.g printing to a closed pipe), so stop the whole run.
+      self.error = e
+      self.stopped.set()
+      raise
+
+    with self._lock:
+      self.live[stage.name] -= 1
+      last = self.live[stage.name] == 0
+    if last:
+      for name in stage.downstream:
+        self.close(name)
+
+  def run(self, items: Iterable[dict], first: list[str]) -> dict[str, dict[str, int]]:
+    """Feeds `items` to the `first` stages, and waits until every stage has finished.
+
+    Returns the number of items each stage did, resumed (from the checkpoint) and failed.
+    """
+    for name in first:
+      self.upstream[name] += 1
+
+    started_at = time.time()
+    threads = []
+    for stage in self.stages.values():
+      self.live[stage.name] = stage.workers
+      for i in range(stage.workers):
+        threads.append(Thread(target=self.work, args=(stage,), name=f"{stage.name}-{i}", daemon=True))
+    for thread in threads:
+      thread.start()
+
+    try:
+      for item in items:
+        for name in first:
+          self.put(name, item)
+      for name in first:
+        self.close(name)
+      # Join with a timeout, so that Ctrl-C still reaches the main thread.
+      for thread in threads:
+        while thread.is_alive():
+          thread.join(timeout=0.5)
+    finally:
+      self.stopped.set()
+      elapsed = max(time.time() - started_at, 1e-9)
+      for stage in self.stages.values():
+        self.metrics.set("pool_workers", stage.workers, pool=stage.name)
+        self.metrics.set("pool_utilization", self.busy[stage.name] / (stage.workers * elapsed), pool=stage.name)
+      if self.pool is not None:
+        self.pool.shutdown(cancel_futures=True)
+
+    if self.error is not None:
+      raise RuntimeError(f"A worker of the pipeline failed: {self.error!r}") from self.error
+    return self.counts
+
+
+def links(stages: list[str]) -> tuple[list[str], dict[str, list[str]]]:
+  """Returns the stages that take the input items, and the stages downstream of each stage (skipping the ones that aren't running)."""
+  levels = [[s for s in level if s in stages] for level in LEVELS]
+  levels = [level for level in levels if level]
+  downstream = {s: levels[i + 1] if i + 1 < len(levels) else [] for i, level in enumerate(levels) for s in level}
+  return levels[0], downstream
+
+
+def read_records(path: str) -> list[dict]:
+  """Reads the rows of a CSV file as dicts (of plain Python values, so that they can be checkpointed)."""
+  return json.loads(pd.read_csv(path).to_json(orient="records"))
+
+
+def has_results(path: str) -> bool:
+  """Returns True if a scraped file has results (older scrapes saved `null` when a request failed)."""
+  with open(path, "rb") as f:
+    return f.read(4) != b"null"
+
+
+def main():
+  """Refresh the Ironman data end to end: discover subevents, download, convert and publish them as they arrive."""
+  from argparse import ArgumentParser
+  parser = ArgumentParser(description="Refresh the Ironman data end to end: discover subevents, download, convert and publish them as they arrive.")
+  parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES,
+                      help="The stages to run. Without `discover`, the subevents in subevents.csv are used")
+  parser.add_argument("--update-races", action="store_true", help="Update races.csv (like `scrape_im_races.py`) before starting")
+  parser.add_argument("--discover-t", type=int, default=2, help="The number of races to crawl at once")
+  parser.add_argument("--tab-t", type=int, default=8, help="The number of threads to use for the tabs of each race")
+  parser.add_argument("--download-t", type=int, default=4, help="The number of subevents to download at once")
+  parser.add_argument("--p", type=int, default=os.cpu_count(), help="The number of processes to convert and publish with")
+  parser.add_argument("--queue-size", type=int, default=64, help="The most items that can wait for each stage")
+  parser.add_argument("--retries", type=int, default=2, help="How many times to retry a failed item (with exponential backoff)")
+  parser.add_argument("--refresh", action="store_true",
+                      help="Also check the subevents that have already been scraped, and re-download the ones that changed")
+  parser.add_argument("--index", help="Where to put the index file (for `publish`)", type=str, default=None)
+  parser.add_argument("--data", help="Where to put the data files (for `publish`)", type=str, default=None)
+  parser.add_argument("--format", choices=["rows", "columnar"], default="rows", help="The format to publish")
+  parser.add_argument("--aggregates", help="Where to put the precomputed histograms and quantiles for the charts", type=str, default=None)
+  parser.add_argument("--checkpoint", type=str, default=data_folder("im/orchestrate.json"),
+                      help="Where to keep track of the finished items, so that an interrupted run can resume")
+  parser.add_argument("--fresh", action="store_true", help="Ignore the checkpoint of an interrupted run")
+  parser.add_argument("--cache", choices=http_cache.MODES, default="on", help="How to use the HTTP cache (see `http_cache.py`)")
+  parser.add_argument("--metrics", type=str, default=metrics_path("orchestrate"),
+                      help="Where to write the metrics of the run (Prometheus text if it ends in .prom, JSON otherwise)")
+  args = parser.parse_args()
+
+  # These need the API key, so they're imported once the arguments are parsed.
+  import create_im_csv
+  import publish
+  import scrape_im_races
+  import scrape_im_results
+  import scrape_im_subevents
+  from manifest import Manifest
+
+  stages = [s for s in STAGES if s in args.stages]
+  if "publish" in stages and args.data is None:
+    print("Note: --data isn't set, so the subevents won't be published.")
+    stages.remove("publish")
+
+  if args.update_races:
+    scrape_im_races.update_from_google_sheets()
+    scrape_im_races.update_from_discountinued()
+
+  checkpoint = Checkpoint(args.checkpoint)
+  if args.fresh:
+    checkpoint.clear()
+  elif checkpoint.stages:
+    print(f"Resuming from {args.checkpoint}: {checkpoint.finished()}")
+
+  os.makedirs(data_folder("im/json"), exist_ok=True)
+  os.makedirs(data_folder("im/csv"), exist_ok=True)
+
+  cache = http_cache.configure(mode=args.cache)
+  manifest = Manifest()
+  writer = scrape_im_subevents.SubeventWriter()
+  writer_lock = Lock()
+
+  def discover(race: dict) -> list[dict]:
+    rows = scrape_im_subevents.pipeline(race, t=args.tab_t)
+    with writer_lock:
+      writer.add(rows)
+    return rows
+
+  def download(row: dict) -> list[dict]:
+    subevent_id = row["subevent_id"]
+    path = data_folder(f"im/json/{subevent_id}.json")
+    if not os.path.exists(path):
+      # The pages are streamed to disk, so a retry (or the next run) picks up from the last one.
+      scrape_im_results.pipeline(subevent_id, manifest)
+    elif args.refresh:
+      scrape_im_results.refresh_pipeline(subevent_id, manifest)
+    return [row] if has_results(path) else []
+
+  def convert(row: dict) -> list[dict]:
+    path = data_folder(f"im/json/{row['subevent_id']}.json")
+    csv = path.replace("json", "csv")
+    # Only convert the results that changed since they were last converted.
+    if not os.path.exists(csv) or os.path.getmtime(csv) < os.path.getmtime(path):
+      pipeline.run_in_process(create_im_csv.convert, path)
+    return []
+
+  version = publish.code_version(args.format, with_aggregates=args.aggregates is not None)
+  hashes = publish.load_json(args.data, publish.HASHES_FILENAME) if args.data else {}
+  published = publish.load_json(args.data, publish.MANIFEST_FILENAME) if args.data else {}
+  publish_lock = Lock()
+  if args.data:
+    os.makedirs(args.data, exist_ok=True)
+  if args.aggregates:
+    os.makedirs(args.aggregates, exist_ok=True)
+
+  def publish_one(row: dict) -> list[dict]:
+    name = f"{publish.get_race_name(row['results_url'])}-{row['year']}"
+    path = os.path.join(args.data, f"{name}.json")
+    aggregates_path = os.path.join(args.aggregates, f"{name}.json") if args.aggregates else None
+    h = publish.input_hash(row["subevent_id"], version)
+    with publish_lock:
+      unchanged = publish.up_to_date(name, h, hashes, published, publish.output_paths(path, args.format, aggregates_path))
+    if unchanged:
+      return []
+    value = pipeline.run_in_process(publish.publish_subevent, row["subevent_id"], path,
+                                    format=args.format, aggregates_path=aggregates_path)
+    with publish_lock:
+      if value is not None:
+        published[name] = value
+      else:
+        published.pop(name, None)
+      hashes[name] = h
+    print(f"Published {name}")
+    return []
+
+  funcs = {"discover": discover, "download": download, "convert": convert, "publish": publish_one}
+  workers = {"discover": args.discover_t, "download": args.download_t, "convert": args.p, "publish": args.p}
+  first, downstream = links(stages)
+
+  pipeline = Pipeline(
+    [Stage(name, funcs[name], workers[name], downstream[name], args.queue_size, "name" if name == "discover" else "subevent_id")
+     for name in stages],
+    checkpoint,
+    backoff=Backoff(retries=args.retries),
+    p=args.p if {"convert", "publish"} & set(stages) else 0,
+  )
+
+  # Without `discover`, the subevents that were found before are used.
+  items = read_records(tasks_folder("im/races.csv" if "discover" in stages else "im/subevents.csv"))
+
+  print(f"Running {' -> '.join(stages)} for {len(items)} {'races' if 'discover' in stages else 'subevents'}.")
+
+  counts = None
+  try:
+    counts = pipeline.run(items, first)
+  finally:
+    # Save whatever we finished, even if the run is interrupted.
+    with writer_lock:
+      writer.flush()
+    manifest.save()
+    cache.save()
+    if args.data:
+      publish.save_json(args.data, publish.HASHES_FILENAME, hashes)
+      publish.save_json(args.data, publish.MANIFEST_FILENAME, published)
+    if counts is not None and not any(c["failed"] for c in counts.values()):
+      checkpoint.clear()
+    else:
+      checkpoint.save()
+    METRICS.write(args.metrics)
+    print(METRICS.summary())
+
+  if args.index:
+    publish.write_index(args.index, publish.race_entries(publish.subevents_frame(), publish.Catalog()))
+
+  for name, c in counts.items():
+    print(f"{name:10} {c['done']:>6} done  {c['resumed']:>6} resumed  {c['failed']:>6} failed")
+
+  print("DONE")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,334 @@
+import sys; sys.path.extend([".", "..", "../.."])
+
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from utils.paths import data_folder, tasks_folder
+from utils.store import list_subevents, store_folder
+from ranking import SPLITS
+from publish import get_race_name
+
+
+# Bump this if the layout of the index changes, so that it gets rebuilt.
+INDEX_VERSION = 2
+
+MANIFEST_FILENAME = "index.json"
+
+# The splits that are ranked (see `ranking.SPLITS`).
+SPLIT_COLUMNS = [f"{split}Time" for split in SPLITS]
+
+# The groups that every subevent has (the age groups are added as they're found).
+# These match the options in the app (see `aggregates.py`).
+OVERALL_GROUPS = ["overall", "m-overall", "f-overall"]
+
+
+def percentiles_folder(relative_path: str = "") -> str:
+  """Returns a path relative to the folder of the percentile index."""
+  return data_folder(os.path.join("im/percentiles", relative_path))
+
+
+def sorted_runs(df: pd.DataFrame) -> dict[tuple[str, str], np.ndarray]:
+  """Returns the sorted times of each (split, group) of a subevent.
+
+  These are the times that `ranking.rank_matrix` ranks: every positive time, whatever
+  the status of the athlete. Everyone is in "overall", and the athletes with an age
+  group are also in it and in their gender ("m-overall" for "M30-34").
+  """
+  age_group = df.AgeGroup.astype(object).where(df.AgeGroup.notna(), None).to_numpy()
+  has_age_group = age_group != None # noqa: E711 (elementwise)
+  gender = np.array([f"{ag[0].lower()}-overall" if ag else None for ag in age_group], dtype=object)
+
+  runs = {}
+  for split in SPLIT_COLUMNS:
+    values = pd.to_numeric(df[split], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    valid = values > 0
+    runs[(split, "overall")] = np.sort(values[valid]).astype(np.int32)
+    for labels in (gender, age_group):
+      mask = valid & has_age_group
+      codes, uniques = pd.factorize(labels[mask])
+      # Sort by (group, time) once, so each group is a contiguous run.
+      order = np.lexsort((values[mask], codes))
+      v, c = values[mask][order].astype(np.int32), codes[order]
+      bounds = np.searchsorted(c, np.arange(len(uniques) + 1))
+      for i, group in enumerate(uniques):
+        runs[(split, group)] = v[bounds[i]:bounds[i + 1]]
+  return runs
+
+
+def count_less(values: np.ndarray, lo: np.ndarray, hi: np.ndarray, t: np.ndarray, inclusive: bool = False) -> np.ndarray:
+  """Counts the values in each sorted run `values[lo[i]:hi[i]]` that are less than `t[i]` (or equal, if `inclusive`).
+
+  This is a binary search over a whole batch of runs at once, so it takes about
+  log2(longest run) vectorized steps, whatever the size of the batch.
+  """
+  start, lo, hi = lo, lo.copy(), hi.copy()
+  if len(values) == 0:
+    return np.zeros_like(lo)
+  while True:
+    active = lo < hi
+    if not active.any():
+      return lo - start
+    mid = (lo + hi) // 2
+    v = values[np.where(active, mid, 0)]
+    less = (v <= t) if inclusive else (v < t)
+    lo = np.where(active & less, mid + 1, lo)
+    hi = np.where(active & ~less, mid, hi)
+
+
+class PercentileIndex:
+  """Sorted split times for each subevent x split x group, to tell where a time would place.
+
+  All of the runs are in one (memory-mapped) array, with each subevent's runs
+  next to each other. `run_of[subevent, split, group]` is the run of each
+  combination (-1 if there's no one in it), and `runs[run]` is its [start, end).
+
+  `update` rebuilds the runs of the subevents that are new or changed, and copies
+  the rest from the previous version of the index. Each version's arrays are
+  written to their own folder (`build-<n>`), which the manifest points to, so
+  the manifest and the arrays are swapped in together.
+  """
+  def __init__(self, folder: str = percentiles_folder()):
+    self.folder = folder
+    path = os.path.join(folder, MANIFEST_FILENAME)
+    manifest = {}
+    if os.path.exists(path):
+      with open(path, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("v") != INDEX_VERSION:
+      manifest = {"v": INDEX_VERSION, "subevents": {}, "groups": list(OVERALL_GROUPS), "build": None, "built_at": None}
+    self.manifest = manifest
+    self._open()
+
+  def _open(self):
+    self.subevent_ids = sorted(self.manifest["subevents"], key=lambda s: self.manifest["subevents"][s]["code"])
+    self.codes = {s: e["code"] for s, e in self.manifest["subevents"].items()}
+    self.groups = {g: i for i, g in enumerate(self.manifest["groups"])}
+    self.splits = {s: i for i, s in enumerate(SPLIT_COLUMNS)}
+
+    if self.subevent_ids:
+      folder = self.build_folder(self.manifest["build"])
+      self.values = np.asarray(np.load(os.path.join(folder, "values.npy"), mmap_mode="r"))
+      self.runs = np.load(os.path.join(folder, "runs.npy"))
+      self.run_of = np.load(os.path.join(folder, "run_of.npy"))
+    else:
+      self.values = np.empty(0, dtype=np.int32)
+      self.runs = np.empty((0, 2), dtype=np.int64)
+      self.run_of = np.empty((0, len(SPLIT_COLUMNS), len(self.groups)), dtype=np.int32)
+
+  def build_folder(self, build: int) -> str:
+    return os.path.join(self.folder, f"build-{build:06d}")
+
+  @property
+  def version(self) -> str:
+    """Changes whenever the index is rebuilt."""
+    return str(self.manifest["built_at"])
+
+  def fresh(self, subevent_id: str, path: str) -> bool:
+    """Returns True if a subevent is in the index, and its file hasn't changed since."""
+    entry = self.manifest["subevents"].get(subevent_id)
+    stat = os.stat(path)
+    return entry is not None and entry["source"] == {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+  def update(self, paths: dict[str, str] | None = None, force: bool = False) -> int:
+    """Rebuilds the runs of the subevents that are new or changed (or all of them, if `force`).
+
+    `paths` maps the ID of every subevent in the store to its file (the whole results
+    store by default). Returns the number of subevents that were (re)built.
+    """
+    paths = list_subevents() if paths is None else paths
+    groups = list(self.manifest["groups"])
+    group_codes = {g: i for i, g in enumerate(groups)}
+
+    # Each block is (flat values, {(split, group): (start, end) within the block}).
+    blocks, sources, built = {}, {}, 0
+    for subevent_id in sorted(paths):
+      stat = os.stat(paths[subevent_id])
+      sources[subevent_id] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+      if not force and self.fresh(subevent_id, paths[subevent_id]):
+        code = self.codes[subevent_id]
+        entry = self.manifest["subevents"][subevent_id]
+        offset = entry["block"][0]
+        spans = {}
+        for (s, g) in zip(*np.nonzero(self.run_of[code] >= 0)):
+          start, end = self.runs[self.run_of[code, s, g]]
+          spans[(SPLIT_COLUMNS[s], self.manifest["groups"][g])] = (start - offset, end - offset)
+        blocks[subevent_id] = (np.array(self.values[entry["block"][0]:entry["block"][1]]), spans)
+        continue
+
+      df = pq.read_table(paths[subevent_id], columns=["AgeGroup"] + SPLIT_COLUMNS).to_pandas()
+      runs = sorted_runs(df)
+      spans, position = {}, 0
+      for key, v in runs.items():
+        spans[key] = (position, position + len(v))
+        position += len(v)
+        if key[1] not in group_codes:
+          group_codes[key[1]] = len(groups)
+          groups.append(key[1])
+      blocks[subevent_id] = (np.concatenate(list(runs.values())) if runs else np.empty(0, dtype=np.int32), spans)
+      built += 1
+
+    # Lay the blocks out one after the other.
+    subevents, values, runs = {}, [], []
+    run_of = np.full((len(blocks), len(SPLIT_COLUMNS), len(groups)), -1, dtype=np.int32)
+    position = 0
+    for code, (subevent_id, (v, spans)) in enumerate(blocks.items()):
+      for (split, group), (start, end) in spans.items():
+        run_of[code, self.splits[split], group_codes[group]] = len(runs)
+        runs.append((position + start, position + end))
+      subevents[subevent_id] = {"code": code, "source": sources[subevent_id], "block": [position, position + len(v)]}
+      values.append(v)
+      position += len(v)
+
+    arrays = {
+      "values": np.concatenate(values).astype(np.int32) if values else np.empty(0, dtype=np.int32),
+      "runs": np.array(runs, dtype=np.int64).reshape(-1, 2),
+      "run_of": run_of,
+    }
+
+    # Write the arrays to a new folder, and only point the manifest at it once they're all there.
+    previous = self.manifest["build"]
+    build = 0 if previous is None else previous + 1
+    folder = self.build_folder(build)
+    os.makedirs(folder, exist_ok=True)
+    for name, array in arrays.items():
+      np.save(os.path.join(folder, f"{name}.npy"), array)
+
+    self.manifest = {"v": INDEX_VERSION, "subevents": subevents, "groups": groups, "build": build,
+                     "built_at": pd.Timestamp.now().isoformat()}
+    path = os.path.join(self.folder, MANIFEST_FILENAME)
+    with open(path + ".tmp", "w") as f:
+      json.dump(self.manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+    self._open()
+    # Remove the previous version once the manifest doesn't point to it anymore.
+    if previous is not None:
+      shutil.rmtree(self.build_folder(previous), ignore_errors=True)
+    return built
+
+  def run_ids(self, subevent_ids, splits, groups) -> np.ndarray:
+    """Returns the run of each (subevent, split, group), or -1 if it's empty or unknown."""
+    subevent_ids, splits, groups = np.broadcast_arrays(np.asarray(subevent_ids, dtype=object), np.asarray(splits, dtype=object), np.asarray(groups, dtype=object))
+    codes = np.array([self.codes.get(s, -1) for s in subevent_ids.ravel()], dtype=np.int64)
+    split_codes = np.array([self.splits.get(s, -1) for s in splits.ravel()], dtype=np.int64)
+    group_codes = np.array([self.groups.get(g, -1) for g in groups.ravel()], dtype=np.int64)
+    known = (codes >= 0) & (split_codes >= 0) & (group_codes >= 0)
+    runs = np.full(len(codes), -1, dtype=np.int64)
+    runs[known] = self.run_of[codes[known], split_codes[known], group_codes[known]]
+    return runs
+
+  def counts(self, runs: np.ndarray, times: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the number of times in each run that are faster, faster or tied, and in total."""
+    times = np.asarray(times, dtype=np.float64)
+    exists = runs >= 0
+    lo = np.where(exists, self.runs[np.maximum(runs, 0), 0], 0) if len(self.runs) else np.zeros(len(runs), dtype=np.int64)
+    hi = np.where(exists, self.runs[np.maximum(runs, 0), 1], 0) if len(self.runs) else np.zeros(len(runs), dtype=np.int64)
+    faster = count_less(self.values, lo, hi, times)
+    faster_or_tied = count_less(self.values, lo, hi, times, inclusive=True)
+    return faster, faster_or_tied, hi - lo
+
+  def lookup(self, subevent_ids, splits, groups, times) -> pd.DataFrame:
+    """Tells where each time would place in its (subevent, split, group). The arguments broadcast.
+
+    Returns a dataframe with one row per query:
+    - `rank`: 1 + the number of faster times (the same "min" rank as `ranking.rank_matrix`)
+    - `percentile`: the percentage of the group that was slower
+    - `n`: the number of times in the group (0 if the subevent or group is unknown)
+    """
+    subevent_ids, splits, groups, times = np.broadcast_arrays(
+      np.asarray(subevent_ids, dtype=object), np.asarray(splits, dtype=object), np.asarray(groups, dtype=object), np.asarray(times, dtype=np.float64))
+    runs = self.run_ids(subevent_ids, splits, groups)
+    faster, faster_or_tied, n = self.counts(runs, times.ravel())
+    return self._frame(faster, faster_or_tied, n)
+
+  def lookup_pooled(self, subevent_ids: list[list[str]], splits, groups, times) -> pd.DataFrame:
+    """Like `lookup`, but each query is compared with several subevents at once (e.g every year of a race).
+
+    `subevent_ids[i]` lists the subevents of query `i`. The times of every subevent
+    are counted together, as if they were one race.
+    """
+    lengths = np.array([len(ids) for ids in subevent_ids], dtype=np.int64)
+    query = np.repeat(np.arange(len(subevent_ids)), lengths)
+    flat = [s for ids in subevent_ids for s in ids]
+    splits, groups, times = (np.broadcast_to(np.asarray(a, dtype=dtype), (len(subevent_ids),))[query]
+                             for a, dtype in ((splits, object), (groups, object), (times, np.float64)))
+
+    faster, faster_or_tied, n = self.counts(self.run_ids(flat, splits, groups), times)
+    total = lambda x: np.bincount(query, weights=x, minlength=len(subevent_ids)).astype(np.int64)
+    return self._frame(total(faster), total(faster_or_tied), total(n))
+
+  @staticmethod
+  def _frame(faster: np.ndarray, faster_or_tied: np.ndarray, n: np.ndarray) -> pd.DataFrame:
+    with np.errstate(invalid="ignore", divide="ignore"):
+      percentile = np.where(n > 0, np.round(100 * (n - faster_or_tied) / n, 2), np.nan)
+    return pd.DataFrame({"rank": faster + 1, "percentile": percentile, "n": n})
+
+
+def race_years(subevents_csv: str = tasks_folder("im/subevents.csv")) -> pd.DataFrame:
+  """Returns the race (e.g "im703-boulder"), year and subevent ID of each row of `subevents.csv`."""
+  df = pd.read_csv(subevents_csv).drop_duplicates(subset=["subevent_id"])
+  return pd.DataFrame({"race": df.results_url.map(get_race_name), "year": df.year.astype(int), "subevent_id": df.subevent_id})
+
+
+class RacePercentiles:
+  """Answers (race, year, group, split, time) queries with a `PercentileIndex`.
+
+  If the year of a query is missing, the times of every year of the race are pooled.
+  If there are two subevents with the same race and year, the last one is used (like
+  in `publish.py`).
+  """
+  def __init__(self, index: PercentileIndex, races: pd.DataFrame | None = None):
+    self.index = index
+    races = race_years() if races is None else races
+    latest = races.drop_duplicates(subset=["race", "year"], keep="last")
+    self.by_year = {(race, int(year)): [s] for race, year, s in zip(latest.race, latest.year, latest.subevent_id)}
+    self.by_race = latest.groupby("race").subevent_id.agg(list).to_dict()
+
+  def subevents(self, race: str, year: float | None) -> list[str]:
+    """Returns the subevents that a query is compared with (none if the race or year is unknown)."""
+    if year is None or year != year: # missing or NaN
+      return self.by_race.get(race, [])
+    return self.by_year.get((race, int(year)), [])
+
+  def lookup(self, races, years, groups, splits, times) -> pd.DataFrame:
+    """Returns the `rank`, `percentile` and `n` of each query (see `PercentileIndex.lookup`). The arguments broadcast."""
+    races, years, groups, splits, times = np.broadcast_arrays(
+      np.asarray(races, dtype=object), np.asarray(years, dtype=object), np.asarray(groups, dtype=object),
+      np.asarray(splits, dtype=object), np.asarray(times, dtype=np.float64))
+    ids = [self.subevents(race, year) for race, year in zip(races.ravel(), years.ravel())]
+    return self.index.lookup_pooled(ids, splits.ravel(), groups.ravel(), times.ravel())
+
+  def query(self, queries: pd.DataFrame) -> pd.DataFrame:
+    """Answers a batch of queries with the columns `race`, `year`, `group`, `split` and `time`.
+
+    Returns the queries, with the `rank`, `percentile` and `n` columns added.
+    """
+    result = self.lookup(queries.race.to_numpy(), queries.year.to_numpy(), queries.group.to_numpy(),
+                         queries.split.to_numpy(), queries.time.to_numpy())
+    return pd.concat([queries, result.set_index(queries.index)], axis=1)
+
+
+def main():
+  """Build (or update) the percentile index of the results store."""
+  parser = argparse.ArgumentParser(description="Build (or update) the percentile index of the results store.")
+  parser.add_argument("--store", type=str, default=store_folder(), help="The folder of the results store")
+  parser.add_argument("--out", type=str, default=percentiles_folder(), help="Where to put the index")
+  parser.add_argument("--force", action="store_true", help="Rebuild every subevent, even if it hasn't changed")
+  args = parser.parse_args()
+
+  index = PercentileIndex(args.out)
+  built = index.update(list_subevents(args.store), force=args.force)
+
+  print(f"Built {built} of {len(index.subevent_ids)} subevents ({len(index.runs)} runs, {len(index.values)} times).")
+  print("DONE")
+
+
+if __name__ == "__main__":
+  main()
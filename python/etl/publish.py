@@ -1,6 +1,7 @@
 import sys; sys.path.extend([".", "..", "../.."])
 
 import argparse
+import hashlib
 import json
 import os
 from enum import Enum
@@ -8,6 +9,26 @@ import pandas as pd
 from pydantic import BaseModel
 
 from utils.paths import tasks_folder, data_folder
+from job import Job, JobStatus, stream_pooled_jobs
+from metrics import METRICS, metrics_path
+import aggregates
+from catalog import Catalog, summarize
+import compact
+import ranking
+from ranking import rank_frame
+
+
+# Bump this if the format of the published files changes (without the ranking code changing).
+PUBLISH_VERSION = "1"
+
+# Keeps track of the hash of the inputs of each published file (see `input_hash`).
+HASHES_FILENAME = ".hashes.json"
+
+# Lists the size and hash of each published file.
+MANIFEST_FILENAME = "manifest.json"
+
+# The app reads the row files, so the columnar files are written next to them (rather than in their place).
+COLUMNAR_SUFFIX = ".cols.json"
 
 
 class Series(str, Enum):
@@ -19,6 +40,9 @@ class Series(str, Enum):
 class Subevent(BaseModel):
   label: str
   id: str
+  # From the catalog (if the subevent is in it).
+  participants: int | None = None
+  finishers: int | None = None
 
 
 class RaceEntry(BaseModel):
@@ -28,71 +52,170 @@ class RaceEntry(BaseModel):
   subevents: list[Subevent]
 
 
-def detect_gender(subevent_id: str):
-  df = pd.read_csv(data_folder(f"im/csv/{subevent_id}.csv"))
-  F = df.ContactGender.value_counts().get("F", 0)
-  M = df.ContactGender.value_counts().get("M", 0)
-  F = F / (F + M)
-  M = M / (F + M)
-  if F > 0.9:
-    return "F"
-  elif M > 0.9:
-    return "M"
-  else:
-    return "MF"
+def get_race_name(url: str) -> str:
+  """Returns the ID of a race (e.g "im703-boulder") given the URL of its results page."""
+  name = url.split("/")[-1].replace("-results", "").lower()
 
+  if "im-world-championship" in name:
+    return "im-world-championship"
+  elif "im703-world-championship" in name:
+    return "im703-world-championship"
 
-def rank_splits(data: dict):
-  """Rank everyone's splits overall, as well as based on gender and age group."""
-  df = pd.DataFrame(data)
+  return name
 
-  df["Gender"] = df.AgeGroup.map(lambda ag: ag[0] if not pd.isna(ag) else pd.NA)
-  df["FinishRankGroup"] = df[df.FinishTime > 0].groupby(by=["AgeGroup"])["FinishTime"].rank(method="min", ascending=True)
-  df["SwimRankGroup"] = df[df.SwimTime > 0].groupby(by=["AgeGroup"])["SwimTime"].rank(method="min", ascending=True)
-  df["BikeRankGroup"] = df[df.BikeTime > 0].groupby(by=["AgeGroup"])["BikeTime"].rank(method="min", ascending=True)
-  df["RunRankGroup"] = df[df.RunTime > 0].groupby(by=["AgeGroup"])["RunTime"].rank(method="min", ascending=True)
 
-  df["FinishRankGender"] = df[df.FinishTime > 0].groupby(by=["Gender"])["FinishTime"].rank(method="min", ascending=True)
-  df["SwimRankGender"] = df[df.SwimTime > 0].groupby(by=["Gender"])["SwimTime"].rank(method="min", ascending=True)
-  df["BikeRankGender"] = df[df.BikeTime > 0].groupby(by=["Gender"])["BikeTime"].rank(method="min", ascending=True)
-  df["RunRankGender"] = df[df.RunTime > 0].groupby(by=["Gender"])["RunTime"].rank(method="min", ascending=True)
+def race_names(df: pd.DataFrame) -> pd.Series:
+  """Returns the display name of each row of `subevents.csv` (e.g "70.3 Boulder")."""
+  return df.series.map(lambda s: {"IRONMAN-70.3": "70.3"}.get(s, s)) + " " + df.name.map(lambda n: n.replace("IRONMAN ", "").replace("70.3 ", ""))
 
-  df["FinishRankOverall"] = df[df.FinishTime > 0]["FinishTime"].rank(method="min", ascending=True)
-  df["SwimRankOverall"] = df[df.SwimTime > 0]["SwimTime"].rank(method="min", ascending=True)
-  df["BikeRankOverall"] = df[df.BikeTime > 0]["BikeTime"].rank(method="min", ascending=True)
-  df["RunRankOverall"] = df[df.RunTime > 0]["RunTime"].rank(method="min", ascending=True)
 
-  df.fillna(-1, inplace=True)
+def detect_gender(subevent_id: str, catalog: Catalog | None = None) -> str:
+  """Returns whether a subevent is a women's ("F"), men's ("M") or mixed ("MF") race.
 
-  return df.to_dict(orient="records")
+  This is a lookup in the catalog (see `catalog.py`). Subevents that aren't in the
+  catalog yet (or whose results changed) are summarized first.
+  """
+  catalog = catalog or Catalog()
+  if catalog.stale(subevent_id):
+    catalog.add(subevent_id, summarize(data_folder(f"im/json/{subevent_id}.json")))
+  return catalog.gender(subevent_id)
 
 
-def main():
-  """Process and copy results to the `triathlon-data` repository."""
-  parser = argparse.ArgumentParser(description="Process and copy results to the `triathlon-data` repository.")
-  parser.add_argument("--index", help="Where to put the index file", required=True, type=str)
-  parser.add_argument("--data", help="Where to put the data files", type=str, default=None)
-  args = parser.parse_args()
+def code_version(format: str = "rows", with_aggregates: bool = False) -> str:
+  """Returns a hash of the code that determines the contents of a published file."""
+  digest = hashlib.sha256(PUBLISH_VERSION.encode())
+  digest.update(format.encode())
+  modules = [ranking, compact] if format == "columnar" else [ranking]
+  if with_aggregates:
+    modules.append(aggregates)
+  for module in modules:
+    with open(module.__file__, "rb") as f:
+      digest.update(f.read())
+  return digest.hexdigest()
+
+
+def input_hash(subevent_id: str, version: str) -> str:
+  """Returns a hash of the results of a subevent and the code `version`.
+
+  If this hasn't changed since the last time the subevent was published, there's
+  no need to publish it again.
+  """
+  with open(data_folder(f"im/json/{subevent_id}.json"), "rb") as f:
+    digest = hashlib.file_digest(f, "sha256")
+  digest.update(version.encode())
+  return digest.hexdigest()
+
+
+def columnar_path(path: str) -> str:
+  """Returns where the columnar copy of a published file goes (e.g `im703-boulder-2019.cols.json`)."""
+  return path.removesuffix(".json") + COLUMNAR_SUFFIX
+
+
+def output_paths(path: str, format: str = "rows", aggregates_path: str | None = None) -> list[str]:
+  """Returns every file that publishing a subevent to `path` writes (see `publish_subevent`)."""
+  outputs = [path]
+  if format == "columnar":
+    outputs.append(columnar_path(path))
+  if aggregates_path is not None:
+    outputs.append(aggregates_path)
+  return outputs
+
+
+def up_to_date(name: str, h: str, hashes: dict, manifest: dict, outputs: list[str]) -> bool:
+  """Returns whether a file was last published from the same inputs (`h`), and its `outputs` are still there.
+
+  If the last publish had no results to write, the file isn't in the `manifest`, so
+  there are no outputs to look for.
+  """
+  if hashes.get(name) != h:
+    return False
+  return name not in manifest or all(os.path.exists(p) for p in outputs)
+
+
+def load_json(folder: str, filename: str) -> dict:
+  """Loads a JSON file that keeps track of the files published to `folder` (if it exists)."""
+  path = os.path.join(folder, filename)
+  if not os.path.exists(path):
+    return {}
+  with open(path, "r") as f:
+    return json.load(f)
 
-  df = pd.read_csv(tasks_folder("im/subevents.csv"))
 
-  def get_race_name(url: str):
-    name = url.split("/")[-1].replace("-results", "").lower()
+def save_json(folder: str, filename: str, value: dict):
+  """Saves a JSON file that keeps track of the files published to `folder`."""
+  with open(os.path.join(folder, filename), "w") as f:
+    json.dump(value, f, indent=2, sort_keys=True)
 
-    if "im-world-championship" in name:
-      return "im-world-championship"
-    elif "im703-world-championship" in name:
-      return "im703-world-championship"
 
-    return name
+def publish_subevent(
+  subevent_id: str,
+  path: str,
+  format: str = "rows",
+  aggregates_path: str | None = None,
+  json_path: str | None = None,
+) -> dict | None:
+  """Ranks the results of a subevent and writes them to `path`.
 
+  The file is an array of row objects (which is what the app reads). In the
+  `columnar` format, struct-of-arrays JSON (see `compact.encode`) is also written
+  to `columnar_path(path)`, along with precompressed `.gz` and `.br` copies.
+
+  If `aggregates_path` is given, the histograms and quantiles for the charts
+  (see `aggregates.compute_aggregates`) are written there.
+
+  The results are read from `json_path` (default: the scraped file in `data/im/json`).
+
+  Returns the size and hash of the file(s), or None if there were no results to publish.
+  """
+  with METRICS.stage("parse"), open(json_path or data_folder(f"im/json/{subevent_id}.json")) as f:
+    data = json.load(f)
+
+  if len(data["data"]) == 0:
+    return None
+
+  with METRICS.stage("flatten"):
+    df = pd.DataFrame(data["data"])
+  METRICS.set("subevent_rows", len(df), subevent=subevent_id)
+  METRICS.inc("rows_total", len(df))
+
+  if aggregates_path is not None:
+    # This has to happen before ranking, which fills in the missing values.
+    with METRICS.stage("aggregate"), open(aggregates_path, "w") as f:
+      json.dump(aggregates.compute_aggregates(df), f, separators=(",", ":"))
+
+  with METRICS.stage("rank"):
+    df = rank_frame(df)
+
+  columnar = None
+  if format == "columnar":
+    with METRICS.stage("serialize"):
+      columnar = compact.write_precompressed(columnar_path(path), compact.dumps(compact.encode(df, data["total"])))
+
+  with METRICS.stage("serialize"):
+    data["data"] = df.to_dict(orient="records")
+    body = json.dumps(data, indent=2).encode("utf-8")
+
+    with open(path, "wb") as f:
+      f.write(body)
+
+  written = {"bytes": len(body), "sha256": hashlib.sha256(body).hexdigest()}
+  if columnar is not None:
+    written["columnar"] = columnar
+  return written
+
+
+def subevents_frame(path: str = tasks_folder("im/subevents.csv")) -> pd.DataFrame:
+  """Reads `subevents.csv`, and adds the ID (e.g "im703-boulder") and display name of each race."""
+  df = pd.read_csv(path)
   df["id"] = df.results_url.map(get_race_name)
-  df["name"] = df.series.map(lambda s: {"IRONMAN-70.3": "70.3"}.get(s, s)) + " " + df.name.map(lambda n: n.replace("IRONMAN ", "").replace("70.3 ", ""))
+  df["name"] = race_names(df)
+  return df
 
-  ids = df.id.unique()
-  out = {}
 
-  for id in ids:
+def race_entries(df: pd.DataFrame, catalog: Catalog) -> dict[str, RaceEntry]:
+  """Returns the index entry of each race (with its subevents) in a `subevents_frame`."""
+  out = {}
+  for id in df.id.unique():
     df_ = df[df.id == id].copy()
 
     entry = RaceEntry(
@@ -106,31 +229,102 @@ def main():
       full_subevent_id = f"{row.id}-{row.year}"
 
       # if "world championship" in row.name.lower():
-      #   gender = detect_gender(row.subevent_id)
+      #   gender = detect_gender(row.subevent_id, catalog)
       #   full_subevent_id += "-" + gender.lower()
-      
+
       print(full_subevent_id)
 
-      entry.subevents.append(Subevent(label=row.year, id=full_subevent_id))
+      summary = catalog.get(row.subevent_id) or {}
+      entry.subevents.append(Subevent(
+        label=str(row.year),
+        id=full_subevent_id,
+        participants=summary.get("participants"),
+        finishers=summary.get("finishers"),
+      ))
 
-      if args.data:
-        with open(data_folder(f"im/json/{row.subevent_id}.json")) as f:
-          data = json.load(f)
+    out[id] = entry
+  return out
 
-        if len(data["data"]) == 0:
-          print("Warning: No data found for this subevent. Skipping.")
-          continue
 
-        data["data"] = rank_splits(data["data"])
+def write_index(path: str, entries: dict[str, RaceEntry]):
+  """Writes the index of races (see `race_entries`)."""
+  with open(path, "w") as f:
+    json.dump({id: entries[id].dict() for id in entries}, f, indent=2)
 
-        with open(os.path.join(args.data, f"{full_subevent_id}.json"), "w") as f:
-          json.dump(data, f, indent=2)
 
-    out[id] = entry
+def main():
+  """Process and copy results to the `triathlon-data` repository."""
+  parser = argparse.ArgumentParser(description="Process and copy results to the `triathlon-data` repository.")
+  parser.add_argument("--index", help="Where to put the index file", required=True, type=str)
+  parser.add_argument("--data", help="Where to put the data files", type=str, default=None)
+  parser.add_argument("--p", type=int, default=os.cpu_count(), help="The number of processes to use")
+  parser.add_argument("--force", action="store_true", help="Publish every subevent, even if its inputs haven't changed")
+  parser.add_argument("--format", choices=["rows", "columnar"], default="rows",
+                      help="Write arrays of row objects, or also compact struct-of-arrays JSON (<id>.cols.json) with .gz/.br copies")
+  parser.add_argument("--aggregates", help="Where to put the precomputed histograms and quantiles for the charts", type=str, default=None)
+  parser.add_argument("--metrics", type=str, default=metrics_path("publish"),
+                      help="Where to write the metrics of the run (Prometheus text if it ends in .prom, JSON otherwise)")
+  args = parser.parse_args()
+  if args.aggregates and not args.data:
+    parser.error("--aggregates needs --data (the aggregates are computed while publishing the data files).")
+
+  df = subevents_frame()
+  out = race_entries(df, Catalog())
+
+  # Maps the path of each file that needs to be published to (subevent ID, input hash).
+  # If two subevents have the same ID on the site, the last one wins (as it always has).
+  todo = {}
+  version = code_version(args.format, with_aggregates=args.aggregates is not None)
+  hashes = load_json(args.data, HASHES_FILENAME) if args.data and not args.force else {}
+  manifest = load_json(args.data, MANIFEST_FILENAME) if args.data else {}
+
+  if args.data:
+    for id in out:
+      for row in df[df.id == id].itertuples():
+        full_subevent_id = f"{row.id}-{row.year}"
+        path = os.path.join(args.data, f"{full_subevent_id}.json")
+        h = input_hash(row.subevent_id, version)
+        aggregates_path = os.path.join(args.aggregates, f"{full_subevent_id}.json") if args.aggregates else None
+        outputs = output_paths(path, args.format, aggregates_path)
+        if not up_to_date(full_subevent_id, h, hashes, manifest, outputs):
+          todo[path] = (row.subevent_id, h)
+        else:
+          todo.pop(path, None)
+
+  # The index is always assembled in the same order, so write it before publishing the data.
+  write_index(args.index, out)
+
+  if args.data:
+    print(f"Publishing {len(todo)} subevents that changed using {args.p} processes.")
+
+    if args.aggregates:
+      os.makedirs(args.aggregates, exist_ok=True)
+
+    jobs = []
+    for path, (subevent_id, _) in todo.items():
+      aggregates_path = os.path.join(args.aggregates, os.path.basename(path)) if args.aggregates else None
+      jobs.append(Job(publish_subevent, (subevent_id, path), dict(format=args.format, aggregates_path=aggregates_path)))
+    new_hashes = {os.path.basename(path).replace(".json", ""): h for path, (_, h) in todo.items()}
+
+    try:
+      for i, r in enumerate(stream_pooled_jobs(jobs, t=args.p, processes=True, name="publish"), start=1):
+        name = os.path.basename(r.args[1]).replace(".json", "")
+        if r.status != JobStatus.FULFILLED:
+          print(f"[{i}/{len(jobs)}] Failed to publish {name}: {r.reason}")
+          continue
+        if r.value is None:
+          print(f"[{i}/{len(jobs)}] Warning: No data found for {name}. Skipping.")
+          manifest.pop(name, None)
+        else:
+          print(f"[{i}/{len(jobs)}] Published {name} ({r.value['bytes']} bytes)")
+          manifest[name] = r.value
+        hashes[name] = new_hashes[name]
+    finally:
+      save_json(args.data, HASHES_FILENAME, hashes)
+      save_json(args.data, MANIFEST_FILENAME, manifest)
+      METRICS.write(args.metrics)
+      print(METRICS.summary())
 
-  with open(args.index, "w") as f:
-    json.dump({id: out[id].dict() for id in out}, f, indent=2)
-  
   print("DONE")
 
 
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+
+
+# The splits that are ranked. Each one has a `<split>Time` column (in seconds).
+SPLITS = ["Finish", "Swim", "Bike", "Run"]
+
+# Maps the suffix of each rank column to the columns that define its groups. For
+# example, `FinishRankGroup` ranks everyone's finish time within their age group.
+# An empty list ranks everyone together.
+GROUPINGS = {
+  "Group": ["AgeGroup"],
+  "Gender": ["Gender"],
+  "Overall": [],
+}
+
+
+def group_codes(df: pd.DataFrame, columns: list[str]) -> np.ndarray:
+  """Returns an integer code for the group of each row.
+
+  Rows with a missing value in any of the `columns` get a code of -1.
+  """
+  codes = np.zeros(len(df), dtype=np.int64)
+
+  for column in columns:
+    c, uniques = pd.factorize(df[column])
+    codes = np.where((codes < 0) | (c < 0), -1, codes * len(uniques) + c)
+
+  return codes
+
+
+def rank_matrix(values: np.ndarray, codes: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+  """Assigns min-method ranks to every column of `values` within the groups in `codes`.
+
+  This is equivalent to running `df.groupby(codes)[column].rank(method="min")` on
+  the positive entries of each column, but every split is ranked at once: the
+  values are sorted once, and then each grouping only needs one stable sort of its
+  (integer) codes.
+
+  Parameters
+  ----------
+  values: An (n, k) array with one column per split. Entries that are NaN or not
+    positive aren't ranked.
+  codes: Maps the name of each grouping to an (n,) array of group codes. Rows with
+    a negative code aren't ranked.
+
+  Returns
+  -------
+  A dict with the same keys as `codes`, where each value is an (n, k) float array
+  of ranks (NaN for entries that weren't ranked).
+  """
+  n, k = values.shape
+
+  # Work on one contiguous row per split, since that's much faster to sort.
+  values = np.ascontiguousarray(values.T)
+  valid = values > 0
+
+  # Sort each split by value once. Entries that can't be ranked go to the end.
+  keyed = np.where(valid, values, np.inf)
+  order = np.argsort(keyed, axis=1, kind="stable")
+  sorted_values = np.take_along_axis(keyed, order, axis=1)
+  positions = np.arange(n)[None, :]
+
+  out = {}
+
+  for name, c in codes.items():
+    c = np.asarray(c, dtype=np.int64)[None, :]
+    unranked = c.max(initial=-1) + 1
+    group = np.where(valid & (c >= 0), c, unranked)
+
+    # A stable sort by group keeps the entries within each group sorted by value.
+    by_value = np.take_along_axis(group, order, axis=1)
+    by_group = np.argsort(by_value, axis=1, kind="stable")
+    perm = np.take_along_axis(order, by_group, axis=1)
+    g = np.take_along_axis(by_value, by_group, axis=1)
+    v = np.take_along_axis(sorted_values, by_group, axis=1)
+
+    # The rank of an entry is its position relative to the start of its group,
+    # where tied entries all take the position of the first one (i.e "min").
+    new_group = np.ones((k, n), dtype=bool)
+    new_group[:, 1:] = g[:, 1:] != g[:, :-1]
+    new_value = new_group.copy()
+    new_value[:, 1:] |= v[:, 1:] != v[:, :-1]
+
+    group_start = np.maximum.accumulate(np.where(new_group, positions, 0), axis=1)
+    run_start = np.maximum.accumulate(np.where(new_value, positions, 0), axis=1)
+
+    ranks_sorted = (run_start - group_start + 1).astype(np.float64)
+    ranks_sorted[g == unranked] = np.nan
+
+    ranks = np.empty((k, n), dtype=np.float64)
+    np.put_along_axis(ranks, perm, ranks_sorted, axis=1)
+    out[name] = ranks.T
+
+  return out
+
+
+def gender_from_age_group(age_group: pd.Series) -> pd.Series:
+  """Returns the gender (the first letter of the age group, e.g "M" for "M25-29") of each row."""
+  codes, uniques = pd.factorize(age_group)
+  # Only look at each distinct age group once, rather than once per row.
+  genders = np.append(pd.Series(uniques, dtype=object).str[0].to_numpy(dtype=object), np.nan)
+  # A code of -1 (i.e a missing age group) picks the NaN at the end.
+  return pd.Series(genders[codes], index=age_group.index, dtype=object)
+
+
+def rank_frame(df: pd.DataFrame, groupings: dict[str, list[str]] = GROUPINGS) -> pd.DataFrame:
+  """Adds the `Gender` column and the rank columns to a dataframe of results (in place).
+
+  Extra `groupings` (e.g `{"Country": ["CountryISO2"]}`) add a `<split>Rank<suffix>`
+  column for each split. Entries that can't be ranked (and any other missing
+  values) are filled with -1.
+  """
+  df["Gender"] = gender_from_age_group(df.AgeGroup)
+
+  values = df[[f"{split}Time" for split in SPLITS]].to_numpy(dtype=np.float64, na_value=np.nan)
+  codes = {suffix: group_codes(df, columns) for suffix, columns in groupings.items()}
+  ranks = rank_matrix(values, codes)
+
+  df.fillna(-1, inplace=True)
+
+  for suffix in groupings:
+    r = np.nan_to_num(ranks[suffix], nan=-1)
+    for j, split in enumerate(SPLITS):
+      df[f"{split}Rank{suffix}"] = r[:, j]
+
+  return df
+
+
+def rank_splits(data: list[dict], groupings: dict[str, list[str]] = GROUPINGS) -> list[dict]:
+  """Rank everyone's splits overall, as well as based on gender and age group."""
+  return rank_frame(pd.DataFrame(data), groupings=groupings).to_dict(orient="records")
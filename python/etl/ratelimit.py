@@ -0,0 +1,464 @@
+import sys; sys.path.extend([".", "..", "../.."])
+
+import bisect
+import email.utils
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from threading import Condition, Lock
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import METRICS
+
+
+# The most requests per second to send to each host (and how many can be sent in a
+# burst). Hosts that aren't listed here (e.g the mock server) only have the
+# concurrency limit.
+DEFAULT_RATES = {
+  "api.competitor.com": (20.0, 40),
+  "www.ironman.com": (10.0, 20),
+  "sheets.googleapis.com": (1.0, 5),
+}
+
+DEFAULT_MAX_CONCURRENCY = 32
+
+# A server that's overloaded (or wants us to slow down) responds with one of these.
+# A 429 means the whole host wants fewer requests, while a 503 might only be one
+# of its backends, so only the request that got it waits.
+TOO_MANY_REQUESTS = 429
+THROTTLED = (429, 503)
+
+# How long to wait after a 429 or 503 without a `Retry-After` (and the longest `Retry-After` that's honored).
+DEFAULT_PAUSE = 1.0
+MAX_PAUSE = 120.0
+
+# The lowest rate (in requests per second) that a host is slowed down to.
+MIN_RATE = 0.5
+
+
+def retry_after(response: requests.Response) -> float | None:
+  """Returns the seconds to wait from the `Retry-After` header of a response (which is either seconds or an HTTP date)."""
+  value = response.headers.get("Retry-After")
+  if value is None:
+    return None
+  try:
+    return max(float(value), 0.0)
+  except ValueError:
+    pass
+  try:
+    return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+  except (TypeError, ValueError):
+    return None
+
+
+class TokenBucket:
+  """Allows `rate` requests per second on average, in bursts of up to `burst`."""
+  def __init__(self, rate: float, burst: float):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = float(burst)
+    self.updated = time.monotonic()
+    self._lock = Lock()
+
+  def _refill(self):
+    now = time.monotonic()
+    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  def take(self) -> float:
+    """Takes a token, and returns how many seconds to wait before using it (0 if there was one left).
+
+    The token is reserved even if the caller has to wait, so the callers are served
+    in order rather than polling.
+    """
+    with self._lock:
+      self._refill()
+      self.tokens -= 1
+      return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+  def try_take(self) -> bool:
+    """Takes a token if there's one left (without waiting)."""
+    with self._lock:
+      self._refill()
+      if self.tokens < 1:
+        return False
+      self.tokens -= 1
+      return True
+
+  def set_rate(self, rate: float):
+    with self._lock:
+      self._refill()
+      self.rate = rate
+
+
+class AIMDLimiter:
+  """Limits the number of requests in flight, and adapts the limit to how the server copes.
+
+  The limit grows by one for every `limit` requests that succeed while it's being
+  used (additive increase). It's multiplied by `decrease` when a request is
+  throttled, and by `soft_decrease` when one fails or the latency climbs
+  (multiplicative decrease). The gentler cut keeps a few random errors from
+  collapsing the limit. The requests that were in flight together saw the same
+  congestion, so the limit is only cut once for all of them.
+  """
+  def __init__(
+    self,
+    initial: int = 4,
+    min_limit: int = 1,
+    max_limit: int = DEFAULT_MAX_CONCURRENCY,
+    decrease: float = 0.5,
+    soft_decrease: float = 0.9,
+  ):
+    self.limit = float(min(max(initial, min_limit), max_limit))
+    self.min_limit = min_limit
+    self.max_limit = max_limit
+    self.decrease = decrease
+    self.soft_decrease = soft_decrease
+    self.in_flight = 0
+    self.cut_at = 0.0
+    self._cond = Condition()
+
+  def acquire(self) -> float:
+    """Waits until fewer than `limit` requests are in flight, and returns when the request started (pass it to `release`)."""
+    with self._cond:
+      while self.in_flight >= int(self.limit):
+        self._cond.wait()
+      self.in_flight += 1
+      return time.monotonic()
+
+  def release(self, started_at: float, ok: bool, throttled: bool = False):
+    """Records how a request went: it was `throttled`, it failed or was slow (not `ok`), or it succeeded."""
+    with self._cond:
+      used = self.in_flight >= self.limit / 2
+      self.in_flight -= 1
+      if throttled or not ok:
+        # Only cut the limit once for the requests that were in flight when it was last cut.
+        if started_at >= self.cut_at:
+          self.limit = max(self.min_limit, self.limit * (self.decrease if throttled else self.soft_decrease))
+          self.cut_at = time.monotonic()
+      elif used:
+        # There's no point in growing a limit that isn't being used.
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+      self._cond.notify_all()
+
+
+class Latencies:
+  """The recent latencies of an endpoint.
+
+  Keeps the last `window` of them (sorted too, for the quantiles), the p50 of each
+  block of `short` of them, and a `baseline`: the latency of the endpoint when it
+  isn't congested. The baseline drops straight to a lower p50, and only drifts up
+  (by `alpha` of the difference per block) if the endpoint really got slower.
+  Comparing medians (rather than single latencies) means a heavy tail alone doesn't
+  look like congestion, and the slow drift means a gradual slowdown does.
+  """
+  def __init__(self, window: int = 200, min_samples: int = 20, short: int = 20, alpha: float = 0.01):
+    self.samples: deque[float] = deque()
+    self.ordered: list[float] = []
+    self.recent: list[float] = []
+    self.short = short
+    self.window = window
+    self.min_samples = min_samples
+    self.alpha = alpha
+    self.recent_p50: float | None = None
+    self.baseline: float | None = None
+    self._lock = Lock()
+
+  def add(self, seconds: float):
+    with self._lock:
+      if len(self.samples) == self.window:
+        del self.ordered[bisect.bisect_left(self.ordered, self.samples.popleft())]
+      self.samples.append(seconds)
+      bisect.insort(self.ordered, seconds)
+      self.recent.append(seconds)
+      if len(self.recent) == self.short:
+        self.recent_p50 = sorted(self.recent)[len(self.recent) // 2]
+        self.recent.clear()
+        if self.baseline is None or self.recent_p50 < self.baseline:
+          self.baseline = self.recent_p50
+        else:
+          self.baseline += self.alpha * (self.recent_p50 - self.baseline)
+
+  def quantiles(self, *qs: float) -> list[float] | None:
+    """Returns the quantiles of the window, or None if there aren't enough samples yet."""
+    with self._lock:
+      n = len(self.ordered)
+      if n < self.min_samples:
+        return None
+      return [self.ordered[int(q * (n - 1))] for q in qs]
+
+
+class HostController:
+  """Paces the requests to one host (see `get`).
+
+  - At most `AIMDLimiter.limit` requests are in flight, and the limit adapts between
+    `min_concurrency` and `max_concurrency`.
+  - If `rate` is given, a token bucket keeps the requests under `rate` per second.
+  - When a request is throttled (429 or 503), it's retried after the `Retry-After`
+    (up to `retries` times). After a 429, every request to the host waits, and the
+    rate is cut by `rate_decrease` (or, if there wasn't a bucket yet, set to that fraction of
+    the rate of the last few seconds), and grows back by about one request per
+    second every second while the bucket holds the requests back, up to `rate`. A
+    rate that was learned this way (rather than given) is forgotten after `forget`
+    seconds without a 429.
+  - When the latencies of an endpoint have a long tail (p99 > `tail` * p50), a
+    request that takes longer than the p95 is sent again, and whichever response
+    comes first is used. At most a fraction `hedge_budget` of the requests are hedged.
+
+  A request is considered slow (and the limit is cut a little) when the p50 of its
+  endpoint's recent latencies is over `tolerance` times their long-run baseline.
+
+  The requests go through one `requests.Session`, so they reuse the connections to
+  the host rather than each paying for a TCP and TLS handshake.
+  """
+  def __init__(
+    self,
+    host: str,
+    rate: float | None = None,
+    burst: float | None = None,
+    initial: int = 4,
+    min_concurrency: int = 1,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    adaptive: bool = True,
+    retries: int = 3,
+    tolerance: float = 2.0,
+    tail: float = 3.0,
+    hedge_budget: float = 0.05,
+    rate_decrease: float = 0.75,
+    forget: float = 30.0,
+  ):
+    self.host = host
+    self.limiter = AIMDLimiter(initial if adaptive else max_concurrency, min_concurrency, max_concurrency)
+    self.bucket = TokenBucket(rate, burst or 2 * rate) if rate else None
+    self.max_rate = rate
+    self.rate_decrease = rate_decrease
+    self.forget = forget
+    self.rate_cut_at = 0.0
+    # When the recent requests were sent (to estimate the rate at which the host starts throttling).
+    self.sent: deque[float] = deque(maxlen=4096)
+    self.adaptive = adaptive
+    self.retries = retries
+    self.tolerance = tolerance
+    self.tail = tail
+    self.hedge_budget = hedge_budget
+    self.paused_until = 0.0
+    self.latencies: dict[str, Latencies] = {}
+    self.requests = 0
+    self.hedges = 0
+    self._lock = Lock()
+    self._hedger: ThreadPoolExecutor | None = None
+    # Keep a connection for every request that can be in flight (including the hedged ones).
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2 * self.limiter.max_limit)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+
+  def get(self, url: str, headers: dict | None = None, timeout: float | None = None, endpoint: str = "default") -> requests.Response:
+    """Sends a GET request once the host is ready for it, and retries it (after the `Retry-After`) if it's throttled.
+
+    Returns the last response, even if it was throttled. A request that raises (e.g a
+    timeout) isn't retried here, since the job that sent it has its own `Backoff`.
+    """
+    for attempt in range(self.retries + 1):
+      response = self.send(url, headers, timeout, endpoint)
+      if response.status_code not in THROTTLED or attempt == self.retries:
+        break
+      METRICS.inc("ratelimit_retries_total", host=self.host, status=response.status_code)
+      # After a 429, `send` waits for the whole host to be unpaused.
+      if response.status_code != TOO_MANY_REQUESTS:
+        time.sleep(min(retry_after(response) or DEFAULT_PAUSE, MAX_PAUSE))
+    return response
+
+  def send(self, url: str, headers: dict | None, timeout: float | None, endpoint: str) -> requests.Response:
+    started_at = self.limiter.acquire()
+    ok, throttled = False, False
+    try:
+      limited = self.wait_turn()
+      latencies = self.latency(endpoint)
+      with self._lock:
+        self.requests += 1
+
+      hedge_after = self.hedge_after(latencies)
+      if hedge_after is None:
+        response, elapsed = self.request(url, headers, timeout, endpoint)
+      else:
+        response, elapsed = self.hedged(url, headers, timeout, endpoint, hedge_after)
+
+      METRICS.inc("ratelimit_responses_total", host=self.host, status=response.status_code)
+      throttled = response.status_code in THROTTLED
+      if response.status_code == TOO_MANY_REQUESTS:
+        self.pause(retry_after(response))
+        self.slow_down(started_at)
+      ok = response.status_code < 500 and not throttled
+      if ok:
+        latencies.add(elapsed)
+        ok = not self.is_slow(latencies)
+        if limited:
+          self.speed_up()
+      return response
+    finally:
+      if self.adaptive:
+        self.limiter.release(started_at, ok, throttled)
+      else:
+        self.limiter.release(started_at, True)
+      METRICS.set("ratelimit_concurrency", self.limiter.limit, host=self.host)
+
+  def request(self, url: str, headers: dict | None, timeout: float | None, endpoint: str) -> tuple[requests.Response, float]:
+    """Sends one request, and returns the response and how long it took."""
+    t0 = time.perf_counter()
+    with METRICS.request(endpoint) as m:
+      r = self.session.get(url, headers=headers, timeout=timeout)
+      m.status, m.bytes = r.status_code, len(r.content)
+    return r, time.perf_counter() - t0
+
+  def hedged(self, url: str, headers: dict | None, timeout: float | None, endpoint: str, after: float) -> tuple[requests.Response, float]:
+    """Sends a request, and sends it again if there's no response after `after` seconds. Returns the first response."""
+    t0 = time.perf_counter()
+    pool = self.hedger()
+    first = pool.submit(self.request, url, headers, timeout, endpoint)
+    done, _ = wait([first], timeout=after)
+    if done or not self.can_hedge():
+      return first.result()[0], time.perf_counter() - t0
+
+    METRICS.inc("ratelimit_hedges_total", host=self.host)
+    second = pool.submit(self.request, url, headers, timeout, endpoint)
+    done, _ = wait([first, second], return_when=FIRST_COMPLETED)
+    winner = first if first in done else second
+    if winner.exception() is not None:
+      # Fall back to the other request if the first one to finish failed.
+      winner = second if winner is first else first
+    METRICS.inc("ratelimit_hedge_wins_total", host=self.host, won="hedge" if winner is second else "original")
+    return winner.result()[0], time.perf_counter() - t0
+
+  def hedger(self) -> ThreadPoolExecutor:
+    with self._lock:
+      if self._hedger is None:
+        self._hedger = ThreadPoolExecutor(max_workers=2 * self.limiter.max_limit, thread_name_prefix=f"hedge-{self.host}")
+      return self._hedger
+
+  def can_hedge(self) -> bool:
+    """Returns True if there's room in the budget (and the rate limit) for another hedged request."""
+    with self._lock:
+      if time.monotonic() < self.paused_until or self.hedges >= self.hedge_budget * self.requests:
+        return False
+      if self.bucket is not None and not self.bucket.try_take():
+        return False
+      self.hedges += 1
+      return True
+
+  def hedge_after(self, latencies: Latencies) -> float | None:
+    """Returns the p95 latency of an endpoint if its tail is long enough to hedge (or None)."""
+    if self.hedge_budget <= 0:
+      return None
+    quantiles = latencies.quantiles(0.5, 0.95, 0.99)
+    if quantiles is None:
+      return None
+    p50, p95, p99 = quantiles
+    return p95 if p99 > self.tail * p50 else None
+
+  def is_slow(self, latencies: Latencies) -> bool:
+    recent, baseline = latencies.recent_p50, latencies.baseline
+    return recent is not None and baseline is not None and recent > self.tolerance * baseline
+
+  def latency(self, endpoint: str) -> Latencies:
+    with self._lock:
+      if endpoint not in self.latencies:
+        self.latencies[endpoint] = Latencies()
+      return self.latencies[endpoint]
+
+  def wait_turn(self) -> bool:
+    """Waits until the host isn't paused (by a `Retry-After`), and for a token. Returns True if the token bucket held the request back."""
+    while True:
+      with self._lock:
+        now = time.monotonic()
+        if self.bucket is not None and self.max_rate is None and now - self.rate_cut_at > self.forget:
+          # The host hasn't throttled us in a while, so the rate we learned might be out of date.
+          self.bucket = None
+        delay = self.paused_until - now
+        bucket = self.bucket
+      if delay <= 0:
+        break
+      time.sleep(delay)
+    delay = bucket.take() if bucket is not None else 0.0
+    if delay > 0:
+      METRICS.observe("ratelimit_wait_seconds", delay, host=self.host)
+      time.sleep(delay)
+    with self._lock:
+      self.sent.append(time.monotonic())
+    return delay > 0
+
+  def slow_down(self, started_at: float):
+    """Cuts the rate of requests after the host throttled one (once for the requests that were sent together)."""
+    if not self.adaptive:
+      return
+    with self._lock:
+      now = time.monotonic()
+      if started_at < self.rate_cut_at:
+        return
+      self.rate_cut_at = now
+      if self.bucket is None:
+        # Start from the rate of the last few seconds (if there were enough requests to tell).
+        window = min(2.0, now - self.sent[0]) if self.sent else 0.0
+        recent = sum(t > now - window for t in self.sent)
+        if recent < 10 or window <= 0:
+          return
+        rate = max(MIN_RATE, self.rate_decrease * recent / window)
+        self.bucket = TokenBucket(rate, max(1.0, rate / 2))
+      else:
+        rate = max(MIN_RATE, self.rate_decrease * self.bucket.rate)
+        self.bucket.set_rate(rate)
+    METRICS.set("ratelimit_rate", rate, host=self.host)
+
+  def speed_up(self):
+    """Raises the rate by about one request per second, every second that the bucket holds the requests back."""
+    with self._lock:
+      if self.bucket is None or not self.adaptive:
+        return
+      rate = self.bucket.rate + 1 / self.bucket.rate
+      self.bucket.set_rate(rate if self.max_rate is None else min(rate, self.max_rate))
+
+  def pause(self, seconds: float | None):
+    """Holds back every request to the host for `seconds` (or `DEFAULT_PAUSE`)."""
+    seconds = min(DEFAULT_PAUSE if seconds is None else seconds, MAX_PAUSE)
+    with self._lock:
+      self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+_controllers: dict[str, HostController] = {}
+_settings: dict = {}
+_lock = Lock()
+
+
+def controller(url: str) -> HostController:
+  """Returns the controller of the host of a URL (the scrapers share one per host)."""
+  host = urlparse(url).netloc
+  with _lock:
+    if host not in _controllers:
+      settings = dict(_settings)
+      rates = settings.pop("rates", DEFAULT_RATES)
+      rate = settings.pop("rate", None)
+      rate, burst = (rate, None) if rate else rates.get(host, (None, None))
+      _controllers[host] = HostController(host, rate, burst, **settings)
+    return _controllers[host]
+
+
+def configure(**kwargs):
+  """Changes the settings of the controllers (see `HostController`), e.g `configure(max_concurrency=8)`.
+
+  Pass `rate` to limit every host to that many requests per second, or `rates` to
+  replace `DEFAULT_RATES`. The controllers start over with the new settings.
+  """
+  global _settings
+  with _lock:
+    _settings = kwargs
+    for c in _controllers.values():
+      c.session.close()
+    _controllers.clear()
+
+
+def get(url: str, headers: dict | None = None, timeout: float | None = None, endpoint: str = "default") -> requests.Response:
+  """Sends a GET request through the controller of its host (see `HostController.get`)."""
+  return controller(url).get(url, headers=headers, timeout=timeout, endpoint=endpoint)
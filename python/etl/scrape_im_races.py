@@ -1,10 +1,15 @@
 import sys; sys.path.extend([".", "..", "../.."])
 
 from bs4 import BeautifulSoup
-import requests
+import os
 import pandas as pd
 
 from utils.paths import tasks_folder
+import http_cache
+
+
+# Override this to point the scraper at another server (e.g `benchmarks/mock_api.py`).
+IRONMAN_URL = os.getenv("IRONMAN_URL", "https://www.ironman.com").rstrip("/")
 
 
 def update_from_google_sheets():
@@ -19,7 +24,7 @@ def update_from_google_sheets():
   print("Updating list of known races from Google Sheets...")
   print(base_url)
 
-  data = requests.get(base_url).json()["values"]
+  data = http_cache.default_cache().get(base_url, endpoint="sheets").json()["values"]
   header = data[0]
   data = data[1:]
 
@@ -49,9 +54,9 @@ def update_from_google_sheets():
 
 
 def update_from_discountinued():
-  base_url = "https://www.ironman.com/discontinued-races"
+  base_url = f"{IRONMAN_URL}/discontinued-races"
 
-  soup = BeautifulSoup(requests.get(base_url).text)
+  soup = BeautifulSoup(http_cache.default_cache().get(base_url, endpoint="discontinued").text)
   h3s = soup.find_all("h3")
 
   # Load out current master list of races.
@@ -72,7 +77,7 @@ def update_from_discountinued():
 
     for link in links:
       name = link.text
-      href = f'https://www.ironman.com{link["href"]}' if link["href"].startswith("/") else link["href"]
+      href = f'{IRONMAN_URL}{link["href"]}' if link["href"].startswith("/") else link["href"]
 
       if name not in df.index:
         print(f"Found discontinued race called '{name}'")
@@ -83,5 +88,8 @@ def update_from_discountinued():
 
 if __name__ == "__main__":
   """Gather a list of all the Ironman races (current and discontinued)."""
-  update_from_google_sheets()
-  update_from_discountinued()
\ No newline at end of file
+  try:
+    update_from_google_sheets()
+    update_from_discountinued()
+  finally:
+    http_cache.default_cache().save()
\ No newline at end of file
@@ -1,40 +1,78 @@
 import sys; sys.path.extend([".", "..", "../.."])
 
-import requests
+import asyncio
+import aiohttp
 import json, os, glob
+from collections import deque
+from itertools import islice
 import pandas as pd
 
 from utils.paths import data_folder, tasks_folder
-from job import Job, JobStatus, await_pooled_jobs
+from job import Backoff, HybridJob, Job, JobStatus, stream_hybrid_jobs, stream_pooled_jobs
+from manifest import ContentHasher, Manifest, content_hash
+from metrics import METRICS, metrics_path
+import http_cache
+import ratelimit
 
 
 API_KEY = os.getenv("API_KEY")
 if API_KEY is None:
   raise EnvironmentError('Please set the `API_KEY` environment variable before running this script.')
 
+# Override this to point the scraper at another server (e.g `benchmarks/mock_api.py`).
+COMPETITOR_API_URL = os.getenv("COMPETITOR_API_URL", "https://api.competitor.com").rstrip("/")
 
-def scrape_single(
+
+def fetch_page(
   subevent_id: str,
   sort: str = "FinishRankOverall",
   age_group: None | str = None,
   skip: int = 0,
   limit: int = 100,
-) -> dict | None:
-  """Scrapes the Competitor API for the results of a subevent.
+) -> bytes:
+  """Requests a page of results from the Competitor API, and returns the raw body (without decoding it).
 
   ```text
   https://api.competitor.com/public/result/subevent/1C0CAFFB-36CF-46F6-8F67-C1E7F7F428B8?%24limit=100&%24skip=0&%24sort%5BFinishRankOverall%5D=1&AgeGroup=M25-29
   ```
+
+  Raises a `ValueError` if the request fails.
   """
-  url = f"https://api.competitor.com/public/result/subevent/{subevent_id}"
+  url = f"{COMPETITOR_API_URL}/public/result/subevent/{subevent_id}"
   params = {
     "$limit": limit,
     "$skip": skip,
     f"$sort[{sort}]": 1,
     "AgeGroup": age_group
   }
-  response = requests.get(url, params=params, headers={"wtc_priv_key": API_KEY})
-  return response.json()
+  # Results can be corrected, so cached pages are always revalidated (or replayed, if the cache is offline).
+  response = http_cache.default_cache().get(url, params=params, headers={"wtc_priv_key": API_KEY}, endpoint="result_page")
+  if response.status_code != 200:
+    raise ValueError(f"{response.url} responded with status code {response.status_code}.")
+  return response.content
+
+
+def parse_page(body: bytes, subevent_id: str = "") -> dict:
+  """Decodes a page of results. Raises a `ValueError` if it's empty (rather than returning None)."""
+  with METRICS.stage("parse"):
+    results = json.loads(body) if body.strip() else None
+  if results is None:
+    raise ValueError(f"The API didn't return any results for {subevent_id}.")
+  return results
+
+
+def scrape_single(
+  subevent_id: str,
+  sort: str = "FinishRankOverall",
+  age_group: None | str = None,
+  skip: int = 0,
+  limit: int = 100,
+) -> dict:
+  """Scrapes the Competitor API for a page of the results of a subevent.
+
+  Raises a `ValueError` if the request fails (rather than returning something that isn't a page of results).
+  """
+  return parse_page(fetch_page(subevent_id, sort=sort, age_group=age_group, skip=skip, limit=limit), subevent_id)
 
 
 def scrape(
@@ -43,16 +81,21 @@ def scrape(
   age_group: None | str = None,
   limit: int = 100,
   verbose: bool = False,
-) -> dict | None:
-  """Scrapes all the results for a subevent by paginating."""
+  first: dict | None = None,
+) -> dict:
+  """Scrapes all the results for a subevent by paginating (into memory).
+
+  If the `first` page of results has already been requested, it is reused. Raises
+  if a request fails. See `scrape_to_file` for a download that's streamed to disk.
+  """
   skip = 0
   data = []
   while True:
     if verbose: print(f"Scraping {skip} to {skip + limit}")
-    results = scrape_single(subevent_id, sort=sort, age_group=age_group, skip=skip, limit=limit)
-    # A failed request will return None.
-    if results is None:
-      return None
+    if skip == 0 and first is not None:
+      results = first
+    else:
+      results = scrape_single(subevent_id, sort=sort, age_group=age_group, skip=skip, limit=limit)
     data.extend(results["data"])
     skip += limit
     # Stop once we have all the results.
@@ -61,13 +104,415 @@ def scrape(
   return dict(total=results["total"], data=data)
 
 
-def pipeline(subevent_id: str):
-  """Downloads the results of a subevent and saves them to a file."""
+async def scrape_single_async(
+  session: aiohttp.ClientSession,
+  subevent_id: str,
+  sort: str = "FinishRankOverall",
+  age_group: None | str = None,
+  skip: int = 0,
+  limit: int = 100,
+  backoff: Backoff = Backoff(),
+) -> dict:
+  """Same as `scrape_single`, but uses a shared (pooled) `aiohttp` session.
+
+  `--async` mode doesn't go through `ratelimit.py`, so the page is retried the same
+  way here: a throttled response (429 or 503) is retried after its `Retry-After`
+  (up to the `retries` of the host's controller), and if the page still fails, it's
+  retried like a job (see `job.Backoff`).
+  """
+  url = f"{COMPETITOR_API_URL}/public/result/subevent/{subevent_id}"
+  params = {
+    "$limit": limit,
+    "$skip": skip,
+    f"$sort[{sort}]": 1,
+  }
+  # Unlike `requests`, `aiohttp` doesn't drop parameters that are None.
+  if age_group is not None:
+    params["AgeGroup"] = age_group
+
+  attempt = 0
+  while True:
+    attempt += 1
+    try:
+      body = await get_async(session, url, params, retries=ratelimit.controller(url).retries)
+      return parse_page(body, subevent_id)
+    except Exception:
+      if attempt > backoff.retries:
+        raise
+      await asyncio.sleep(backoff.wait(attempt))
+
+
+async def get_async(session: aiohttp.ClientSession, url: str, params: dict, retries: int = 0) -> bytes:
+  """Gets a page of results, and retries it (after the `Retry-After`) if it's throttled. Returns the body."""
+  for attempt in range(retries + 1):
+    with METRICS.request("result_page") as r:
+      async with session.get(url, params=params, headers={"wtc_priv_key": API_KEY}) as response:
+        body = await response.read()
+        r.status, r.bytes = response.status, len(body)
+    if response.status not in ratelimit.THROTTLED or attempt == retries:
+      break
+    await asyncio.sleep(min(ratelimit.retry_after(response) or ratelimit.DEFAULT_PAUSE, ratelimit.MAX_PAUSE))
+  if response.status != 200:
+    raise ValueError(f"{response.url} responded with status code {response.status}.")
+  return body
+
+
+async def scrape_async(
+  session: aiohttp.ClientSession,
+  subevent_id: str,
+  sort: str = "FinishRankOverall",
+  age_group: None | str = None,
+  limit: int = 100,
+  verbose: bool = False,
+  first: dict | None = None,
+  backoff: Backoff = Backoff(),
+) -> dict:
+  """Scrapes all the results for a subevent by fetching the pages concurrently.
+
+  The first page tells us the `total`, so after that we know every `$skip` offset
+  and can request the remaining pages at the same time. If the `first` page has
+  already been requested, it is reused.
+  """
+  if first is None:
+    first = await scrape_single_async(session, subevent_id, sort=sort, age_group=age_group, skip=0, limit=limit, backoff=backoff)
+
+  skips = list(range(limit, first["total"], limit))
+  if verbose: print(f"Scraping {len(skips) + 1} pages of {subevent_id} concurrently")
+
+  pages = await asyncio.gather(*[
+    scrape_single_async(session, subevent_id, sort=sort, age_group=age_group, skip=skip, limit=limit, backoff=backoff)
+    for skip in skips
+  ])
+
+  # The pages come back in the same order as `skips`, so the rows stay sorted.
+  data = first["data"]
+  for page in pages:
+    data.extend(page["data"])
+
+  return dict(total=first["total"], data=data)
+
+
+class PartialResults:
+  """The pages of a subevent that have been downloaded so far, streamed to disk as they arrive.
+
+  The rows of each page are appended to `<id>.ndjson.part` (one per line), and then
+  `<id>.ndjson.skip` records the `$skip` of the next page and the size of the part
+  file. If a download is interrupted, the next one picks up after the last committed
+  page (and drops anything that was written after it). Once every page is in,
+  `finalize` writes the usual `<id>.json` through a temporary file. Only one page
+  is held in memory at a time.
+  """
+  def __init__(
+    self,
+    subevent_id: str,
+    sort: str = "FinishRankOverall",
+    age_group: None | str = None,
+    limit: int = 100,
+    folder: str | None = None,
+  ):
+    folder = folder or data_folder("im/json")
+    self.subevent_id = subevent_id
+    self.path = os.path.join(folder, f"{subevent_id}.ndjson.part")
+    self.checkpoint_path = os.path.join(folder, f"{subevent_id}.ndjson.skip")
+    self.final_path = os.path.join(folder, f"{subevent_id}.json")
+    self.params = dict(sort=sort, age_group=age_group, limit=limit)
+    self.clear()
+    self.load()
+
+  def clear(self):
+    self.skip = 0
+    self.total: int | None = None
+    self.bytes = 0
+    self.first_page_hash: str | None = None
+    self.hasher = ContentHasher()
+
+  def load(self):
+    """Picks up from the checkpoint of an interrupted download (if it used the same parameters)."""
+    if not os.path.exists(self.checkpoint_path) or not os.path.exists(self.path):
+      return
+    with open(self.checkpoint_path, "r") as f:
+      checkpoint = json.load(f)
+    if checkpoint["params"] != self.params or os.path.getsize(self.path) < checkpoint["bytes"]:
+      return
+
+    with open(self.path, "r+b") as f:
+      # Anything after the last commit is part of a page that wasn't committed.
+      f.truncate(checkpoint["bytes"])
+      for line in f:
+        self.hasher.update([json.loads(line)])
+    self.skip, self.total, self.bytes = checkpoint["skip"], checkpoint["total"], checkpoint["bytes"]
+    self.first_page_hash = checkpoint["first_page_hash"]
+
+  def matches(self, first: dict) -> bool:
+    """Returns True if the pages so far are consistent with a (new) first page of results."""
+    return self.skip == 0 or (first["total"] == self.total and content_hash(first["data"]) == self.first_page_hash)
+
+  def reset(self):
+    """Starts over (e.g if the results changed since the pages so far were downloaded)."""
+    self.clear()
+    for path in (self.path, self.checkpoint_path):
+      if os.path.exists(path):
+        os.remove(path)
+
+  def commit(self, page: dict):
+    """Appends the next page of results, and then records that it's safely on disk."""
+    rows = page["data"]
+    with METRICS.stage("serialize"):
+      body = "".join(json.dumps(row) + "\n" for row in rows).encode("utf-8")
+      with open(self.path, "r+b" if os.path.exists(self.path) else "wb") as f:
+        f.seek(self.bytes)
+        f.truncate()
+        f.write(body)
+
+      self.hasher.update(rows)
+      if self.skip == 0:
+        self.first_page_hash = content_hash(rows)
+      self.skip += self.params["limit"]
+      self.total = page["total"]
+      self.bytes += len(body)
+
+      checkpoint = dict(params=self.params, skip=self.skip, total=self.total, bytes=self.bytes, first_page_hash=self.first_page_hash)
+      with open(self.checkpoint_path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+      os.replace(self.checkpoint_path + ".tmp", self.checkpoint_path)
+
+  @property
+  def complete(self) -> bool:
+    return self.total is not None and self.skip >= self.total
+
+  def finalize(self) -> dict:
+    """Writes `<id>.json` (`{"total": ..., "data": [...]}`, indented by 2) and removes the partial files.
+
+    Returns the `total`, `hash` and `first_page_hash` of the results (see `Manifest.record_hashes`).
+    """
+    tmp = self.final_path + ".tmp"
+    with METRICS.stage("serialize"), open(self.path, "rb") as src, open(tmp, "w") as out:
+      out.write(f'{{\n  "total": {json.dumps(self.total)},\n  "data": [')
+      for i, line in enumerate(src):
+        row = json.dumps(json.loads(line), indent=2).replace("\n", "\n    ")
+        out.write((",\n    " if i else "\n    ") + row)
+      out.write("\n  ]\n}" if self.hasher.rows else "]\n}")
+    # Only replace the old file once the new one is complete.
+    os.replace(tmp, self.final_path)
+    os.remove(self.path)
+    os.remove(self.checkpoint_path)
+
+    METRICS.set("subevent_rows", self.hasher.rows, subevent=self.subevent_id)
+    METRICS.inc("rows_total", self.hasher.rows)
+    return dict(total=self.total, hash=self.hasher.hexdigest(), first_page_hash=self.first_page_hash, limit=self.params["limit"])
+
+
+def scrape_to_file(
+  subevent_id: str,
+  sort: str = "FinishRankOverall",
+  age_group: None | str = None,
+  limit: int = 100,
+  verbose: bool = False,
+  first: dict | None = None,
+  folder: str | None = None,
+) -> dict:
+  """Scrapes all the results for a subevent by paginating, and streams them to `im/json/<id>.json` (or `folder`).
+
+  If an earlier download of the subevent was interrupted, this picks up from its last
+  page. A failed request raises (and the pages so far are kept for the next attempt).
+  Returns the hashes of the results (see `PartialResults.finalize`).
+  """
+  return download_pages(subevent_id, sort, age_group, limit, verbose, first, folder).finalize()
+
+
+def download_pages(
+  subevent_id: str,
+  sort: str = "FinishRankOverall",
+  age_group: None | str = None,
+  limit: int = 100,
+  verbose: bool = False,
+  first: dict | None = None,
+  folder: str | None = None,
+) -> PartialResults:
+  """Downloads (or resumes) every page of a subevent into its part file, and returns it ready to `finalize`."""
+  partial = PartialResults(subevent_id, sort=sort, age_group=age_group, limit=limit, folder=folder)
+  if first is not None and not partial.matches(first):
+    partial.reset()
+  if verbose and partial.skip > 0: print(f"Resuming {subevent_id} from {partial.skip}")
+
+  while not partial.complete:
+    if verbose: print(f"Scraping {partial.skip} to {partial.skip + limit}")
+    if partial.skip == 0 and first is not None:
+      page = first
+    else:
+      page = scrape_single(subevent_id, sort=sort, age_group=age_group, skip=partial.skip, limit=limit)
+    if partial.total is not None and page["total"] != partial.total:
+      # The results changed since the pages so far were downloaded, so start over.
+      partial.reset()
+      first = None
+      continue
+    partial.commit(page)
+
+  return partial
+
+
+async def scrape_to_file_async(
+  session: aiohttp.ClientSession,
+  subevent_id: str,
+  sort: str = "FinishRankOverall",
+  age_group: None | str = None,
+  limit: int = 100,
+  verbose: bool = False,
+  first: dict | None = None,
+  window: int = 8,
+  backoff: Backoff = Backoff(),
+) -> dict:
+  """Same as `scrape_to_file`, but requests the remaining pages concurrently.
+
+  The pages are committed in order, each as soon as it and every page before it
+  have arrived. At most `window` pages are requested ahead of the last committed
+  one, so a slow page holds back a bounded number of pages in memory. Each page is
+  retried with `backoff` (see `scrape_single_async`), and if it still fails, the
+  pages before it are kept.
+  """
+  partial = PartialResults(subevent_id, sort=sort, age_group=age_group, limit=limit)
+  if first is not None and not partial.matches(first):
+    await asyncio.to_thread(partial.reset)
+
+  while not partial.complete:
+    if partial.skip == 0:
+      if first is None:
+        first = await scrape_single_async(session, subevent_id, sort=sort, age_group=age_group, skip=0, limit=limit, backoff=backoff)
+      await asyncio.to_thread(partial.commit, first)
+      first = None
+
+    skips = range(partial.skip, partial.total, limit)
+    if verbose: print(f"Scraping {len(skips)} pages of {subevent_id}, {window} at a time")
+    remaining = iter(skips)
+    tasks: deque[asyncio.Future] = deque()
+
+    def fill():
+      for skip in islice(remaining, window - len(tasks)):
+        tasks.append(asyncio.ensure_future(
+          scrape_single_async(session, subevent_id, sort=sort, age_group=age_group, skip=skip, limit=limit, backoff=backoff)
+        ))
+
+    try:
+      fill()
+      while tasks:
+        page = await tasks.popleft()
+        if page["total"] != partial.total:
+          # The results changed since the pages so far were downloaded, so start over.
+          await asyncio.to_thread(partial.reset)
+          break
+        await asyncio.to_thread(partial.commit, page)
+        fill()
+    finally:
+      # Don't leave requests running (or their exceptions unretrieved) if one of them failed.
+      for task in tasks:
+        task.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
+
+  return await asyncio.to_thread(partial.finalize)
+
+
+def fetch_pages(subevent_id: str, manifest: Manifest | None = None, limit: int = 100, folder: str | None = None) -> int | None:
+  """Downloads the pages of a subevent into its part file (the I/O phase of a `job.HybridJob`).
+
+  Like `scrape_to_file`, each page is committed as it arrives (so memory stays flat,
+  and a failed page resumes from there), but the results file isn't written. If a
+  `manifest` is given, the subevent is being refreshed, and None is returned if its
+  results haven't changed. Otherwise, returns the total number of results.
+  """
+  first = None
+  if manifest is not None:
+    first = scrape_single(subevent_id, limit=limit)
+    if manifest.unchanged(subevent_id, first, limit=limit):
+      manifest.touch(subevent_id)
+      return None
+  return download_pages(subevent_id, limit=limit, first=first, folder=folder).total
+
+
+def parse_pages(total: int | None, subevent_id: str, limit: int = 100, folder: str | None = None) -> dict | None:
+  """Writes the results file from the part file that `fetch_pages` downloaded (the CPU phase of a `job.HybridJob`).
+
+  Returns the hashes of the results (see `PartialResults.finalize`), or None if nothing was downloaded.
+  """
+  if total is None:
+    return None
+  partial = PartialResults(subevent_id, limit=limit, folder=folder)
+  if not partial.complete:
+    raise ValueError(f"The pages of {subevent_id} haven't all been downloaded.")
+  return partial.finalize()
+
+
+def pipeline(subevent_id: str, manifest: Manifest | None = None, first: dict | None = None):
+  """Downloads the results of a subevent and streams them to a file."""
   print(f"Scraping {subevent_id}")
-  data = scrape(subevent_id)
-  filepath = data_folder(f"im/json/{subevent_id}.json")
-  with open(filepath, "w") as file:
-    json.dump(data, file, indent=2)
+  hashes = scrape_to_file(subevent_id, first=first)
+  if manifest is not None:
+    manifest.record_hashes(subevent_id, **hashes)
+
+
+def refresh_pipeline(subevent_id: str, manifest: Manifest) -> bool:
+  """Re-downloads the results of a subevent, but only if they have changed.
+
+  Only the first page is requested to check for changes. Returns True if the
+  subevent was downloaded again.
+  """
+  first = scrape_single(subevent_id)
+  if manifest.unchanged(subevent_id, first):
+    manifest.touch(subevent_id)
+    return False
+  pipeline(subevent_id, manifest=manifest, first=first)
+  return True
+
+
+async def pipeline_async(
+  session: aiohttp.ClientSession,
+  semaphore: asyncio.Semaphore,
+  subevent_id: str,
+  manifest: Manifest | None = None,
+  refresh: bool = False,
+  backoff: Backoff = Backoff(),
+):
+  """Same as `pipeline` (or `refresh_pipeline`), but downloads the pages of the subevent concurrently."""
+  async with semaphore:
+    first = None
+    if refresh:
+      first = await scrape_single_async(session, subevent_id, backoff=backoff)
+      if manifest.unchanged(subevent_id, first):
+        manifest.touch(subevent_id)
+        return
+    print(f"Scraping {subevent_id}")
+    hashes = await scrape_to_file_async(session, subevent_id, first=first, backoff=backoff)
+  if manifest is not None:
+    manifest.record_hashes(subevent_id, **hashes)
+
+
+async def await_async_jobs(
+  subevent_ids: list[str],
+  connections: int = 16,
+  manifest: Manifest | None = None,
+  refresh: set[str] | None = None,
+  backoff: Backoff = Backoff(),
+) -> list[tuple[str, Exception | None]]:
+  """Downloads all of the subevents using one pooled client.
+
+  All of the subevents share the same connection pool, so we only pay for the
+  TCP and TLS handshakes `connections` times rather than once per page. The
+  subevents in `refresh` are only downloaded again if they have changed. Each
+  page is retried with `backoff` (like the jobs of the threaded mode).
+  """
+  connector = aiohttp.TCPConnector(limit=connections)
+  # Limit the number of subevents in flight so that we don't hold all of them in memory.
+  semaphore = asyncio.Semaphore(connections)
+
+  async with aiohttp.ClientSession(connector=connector) as session:
+    results = await asyncio.gather(
+      *[
+        pipeline_async(session, semaphore, subevent_id, manifest=manifest, refresh=subevent_id in (refresh or ()), backoff=backoff)
+        for subevent_id in subevent_ids
+      ],
+      return_exceptions=True,
+    )
+
+  return [(subevent_id, r if isinstance(r, Exception) else None) for subevent_id, r in zip(subevent_ids, results)]
 
 
 def finished_jobs() -> list[str]:
@@ -84,24 +529,107 @@ def main():
   """Scrapes all the subevents in the `im/subevents.csv` file."""
   from argparse import ArgumentParser
   parser = ArgumentParser()
-  parser.add_argument("--t", type=int, default=4)
+  parser.add_argument("--t", type=int, default=None,
+                      help="The number of threads to use (default: enough for --max-concurrency, since the requests are paced anyway)")
+  parser.add_argument("--retries", type=int, default=2, help="How many times to retry a failed job (with exponential backoff)")
+  parser.add_argument("--async", dest="use_async", action="store_true",
+                      help="Use asyncio with one pooled client and fetch the pages of each subevent concurrently")
+  parser.add_argument("--connections", type=int, default=16, help="The size of the connection pool in --async mode (which isn't paced by ratelimit.py)")
+  parser.add_argument("--p", type=int, default=0,
+                      help="Decode and write the results on this many processes, while the --t threads only download")
+  parser.add_argument("--refresh", action="store_true",
+                      help="Also check the subevents that have already been scraped, and re-download the ones that changed")
+  parser.add_argument("--metrics", type=str, default=metrics_path("scrape_im_results"),
+                      help="Where to write the metrics of the run (Prometheus text if it ends in .prom, JSON otherwise)")
+  parser.add_argument("--cache", choices=http_cache.MODES, default="on",
+                      help="How to use the HTTP cache: 'refresh' revalidates every page, and 'offline' replays pages without the network (--async doesn't use the cache)")
+  parser.add_argument("--max-concurrency", type=int, default=ratelimit.DEFAULT_MAX_CONCURRENCY,
+                      help="The most requests to have in flight to a host (the limit adapts to the latency and errors below this)")
+  parser.add_argument("--rate", type=float, default=None,
+                      help="The most requests per second to send to a host (default: see ratelimit.DEFAULT_RATES)")
   args = parser.parse_args()
 
+  cache = http_cache.configure(mode=args.cache)
+  ratelimit.configure(max_concurrency=args.max_concurrency, rate=args.rate)
+  t = args.t or args.max_concurrency
+
   df = pd.read_csv(tasks_folder("im/subevents.csv"))
+  manifest = Manifest()
 
   # Get a set of the subevent IDs that we've already scraped.
+  all_ids = set(df.subevent_id.unique().tolist())
   done = finished_jobs()
-  todo = set(df.subevent_id.unique().tolist()) - set(done)
+  todo = all_ids - set(done)
+  refresh = (all_ids & set(done)) if args.refresh else set()
+
+  if args.refresh:
+    print(f"Found {len(done)} subevents that have already been scraped. Will check {len(refresh)} of them for changes.")
+  else:
+    print(f"Found {len(done)} subevents that have already been scraped. If you want to check them for changes, use the --refresh flag.")
+
+  if args.use_async:
+    print(f"We have {len(todo)} remaining subevents to process. Will use {args.connections} pooled connections.")
+
+    try:
+      subevent_ids = list(todo) + list(refresh)
+      results = asyncio.run(await_async_jobs(subevent_ids, connections=args.connections, manifest=manifest, refresh=refresh,
+                                             backoff=Backoff(retries=args.retries)))
+    finally:
+      manifest.save()
+      METRICS.write(args.metrics)
+      print(METRICS.summary())
+
+    for subevent_id, reason in results:
+      if reason is not None:
+        print(f"Job (args={(subevent_id,)}) failed with exception: {reason}.")
+
+    print("DONE")
+    return
+
+  if args.p > 0:
+    print(f"We have {len(todo)} remaining subevents to process. Will download on {t} threads and parse on {args.p} processes.")
+
+    # The subevents that are being refreshed are only downloaded again if they have changed.
+    jobs = [HybridJob(fetch_pages, parse_pages, (subevent_id,)) for subevent_id in todo]
+    jobs += [HybridJob(fetch_pages, parse_pages, (subevent_id,), dict(manifest=manifest)) for subevent_id in refresh]
+
+    failed = 0
+    try:
+      for i, r in enumerate(stream_hybrid_jobs(jobs, t=t, p=args.p, backoff=Backoff(retries=args.retries), name="scrape"), start=1):
+        if r.status != JobStatus.FULFILLED:
+          failed += 1
+          print(f"Job (args={r.args}) failed after {r.attempts} attempts with exception: {r.reason}.")
+        elif r.value is not None:
+          manifest.record_hashes(r.args[0], **r.value)
+        print(f"[{i}/{len(jobs)}] Finished {r.args[0]} in {r.elapsed:.1f}s ({failed} failed so far)")
+    finally:
+      manifest.save()
+      cache.save()
+      METRICS.write(args.metrics)
+      print(METRICS.summary())
+
+    print("DONE")
+    return
 
-  print(f"Found {len(done)} subevents that have already been scraped. If you want to re-scrape them, delete the files.")
-  print(f"We have {len(todo)} remaining subevents to process. Will use {args.t} threads.")
+  print(f"We have {len(todo)} remaining subevents to process. Will use {t} threads.")
 
   # Jobs are tagged with the subevent ID as a UID so that we can identify them later.
-  results = await_pooled_jobs([Job(pipeline, (subevent_id,)) for subevent_id in todo], t=args.t)
+  jobs = [Job(pipeline, (subevent_id,), dict(manifest=manifest)) for subevent_id in todo]
+  jobs += [Job(refresh_pipeline, (subevent_id,), dict(manifest=manifest)) for subevent_id in refresh]
 
-  for r in results:
-    if r.status != JobStatus.FULFILLED:
-      print(f"Job (args={r.args}) failed with exception: {r.reason}.")
+  # Each job saves its own file, so we only need to report progress as they finish.
+  failed = 0
+  try:
+    for i, r in enumerate(stream_pooled_jobs(jobs, t=t, backoff=Backoff(retries=args.retries), name="scrape"), start=1):
+      if r.status != JobStatus.FULFILLED:
+        failed += 1
+        print(f"Job (args={r.args}) failed after {r.attempts} attempts with exception: {r.reason}.")
+      print(f"[{i}/{len(jobs)}] Finished {r.args[0]} in {r.elapsed:.1f}s ({failed} failed so far)")
+  finally:
+    manifest.save()
+    cache.save()
+    METRICS.write(args.metrics)
+    print(METRICS.summary())
 
   print("DONE")
 
@@ -1,66 +1,108 @@
 import sys; sys.path.extend([".", "..", "../.."])
 
 from bs4 import BeautifulSoup
-import requests
 import pandas as pd
 import os
 
-from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 
 from utils.paths import tasks_folder
-from job import Job, JobStatus, await_pooled_jobs
-
-_lock = Lock() # Lock for writing to the CSV file.
+from job import Backoff, HybridJob, Job, JobStatus, stream_hybrid_jobs, stream_pooled_jobs
+from metrics import METRICS, metrics_path
+import http_cache
+import ratelimit
 
 
 API_KEY = os.getenv("API_KEY")
 if API_KEY is None:
   raise EnvironmentError('Please set the `API_KEY` environment variable before running this script.')
 
+# Override these to point the crawler at other servers (e.g `benchmarks/mock_api.py`).
+COMPETITOR_API_URL = os.getenv("COMPETITOR_API_URL", "https://api.competitor.com").rstrip("/")
+IRONMAN_URL = os.getenv("IRONMAN_URL", "https://www.ironman.com").rstrip("/")
 
-def crawl(url) -> list[tuple[str, str]]:
-  """Get the subevent IDs from a main event page.
-  
-  Returns
-  -------
-  A list of tuples, where the first element is the subevent ID and the second is the year of the event.
-  """
-  r = requests.get(url)
 
+def fetch_html(url: str, endpoint: str = "tab") -> bytes:
+  """Gets a page of ironman.com (through the HTTP cache), and returns the raw body. Raises if the request fails."""
+  print("Scraping URL:", url)
+  r = http_cache.default_cache().get(url, endpoint=endpoint, timeout=None if endpoint == "race_page" else 10)
   if r.status_code != 200:
     raise ValueError(f"{url} responded with status code {r.status_code}.")
+  return r.content
+
 
-  # First, we look for all of the "tab-remote" objects, which point to the results
-  # for a given year. These will have a relative URL like:
-  # /layout_container/show_layout_tab?layout_container_id=100774644&page_node_id=6280763&tab_element_id=303164
-  subevent_urls = []
-  soup = BeautifulSoup(r.text, "html.parser")
-  for a in soup.find_all("a", class_="tab-remote"):
-    subevent_urls.append(f'https://www.ironman.com{a["href"]}')
+def parse_tab_urls(html: bytes, url: str) -> list[str]:
+  """Finds the "tab-remote" URLs on a main event page, which point to the results for a given year.
+
+  These will have a relative URL like:
+  /layout_container/show_layout_tab?layout_container_id=100774644&page_node_id=6280763&tab_element_id=303164
+  """
+  with METRICS.stage("parse_html"):
+    soup = BeautifulSoup(html, "html.parser")
+    subevent_urls = [f'{IRONMAN_URL}{a["href"]}' for a in soup.find_all("a", class_="tab-remote")]
 
   if len(subevent_urls) == 0:
     raise ValueError(f"No subevent URLs found on {url}. Check this page manually to see what's going on.")
 
-  # Next, we visit each subevent URL and extract the subevent ID from the <iframe> that is loaded.
-  info = []
-  for url in subevent_urls:
-    print("Scraping URL:", url)
-    r = requests.get(url, timeout=10)
-    soup = BeautifulSoup(r.text, "html.parser")
+  return subevent_urls
 
+
+def parse_subevent_id(html: bytes, url: str = "") -> str | None:
+  """Gets the subevent ID from the <iframe> on a results tab (or None if there isn't one, e.g on a TriClub results tab)."""
+  with METRICS.stage("parse_html"):
+    soup = BeautifulSoup(html, "html.parser")
     iframe = soup.find("iframe")
 
-    # Sometimes there won't be an <iframe> because of a TriClub results tab.
-    if iframe is not None:
-      subevent_id = iframe["src"].split("/")[-1]
-      r = requests.get(
-        f"https://api.competitor.com/public/events/{subevent_id}",
-        headers={"wtc_priv_key": API_KEY},
-        timeout=10,
-      )
-      year = r.json()["EventYear"]
+  # Sometimes there won't be an <iframe> because of a TriClub results tab.
+  if iframe is None:
+    return None
+
+  return iframe["src"].split("/")[-1]
+
+
+def lookup_year(subevent_id: str | None, url: str = "") -> tuple[str, str] | None:
+  """Looks up the year of a subevent (or returns None if there's no subevent)."""
+  if subevent_id is None:
+    return None
+
+  # The year of a subevent never changes once it's set, so it's cached forever (but not while it's null).
+  r = http_cache.default_cache().get(
+    f"{COMPETITOR_API_URL}/public/events/{subevent_id}",
+    headers={"wtc_priv_key": API_KEY},
+    endpoint="event",
+    timeout=10,
+    keep=lambda r: r.json().get("EventYear") is not None,
+  )
+  with METRICS.stage("parse"):
+    year = r.json()["EventYear"]
+
+  return (subevent_id, year)
+
+
+def crawl_tab(url: str) -> tuple[str, str] | None:
+  """Get the subevent ID and year from one of the "tab-remote" URLs on a main event page.
+
+  Returns None if the tab doesn't contain an <iframe> (e.g it's a TriClub results tab).
+  """
+  return lookup_year(parse_subevent_id(fetch_html(url, endpoint="tab"), url), url)
+
 
-      info.append((iframe["src"].split("/")[-1], year))
+def crawl(url, t: int = 8) -> list[tuple[str, str]]:
+  """Get the subevent IDs from a main event page.
+
+  The tabs (and the year lookup for each subevent) are fetched concurrently using
+  up to `t` threads.
+  
+  Returns
+  -------
+  A list of tuples, where the first element is the subevent ID and the second is the year of the event.
+  """
+  subevent_urls = parse_tab_urls(fetch_html(url, endpoint="race_page"), url)
+
+  # Next, we visit each subevent URL and extract the subevent ID from the <iframe> that is loaded.
+  # Note that `map` keeps the tabs in the same order as they appear on the page.
+  with ThreadPoolExecutor(max_workers=min(t, len(subevent_urls))) as executor:
+    info = [i for i in executor.map(crawl_tab, subevent_urls) if i is not None]
 
   if len(info) == 0:
     raise ValueError(f"No subevent IDs could be parsed from {url}. Check this page manually to see what's going on.")
@@ -68,58 +110,140 @@ def crawl(url) -> list[tuple[str, str]]:
   return info
 
 
-def pipeline(row: dict):
-  """Process a row of the spreadsheet."""
+def crawl_all(
+  urls: list[str],
+  t: int = 8,
+  p: int | None = None,
+  backoff: Backoff | None = None,
+) -> dict[str, list[tuple[str, str]] | Exception]:
+  """Same as calling `crawl` on each URL, but the pages are downloaded on `t` threads and parsed on `p` processes.
+
+  The race pages are crawled first, and then all of their tabs at once (see
+  `job.stream_hybrid_jobs`). Returns the subevents of each URL (in the order of its
+  tabs), or the exception that stopped it from being crawled.
+  """
+  out: dict[str, list[tuple[str, str]] | Exception] = {}
+
+  tabs = {}
+  jobs = [HybridJob(fetch_html, parse_tab_urls, (url,), dict(endpoint="race_page")) for url in urls]
+  for r in stream_hybrid_jobs(jobs, t=t, p=p, backoff=backoff, name="race_pages"):
+    if r.status == JobStatus.FULFILLED:
+      tabs[r.args[0]] = r.value
+    else:
+      out[r.args[0]] = r.reason
+
+  found = {}
+  jobs = [HybridJob(fetch_html, parse_subevent_id, (tab,), dict(endpoint="tab"), then=lookup_year) for url in tabs for tab in tabs[url]]
+  for r in stream_hybrid_jobs(jobs, t=t, p=p, backoff=backoff, name="tabs"):
+    found[r.args[0]] = r.value if r.status == JobStatus.FULFILLED else r.reason
+
+  for url, tab_urls in tabs.items():
+    errors = [found[tab] for tab in tab_urls if isinstance(found[tab], Exception)]
+    info = [found[tab] for tab in tab_urls if found[tab] is not None and not isinstance(found[tab], Exception)]
+    if errors:
+      out[url] = errors[0]
+    elif len(info) == 0:
+      out[url] = ValueError(f"No subevent IDs could be parsed from {url}. Check this page manually to see what's going on.")
+    else:
+      out[url] = info
+
+  return out
+
+
+def subevent_rows(row: dict, subevent_info: list[tuple[str, str]]) -> list[dict]:
+  """Returns the rows for `subevents.csv` (one for each year's event) of a row of the spreadsheet."""
+  return [
+    dict(subevent_id=id, results_url=row["results_url"], name=row["name"], series=row["series"], year=int(year))
+    for (id, year) in subevent_info
+  ]
+
+
+def pipeline(row: dict, t: int = 8) -> list[dict]:
+  """Process a row of the spreadsheet.
+
+  Returns a list of rows for `subevents.csv` (one for each year's event).
+  """
   name = row["name"]
   series = row["series"]
   results_url = row["results_url"]
 
   print("-------------------------------------")
   print("Processing", name, series, results_url)
-  subevent_info = crawl(results_url)
+  subevent_info = crawl(results_url, t=t)
 
   print(f"Found {len(subevent_info)} subevents")
 
-  df = dict(subevent_id=[], results_url=[], name=[], series=[], year=[])
+  return subevent_rows(row, subevent_info)
 
-  # Make a small dataframe with the info about each year's event.
-  for (id, year) in subevent_info:
-    df["subevent_id"].append(id)
-    df["results_url"].append(results_url) 
-    df["name"].append(name)
-    df["series"].append(series)
-    df["year"].append(int(year))
 
-  if len(df) == 0:
-    return
+class SubeventWriter:
+  """Collects the rows found by `pipeline` and merges them into `subevents.csv`.
 
-  print("Writing CSV")
-  with _lock:
-    # If the file already exists, we need to merge the new data with the old data.
-    merged = pd.DataFrame(df)
+  Rather than rewriting the CSV after every race, rows are buffered and merged
+  into the file every `checkpoint` races (and when `flush` is called). The writer
+  is only used from the main thread, so it doesn't need a lock.
+  """
+  def __init__(self, path: str = tasks_folder("im/subevents.csv"), checkpoint: int = 25):
+    self.path = path
+    self.checkpoint = checkpoint
+    self.rows: list[dict] = []
+    self.races = 0
+
+  def add(self, rows: list[dict]):
+    """Adds the rows for one race, flushing them to disk if we've reached a checkpoint."""
+    self.rows.extend(rows)
+    self.races += 1
+    if self.checkpoint and self.races % self.checkpoint == 0:
+      self.flush()
+
+  def flush(self):
+    """Merges the buffered rows with the existing CSV file."""
+    if len(self.rows) == 0:
+      return
+
+    print("Writing CSV")
+    merged = pd.DataFrame(self.rows)
 
-    if os.path.exists(tasks_folder("im/subevents.csv")):
-      existing = pd.read_csv(tasks_folder("im/subevents.csv"))
+    # If the file already exists, we need to merge the new data with the old data.
+    if os.path.exists(self.path):
+      existing = pd.read_csv(self.path)
       before = len(existing)
       merged = pd.concat([existing, merged]).drop_duplicates()
       after = len(merged)
-      print(f"Merged {before} existing subevents with {len(df)} new subevents. Now we have {after} subevents.")
-    
+      print(f"Merged {before} existing subevents with {len(self.rows)} new subevents. Now we have {after} subevents.")
+
     # Ensure that the year is an integer.
     merged.year = merged.year.astype(int)
-    merged.to_csv(tasks_folder("im/subevents.csv"), index=False)
-  print("DONE")
+    merged.to_csv(self.path, index=False)
+    self.rows = []
 
 
 def main():
   """For each Ironman race, find the subevent ID for each year that the race is held."""
   from argparse import ArgumentParser
   parser = ArgumentParser()
-  parser.add_argument("--t", type=int, default=4, help="The number of threads to use")
+  parser.add_argument("--t", type=int, default=None,
+                      help="The number of threads to use (default: enough for --max-concurrency, since the requests are paced anyway)")
+  parser.add_argument("--retries", type=int, default=2, help="How many times to retry a failed job (with exponential backoff)")
+  parser.add_argument("--tab-t", type=int, default=8, help="The number of threads to use for the tabs of each race")
+  parser.add_argument("--p", type=int, default=0,
+                      help="Parse the pages on this many processes, while --t threads download the pages of every race")
+  parser.add_argument("--checkpoint", type=int, default=25, help="Merge the new subevents into the CSV file every this many races")
   parser.add_argument("--skip-existing", action="store_true",
                       help="Skip races that have already been scraped. Don't use this if you want to get all of the latest data.")
+  parser.add_argument("--metrics", type=str, default=metrics_path("scrape_im_subevents"),
+                      help="Where to write the metrics of the run (Prometheus text if it ends in .prom, JSON otherwise)")
+  parser.add_argument("--cache", choices=http_cache.MODES, default="on",
+                      help="How to use the HTTP cache: 'refresh' revalidates every page, and 'offline' replays pages without the network")
+  parser.add_argument("--max-concurrency", type=int, default=ratelimit.DEFAULT_MAX_CONCURRENCY,
+                      help="The most requests to have in flight to a host (the limit adapts to the latency and errors below this)")
+  parser.add_argument("--rate", type=float, default=None,
+                      help="The most requests per second to send to a host (default: see ratelimit.DEFAULT_RATES)")
   args = parser.parse_args()
 
+  cache = http_cache.configure(mode=args.cache)
+  ratelimit.configure(max_concurrency=args.max_concurrency, rate=args.rate)
+
   # Load in all of the races. For each race, we'll find all of the subevents,
   # which correspond to a year that the race was held.
   df = pd.read_csv(tasks_folder("im/races.csv"))
@@ -135,7 +259,7 @@ def main():
 
   print(f"Will scrape subevent IDs for {len(todo)} remaining races.")
 
-  jobs = [Job(pipeline, args=(row.to_dict(),)) for _, row in todo.iterrows()]
+  jobs = [Job(pipeline, args=(row.to_dict(),), kwargs=dict(t=args.tab_t)) for _, row in todo.iterrows()]
   # jobs = [
   #   Job(pipeline, args=(dict(
   #     name="70.3 World Championship",
@@ -150,11 +274,48 @@ def main():
   # ]
   # 70.3 World Championship,IRONMAN-70.3,https://www.ironman.com/im703-world-championship-2024-results
   # IRONMAN World Championship,IRONMAN,https://www.ironman.com/im-world-championship-kona-results
-  results = await_pooled_jobs(jobs, t=args.t)
+  writer = SubeventWriter(checkpoint=args.checkpoint)
+
+  if args.p > 0:
+    t = args.t or args.max_concurrency
+    print(f"Will download on {t} threads and parse on {args.p} processes.")
+    failed = 0
+    try:
+      rows = todo.to_dict("records")
+      found = crawl_all([row["results_url"] for row in rows], t=t, p=args.p, backoff=Backoff(retries=args.retries))
+      for row in rows:
+        if isinstance(found[row["results_url"]], Exception):
+          failed += 1
+          print(f"Failed to crawl {row['name']} with exception: {found[row['results_url']]}.")
+        else:
+          writer.add(subevent_rows(row, found[row["results_url"]]))
+      print(f"Found the subevents of {len(rows) - failed} races ({failed} failed)")
+    finally:
+      writer.flush()
+      cache.save()
+      METRICS.write(args.metrics)
+      print(METRICS.summary())
+
+    print("DONE")
+    return
 
-  for r in results:
-    if r.status != JobStatus.FULFILLED:
-      print(f"Job (args={r.args}) failed with exception: {r.reason}.")
+  # Each race crawls its tabs on --tab-t threads of its own.
+  t = args.t or max(1, args.max_concurrency // args.tab_t)
+  failed = 0
+  try:
+    for i, r in enumerate(stream_pooled_jobs(jobs, t=t, backoff=Backoff(retries=args.retries), name="races"), start=1):
+      if r.status != JobStatus.FULFILLED:
+        failed += 1
+        print(f"Job (args={r.args}) failed after {r.attempts} attempts with exception: {r.reason}.")
+      else:
+        writer.add(r.value)
+      print(f"[{i}/{len(jobs)}] Finished {r.args[0]['name']} in {r.elapsed:.1f}s ({failed} failed so far)")
+  finally:
+    # Save whatever we found, even if the run is interrupted.
+    writer.flush()
+    cache.save()
+    METRICS.write(args.metrics)
+    print(METRICS.summary())
 
   print("DONE")
 
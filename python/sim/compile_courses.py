@@ -0,0 +1,184 @@
+import sys; sys.path.extend([".", "..", "../.."])
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from utils.paths import courses_folder, data_folder, make_directory
+from simulator import G, M, R, Course, load_course
+
+
+# Bump this if the layout of the compiled files changes, so that they all get rebuilt.
+FORMAT_VERSION = 1
+
+# The distance (in meters) between the samples of a compiled course.
+DEFAULT_SPACING = 1.0
+
+# The columns of a compiled course. Each value is stored with its change to the next
+# sample, so that interpolating between two samples only needs one row.
+COLUMNS = ["baro", "d_baro", "sin", "d_sin", "cos", "d_cos"]
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+def compiled_folder(relative_path: str = "") -> str:
+  """Returns a path relative to the folder of compiled courses."""
+  return data_folder(os.path.join("courses", relative_path))
+
+
+def file_hash(path: str) -> str:
+  with open(path, "rb") as f:
+    return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def resample(course: Course, spacing: float = DEFAULT_SPACING) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+  """Interpolates the altitude and grade of a course at every `spacing` meters (from 0 to past the finish)."""
+  n = int(np.ceil(course.total_distance / spacing)) + 1
+  x = np.arange(n) * spacing
+  return x, np.interp(x, course.x, course.y), np.interp(x, course.x, course.a)
+
+
+def compile_table(course: Course, spacing: float = DEFAULT_SPACING) -> np.ndarray:
+  """Returns an (n, 6) table with the `COLUMNS` of a course at every `spacing` meters.
+
+  The barometric term is `-G * M * y / R`, so the pressure at a temperature `Tk` is
+  `Pb * exp(baro / Tk)`. The values are stored as float32, which is plenty for
+  altitudes and grades, and halves the size of the files.
+  """
+  _, y, a = resample(course, spacing)
+  columns = []
+  for values in ((-G * M / R) * y, np.sin(a), np.cos(a)):
+    columns += [values, np.append(np.diff(values), 0)]
+  return np.ascontiguousarray(np.stack(columns, axis=1), dtype=np.float32)
+
+
+@dataclass
+class CompiledCourse:
+  """A course that was resampled to a uniform grid (see `compile_table`).
+
+  It can be used in place of a `Course` in `simulate_batch`. Finding the sample
+  before a distance is a division, rather than a search.
+  """
+  name: str
+  table: np.ndarray # (n, 6), usually memory-mapped
+  spacing: float
+  total_distance: float
+  meta: dict = field(default_factory=dict)
+
+  def lookup(self, x: np.ndarray, cursor: np.ndarray):
+    """Returns the barometric term and the sin and cos of the grade at each distance in `x` (see `Course.lookup`).
+
+    The `cursor` isn't needed, and is returned as is.
+    """
+    u = np.minimum(np.maximum(x * (1 / self.spacing), 0), len(self.table) - 1)
+    i = np.minimum(u.astype(np.int64), len(self.table) - 2)
+    alpha = u - i
+    rows = np.take(self.table, i, axis=0)
+    return rows[:, 0] + rows[:, 1] * alpha, rows[:, 2] + rows[:, 3] * alpha, rows[:, 4] + rows[:, 5] * alpha, cursor
+
+
+def load_manifest(folder: str) -> dict:
+  path = os.path.join(folder, MANIFEST_FILENAME)
+  if not os.path.exists(path):
+    return {}
+  with open(path, "r") as f:
+    return json.load(f)
+
+
+def save_manifest(folder: str, manifest: dict):
+  """Writes the manifest through a temporary file, so an interrupted run can't leave half of one behind."""
+  path = os.path.join(folder, MANIFEST_FILENAME)
+  make_directory(path)
+  with open(path + ".tmp", "w") as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
+  os.replace(path + ".tmp", path)
+
+
+def compile_course(path: str, folder: str = compiled_folder(), spacing: float = DEFAULT_SPACING) -> dict:
+  """Compiles a course file to `<folder>/<name>.npy`.
+
+  Returns its manifest entry, with the hash of the course file it came from and of
+  the compiled file.
+  """
+  course = load_course(path)
+  table = compile_table(course, spacing)
+
+  out = os.path.join(folder, f"{course.name}.npy")
+  make_directory(out)
+  with open(out + ".tmp", "wb") as f:
+    np.save(f, table)
+  os.replace(out + ".tmp", out)
+
+  return {
+    "v": FORMAT_VERSION,
+    "file": os.path.basename(out),
+    "sha256": file_hash(out),
+    "source_sha256": file_hash(path),
+    "spacing": spacing,
+    "samples": len(table),
+    "total_distance": course.total_distance,
+    "meta": course.meta,
+  }
+
+
+def load_compiled(name: str, folder: str = compiled_folder(), verify: bool = False) -> CompiledCourse:
+  """Loads a compiled course (memory-mapped), given its name (e.g "IM_Boulder_70.3").
+
+  If `verify` is True, the file is checked against the hash in the manifest first.
+  """
+  entry = load_manifest(folder).get(name)
+  if entry is None:
+    raise KeyError(f"{name} hasn't been compiled (run `python compile_courses.py` first).")
+
+  path = os.path.join(folder, entry["file"])
+  if verify and file_hash(path) != entry["sha256"]:
+    raise ValueError(f"{path} doesn't match the hash in the manifest. Compile it again with --force.")
+
+  return CompiledCourse(
+    name=name,
+    # A plain array view of the memory map (indexing an `np.memmap` is much slower).
+    table=np.asarray(np.load(path, mmap_mode="r")),
+    spacing=entry["spacing"],
+    total_distance=entry["total_distance"],
+    meta=entry["meta"],
+  )
+
+
+def main():
+  """Compile the course files in `app/public/courses` for the simulator."""
+  parser = argparse.ArgumentParser(description="Compile the course files in `app/public/courses` for the simulator.")
+  parser.add_argument("--out", type=str, default=compiled_folder(), help="Where to put the compiled courses")
+  parser.add_argument("--spacing", type=float, default=DEFAULT_SPACING, help="The distance between samples (meters)")
+  parser.add_argument("--force", action="store_true", help="Compile every course, even if it hasn't changed")
+  args = parser.parse_args()
+
+  manifest = load_manifest(args.out)
+
+  for path in sorted(glob.glob(courses_folder("*.json"))):
+    name = os.path.basename(path).replace(".json", "")
+    entry = manifest.get(name)
+
+    if (
+      not args.force and entry is not None
+      and entry["v"] == FORMAT_VERSION
+      and entry["spacing"] == args.spacing
+      and entry["source_sha256"] == file_hash(path)
+      and os.path.exists(os.path.join(args.out, entry["file"]))
+    ):
+      print(f"{name} is up to date.")
+      continue
+
+    manifest[name] = compile_course(path, args.out, args.spacing)
+    print(f"Compiled {name} ({manifest[name]['samples']} samples)")
+
+  save_manifest(args.out, manifest)
+  print("DONE")
+
+
+if __name__ == "__main__":
+  main()
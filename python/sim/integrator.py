@@ -0,0 +1,247 @@
+import sys; sys.path.extend([".", "..", "../.."])
+
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from simulator import G, M, R, Pb, Course, Params, broadcast_params, rider_constants
+
+
+# Riders start from a standstill, where stepping by distance doesn't work (dt/dx = 1/v),
+# so the first few meters are integrated in time.
+LAUNCH_DISTANCE = 5.0 # m
+LAUNCH_TIMESTEP = 0.01 # s
+
+# The default error allowed in each step (see `integrate_batch`).
+DEFAULT_TOLERANCE = 1e-4
+
+# The Dormand-Prince 5(4) tableau.
+DP_C = [0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1]
+DP_A = [
+  [],
+  [1 / 5],
+  [3 / 40, 9 / 40],
+  [44 / 45, -56 / 15, 32 / 9],
+  [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+  [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+]
+DP_B = [35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84]
+# The difference between the 5th and 4th order solutions (the last term uses the FSAL stage).
+DP_E = [71 / 57600, 0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40]
+
+
+def acceleration(r: dict, v: np.ndarray, baro, sin_theta, cos_theta) -> np.ndarray:
+  """Returns the acceleration of each rider (the same forces as `simulate`).
+
+  The `velocity_min` override is continuous here: a rider at the minimum velocity
+  puts out just enough power to not slow down.
+  """
+  rho = r["rho_scale"] * (Pb * np.exp(baro * r["inv_Tk"]) - r["humidity_term"])
+  F = r["F_legs"] / np.maximum(v, 1) - r["half_cda"] * rho * v * v - r["g_mass"] * sin_theta - r["g_mass_crr"] * cos_theta
+  a = F / r["mass"]
+  return np.where((v <= r["v_min"]) & (a < 0), 0, a)
+
+
+def course_terms(row: np.ndarray, x: float) -> tuple[float, float, float]:
+  """Returns the barometric term (`-G * M * y / R`) and the sin and cos of the grade at `x` in a segment (see `Course.segments`)."""
+  alpha = min(max((x - row[0]) * row[2], 0), 1)
+  theta = row[5] + row[6] * alpha
+  return (-G * M / R) * (row[3] + row[4] * alpha), np.sin(theta), np.cos(theta)
+
+
+def interpolate_terms(course: Course, x: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+  """Returns the barometric term and the sin and cos of the grade at each distance in `x`."""
+  theta = np.interp(x, course.x, course.a)
+  return (-G * M / R) * np.interp(x, course.x, course.y), np.sin(theta), np.cos(theta)
+
+
+def launch(terms, r: dict) -> tuple[np.ndarray, np.ndarray]:
+  """Integrates each rider from a standstill to `LAUNCH_DISTANCE` (RK4 in time).
+
+  `terms(x)` returns the barometric term and the sin and cos of the grade at each
+  distance in `x` (see `course_terms`). Returns the time and velocity of each rider
+  at exactly `LAUNCH_DISTANCE`.
+  """
+  n = len(r["mass"])
+  x, v, t = np.zeros(n), np.zeros(n), np.zeros(n)
+  t_launch, v_launch = np.full(n, np.nan), np.full(n, np.nan)
+  dt = LAUNCH_TIMESTEP
+
+  def f(x, v):
+    return v, acceleration(r, v, *terms(x))
+
+  for _ in range(100_000):
+    k1x, k1v = f(x, v)
+    k2x, k2v = f(x + dt / 2 * k1x, v + dt / 2 * k1v)
+    k3x, k3v = f(x + dt / 2 * k2x, v + dt / 2 * k2v)
+    k4x, k4v = f(x + dt * k3x, v + dt * k3v)
+    x_next = x + dt / 6 * (k1x + 2 * k2x + 2 * k3x + k4x)
+    v_next = v + dt / 6 * (k1v + 2 * k2v + 2 * k3v + k4v)
+
+    # Interpolate to the moment each rider crosses the launch distance.
+    crossed = np.isnan(t_launch) & (x_next >= LAUNCH_DISTANCE)
+    if crossed.any():
+      frac = (LAUNCH_DISTANCE - x[crossed]) / (x_next[crossed] - x[crossed])
+      t_launch[crossed] = t[crossed] + frac * dt
+      v_launch[crossed] = v[crossed] + frac * (v_next[crossed] - v[crossed])
+      if not np.isnan(t_launch).any():
+        return t_launch, v_launch
+
+    x, v, t = x_next, v_next, t + dt
+
+  raise ValueError("Some riders never got going. Is the power too low for the start of the course?")
+
+
+@dataclass
+class IntegrationResult:
+  finish_time: np.ndarray # (N,) seconds
+  override_time: np.ndarray # (N,) seconds spent at the minimum velocity (i.e above the target power)
+  steps: int # the number of (accepted) steps
+  rejected: int # the number of steps that were rejected and retried with a smaller step
+  x: np.ndarray | None = None # (k,) the distances where the states were recorded
+  t: np.ndarray | None = None # (N, k)
+  v: np.ndarray | None = None # (N, k)
+
+
+def integrate_batch(
+  course: Course,
+  params: Params | None = None,
+  tolerance: float = DEFAULT_TOLERANCE,
+  record_every: float | None = None,
+  max_step: float | None = None,
+  **sweep,
+) -> IntegrationResult:
+  """Simulates N riders on a course by integrating over distance, rather than time.
+
+  The model is the same as `simulate` (and the arrays in `sweep` work the same way
+  as in `simulate_batch`), but:
+  - Every rider is at the same distance at each step, so the course only needs
+    to be looked up once per step, rather than once per rider.
+  - Steps never cross a point of the course, so the forces are smooth within a
+    step, and there are no more steps than there need to be on long, even segments.
+  - The step size is adjusted so that the (estimated) error of each step in the
+    time (s) and velocity (m/s) of every rider is below `tolerance`.
+
+  Steps are at most `max_step` meters, if it's given. The states are recorded every
+  `record_every` meters (and at the finish), or not at all if it's None.
+  """
+  params = params or Params()
+  values, shape = broadcast_params(params, sweep)
+  r = rider_constants(values)
+  if (r["v_min"] <= 0).any():
+    raise ValueError("velocity_min has to be positive when integrating over distance.")
+
+  def f(v, terms):
+    """Returns dt/dx and dv/dx."""
+    v = np.maximum(v, r["v_min"])
+    return 1 / v, acceleration(r, v, *terms) / v
+
+  t, v = launch(lambda x: interpolate_terms(course, x), r)
+  v = np.maximum(v, r["v_min"])
+  override_time = np.zeros_like(t)
+
+  total_distance = course.total_distance
+  if record_every is not None:
+    record_x = np.append(np.arange(0, total_distance, record_every), total_distance)
+    record_t = np.zeros((len(t), len(record_x)))
+    record_v = np.zeros((len(t), len(record_x)))
+    # The launch isn't recorded in detail: assume a constant acceleration.
+    early = record_x <= LAUNCH_DISTANCE
+    record_t[:, early] = t[:, None] * np.sqrt(record_x[early] / LAUNCH_DISTANCE)
+    record_v[:, early] = v[:, None] * np.sqrt(record_x[early] / LAUNCH_DISTANCE)
+    next_record = int(early.sum())
+
+  rows_of = course.segments
+  first = max(0, int(np.searchsorted(course.x, LAUNCH_DISTANCE, side="right")) - 1)
+  x = LAUNCH_DISTANCE
+  h = 1.0
+  steps, rejected = 0, 0
+
+  k_first = None
+  for row in rows_of[first:]:
+    x_end = row[1]
+    if x_end <= x:
+      continue
+
+    k_first = None
+    while x < x_end:
+      h = min(h, x_end - x, max_step or np.inf)
+      if k_first is None:
+        k_first = f(v, course_terms(row, x))
+
+      # The Dormand-Prince stages, for the time and velocity of every rider.
+      ks = [k_first]
+      for c, a in zip(DP_C[1:], DP_A[1:]):
+        v_stage = v + h * sum(a_j * k[1] for a_j, k in zip(a, ks))
+        ks.append(f(v_stage, course_terms(row, x + c * h)))
+
+      t_next = t + h * sum(b * k[0] for b, k in zip(DP_B, ks))
+      v_next = v + h * sum(b * k[1] for b, k in zip(DP_B, ks))
+      k_last = f(v_next, course_terms(row, x + h))
+
+      error_t = h * sum(e * k[0] for e, k in zip(DP_E, ks + [k_last]))
+      error_v = h * sum(e * k[1] for e, k in zip(DP_E, ks + [k_last]))
+      error = max(np.abs(error_t).max(), np.abs(error_v).max()) / tolerance
+
+      if error > 1:
+        h *= max(0.2, 0.9 * error ** -0.2)
+        rejected += 1
+        continue
+
+      clamped = v_next <= r["v_min"]
+      override_time += np.where(clamped, t_next - t, 0)
+      v_next = np.maximum(v_next, r["v_min"])
+
+      if record_every is not None:
+        while next_record < len(record_x) and record_x[next_record] <= x + h:
+          frac = (record_x[next_record] - x) / h
+          record_t[:, next_record] = t + frac * (t_next - t)
+          record_v[:, next_record] = v + frac * (v_next - v)
+          next_record += 1
+
+      x, t, v = x + h, t_next, v_next
+      k_first = k_last if not clamped.any() else None
+      steps += 1
+      h *= min(5, 0.9 * max(error, 1e-10) ** -0.2)
+
+  result = IntegrationResult(
+    finish_time=t.reshape(shape),
+    override_time=override_time.reshape(shape),
+    steps=steps,
+    rejected=rejected,
+  )
+  if record_every is not None:
+    result.x, result.t, result.v = record_x, record_t, record_v
+  return result
+
+
+def integrate(
+  course: Course,
+  params: Params,
+  tolerance: float = DEFAULT_TOLERANCE,
+  record_every: float = 100,
+) -> pd.DataFrame:
+  """Simulates one rider with `integrate_batch`.
+
+  Returns the same columns as `simulate` (t, x, v, alt, rho, F_drag, F_grav and
+  F_roll), every `record_every` meters.
+  """
+  result = integrate_batch(course, params, tolerance=tolerance, record_every=record_every)
+  x, v = result.x, result.v[0]
+
+  alt = np.interp(x, course.x, course.y)
+  theta = np.interp(x, course.x, course.a)
+  r = rider_constants(broadcast_params(params, {})[0])
+  rho = r["rho_scale"] * (Pb * np.exp((-G * M / R) * alt * r["inv_Tk"]) - r["humidity_term"])
+
+  return pd.DataFrame({
+    "t": result.t[0],
+    "x": x,
+    "v": v,
+    "alt": alt,
+    "rho": rho,
+    "F_drag": 0.5 * rho * params.cda * v**2,
+    "F_grav": G * params.mass_kg * np.sin(theta),
+    "F_roll": G * params.mass_kg * params.crr * np.cos(theta),
+  })
@@ -0,0 +1,336 @@
+import sys; sys.path.extend([".", "..", "../.."])
+
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from simulator import Pb, Course, Params, broadcast_params, load_course, rider_constants
+from integrator import LAUNCH_DISTANCE, interpolate_terms, launch
+
+
+# The distance (meters) between the steps of the simulation that evaluates plans. The
+# finish times are ~0.3% slow at 100m, but (nearly) all plans are off by the same
+# amount, so it's plenty for comparing them.
+DEFAULT_STEP = 100.0
+
+# The resolution (meters) that the forces are averaged at (see `make_track`).
+FINE_SPACING = 1.0
+
+# The default length (meters) of the segments that each get their own power target.
+DEFAULT_SEGMENT_LENGTH = 2000.0
+
+# The powers (watts) that the launch is precomputed for (see `make_track`).
+LAUNCH_POWERS = np.geomspace(20, 2000, 96)
+
+# The number of Newton iterations used to solve each (implicit) step of `evaluate`.
+NEWTON_ITERATIONS = 3
+
+# How much a plan is penalized for going over its average power or NP: each 1% over
+# costs `CONSTRAINT_PENALTY`% of its finish time.
+CONSTRAINT_PENALTY = 10.0
+
+
+def course_terms_at(course, x: np.ndarray):
+  """Returns the barometric term and the sin and cos of the grade at each distance in `x`.
+
+  The `course` can be a `Course` or a `CompiledCourse`.
+  """
+  if isinstance(course, Course):
+    return interpolate_terms(course, x)
+  baro, sin_theta, cos_theta, _ = course.lookup(x, None)
+  return baro, sin_theta, cos_theta
+
+
+def average_over(x: np.ndarray, values: np.ndarray, edges: np.ndarray) -> np.ndarray:
+  """Returns the average of `values` (sampled at `x`) between each pair of consecutive `edges` (trapezoidal rule)."""
+  integral = np.concatenate([[0], np.cumsum(0.5 * (values[1:] + values[:-1]) * np.diff(x))])
+  return np.diff(np.interp(edges, x, integral)) / np.diff(edges)
+
+
+@dataclass
+class Track:
+  """A course sampled every `step` meters, with the forces on one rider precomputed.
+
+  Only the power changes between plans, so the drag coefficient (`0.5 * rho * CdA`)
+  and the gravity and rolling resistance at each point are computed once.
+  """
+  course: object
+  params: Params
+  boundaries: np.ndarray # (K + 1,) the distances where the segments start and end
+  h: np.ndarray # (S,) the length of each step
+  segment: np.ndarray # (S,) the segment of each step
+  k_drag: np.ndarray # (S,) averaged over each step
+  F_course: np.ndarray # (S,) gravity + rolling resistance, averaged over each step
+  launch_t: np.ndarray # the time and velocity at the end of the launch, at each of `LAUNCH_POWERS`
+  launch_v: np.ndarray
+
+  def launch(self, power: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the time and velocity of riders at the end of the launch, given the power of each one."""
+    if power.min() < LAUNCH_POWERS[0] or power.max() > LAUNCH_POWERS[-1]:
+      r = rider_constants(broadcast_params(self.params, {"power_watts": power})[0])
+      return launch(lambda x: course_terms_at(self.course, x), r)
+    return np.interp(power, LAUNCH_POWERS, self.launch_t), np.interp(power, LAUNCH_POWERS, self.launch_v)
+
+
+def make_track(
+  course,
+  params: Params,
+  segment_length: float = DEFAULT_SEGMENT_LENGTH,
+  step: float = DEFAULT_STEP,
+) -> Track:
+  """Splits a course into segments of (about) `segment_length` meters, and samples it every (about) `step` meters."""
+  total_distance = course.total_distance
+  K = max(1, int(round(total_distance / segment_length)))
+  boundaries = np.linspace(0, total_distance, K + 1)
+
+  # Every segment has a whole number of steps, starting after the launch.
+  x = [np.array([LAUNCH_DISTANCE])]
+  for k in range(K):
+    start = max(boundaries[k], LAUNCH_DISTANCE)
+    if boundaries[k + 1] <= start:
+      continue
+    n = max(1, int(np.ceil((boundaries[k + 1] - start) / step)))
+    x.append(np.linspace(start, boundaries[k + 1], n + 1)[1:])
+  x = np.concatenate(x)
+  h = np.diff(x)
+  segment = np.minimum(np.searchsorted(boundaries, x[:-1], side="right") - 1, K - 1)
+
+  # Average the forces over each step (on a 1m grid), rather than sampling them at a
+  # few points, so that no hills are missed. This makes the work done against gravity
+  # over a step exact, however long it is.
+  r = rider_constants(broadcast_params(params, {})[0])
+  fine = np.arange(0, total_distance + FINE_SPACING, FINE_SPACING)
+  baro, sin_theta, cos_theta = course_terms_at(course, fine)
+  rho = r["rho_scale"] * (Pb * np.exp(baro * r["inv_Tk"]) - r["humidity_term"])
+  k_drag = average_over(fine, r["half_cda"] * rho, x)
+  F_course = average_over(fine, r["g_mass"] * sin_theta + r["g_mass_crr"] * cos_theta, x)
+
+  # The launch is the same for every plan with the same power in the first segment,
+  # and it takes as long to simulate one rider as a few hundred, so do it up front.
+  r = rider_constants(broadcast_params(params, {"power_watts": LAUNCH_POWERS})[0])
+  launch_t, launch_v = launch(lambda x: course_terms_at(course, x), r)
+
+  return Track(
+    course=course,
+    params=params,
+    boundaries=boundaries,
+    h=h,
+    segment=segment,
+    k_drag=k_drag,
+    F_course=F_course,
+    launch_t=launch_t,
+    launch_v=launch_v,
+  )
+
+
+@dataclass
+class Evaluation:
+  finish_time: np.ndarray # (N,)
+  segment_time: np.ndarray # (N, K)
+  average_power: np.ndarray # (N,) time-weighted
+  normalized_power: np.ndarray # (N,)
+
+
+def evaluate(track: Track, plans: np.ndarray) -> Evaluation:
+  """Simulates N power plans (an (N, K) array of watts per segment) at once.
+
+  Every plan is at the same distance at each step, so each step is a handful of
+  operations on (N,) arrays. On a slow climb the pedaling force (`P / v`) changes
+  quickly with the velocity, which makes explicit methods unstable unless the steps
+  are tiny, so each step is implicit: the trapezoidal rule for the kinetic energy,
+
+    m * (v1^2 - v0^2) / 2 = h * (F(v0) + F(v1)) / 2
+
+  solved for `v1` with a few Newton iterations. The minimum velocity is enforced
+  like in `integrator.integrate_batch`.
+  """
+  plans = np.atleast_2d(np.asarray(plans, dtype=np.float64))
+  N, K = plans.shape
+  params = track.params
+  # One contiguous row of (N,) powers per segment.
+  P = np.ascontiguousarray(plans.T) * (1 - 0.01 * params.loss_drivetrain)
+  v_min = max(params.velocity_min, 1)
+
+  t, v = track.launch(plans[:, 0])
+  v = np.maximum(v, v_min)
+
+  # Each step solves `g(v1) = a * v1^2 - q / v1 + c = 0`, where only `c` and `q`
+  # depend on the plan. `g` increases with `v1`, so Newton's method is well-behaved.
+  half_mass = 0.5 * params.mass_kg
+  half_h = 0.5 * track.h
+  a = (half_mass + half_h * track.k_drag).tolist()
+  b = (half_mass - half_h * track.k_drag).tolist()
+  two_f = (2 * half_h * track.F_course).tolist()
+  segment_time = np.zeros((N, K))
+  ends = np.append(np.flatnonzero(np.diff(track.segment)), len(track.h) - 1).tolist()
+
+  k, t_start = 0, 0
+  for i, half_h_i in enumerate(half_h.tolist()):
+    q = half_h_i * P[track.segment[i]]
+    inv_v = 1 / v
+    c = two_f[i] - b[i] * v * v - q * inv_v
+    v1 = v
+    for _ in range(NEWTON_ITERATIONS):
+      q_v1 = q / v1
+      v1 = np.maximum(v1 - (a[i] * v1 * v1 - q_v1 + c) / (2 * a[i] * v1 + q_v1 / v1), v_min)
+    t = t + half_h_i * (inv_v + 1 / v1)
+    v = v1
+
+    if i == ends[k]:
+      segment_time[:, track.segment[i]] = t - t_start
+      k, t_start = k + 1, t
+
+  finish_time = segment_time.sum(axis=1)
+  return Evaluation(
+    finish_time=finish_time,
+    segment_time=segment_time,
+    average_power=(segment_time * plans).sum(axis=1) / finish_time,
+    normalized_power=((segment_time * plans**4).sum(axis=1) / finish_time) ** 0.25,
+  )
+
+
+@dataclass
+class PacingPlan:
+  boundaries: np.ndarray # (K + 1,) meters
+  power: np.ndarray # (K,) watts
+  finish_time: float
+  segment_time: np.ndarray # (K,)
+  average_power: float
+  normalized_power: float
+  baseline_time: float # the finish time at a constant (average) power
+  iterations: int
+  evaluations: int
+
+  def to_frame(self) -> pd.DataFrame:
+    """Returns one row per segment."""
+    return pd.DataFrame({
+      "start": self.boundaries[:-1],
+      "end": self.boundaries[1:],
+      "power": self.power,
+      "time": self.segment_time,
+    })
+
+
+def rescale(track: Track, plan: np.ndarray, average_power: float, iterations: int = 3) -> np.ndarray:
+  """Scales a plan so that its (time-weighted) average power is `average_power`.
+
+  The segment times change with the power, so this takes a few rounds.
+  """
+  for _ in range(iterations):
+    plan = plan * (average_power / evaluate(track, plan[None]).average_power[0])
+  return plan
+
+
+def optimize(
+  track: Track,
+  average_power: float,
+  max_normalized_power: float | None = None,
+  population: int = 256,
+  elite_fraction: float = 0.1,
+  iterations: int = 40,
+  bounds: tuple[float, float] = (0.5, 1.5),
+  smoothing: float = 0.7,
+  seed: int = 0,
+) -> PacingPlan:
+  """Searches for the power of each segment that minimizes the finish time (cross-entropy method).
+
+  The time-weighted average power of a plan can't go over `average_power`, and its
+  normalized power (NP) can't go over `max_normalized_power` (if it's given). The
+  power of each segment stays within `bounds` (as a fraction of `average_power`).
+
+  Each iteration samples `population` plans around the current mean, evaluates
+  them in one batch, and moves the mean towards the best of them.
+  """
+  rng = np.random.default_rng(seed)
+  K = len(track.boundaries) - 1
+  lo, hi = bounds[0] * average_power, bounds[1] * average_power
+  max_np = max_normalized_power or np.inf
+
+  baseline = evaluate(track, np.full((1, K), average_power))
+  mean = np.full(K, float(average_power))
+  std = np.full(K, 0.15 * average_power)
+  best, best_score = mean.copy(), baseline.finish_time[0]
+  weights = baseline.segment_time[0] / baseline.finish_time[0]
+  n_elite = max(2, int(elite_fraction * population))
+
+  for _ in range(iterations):
+    plans = np.clip(rng.normal(mean, std, size=(population, K)), lo, hi)
+    # Aim every plan at the average power, using the segment times of the mean plan.
+    plans = np.clip(plans * (average_power / (plans @ weights))[:, None], lo, hi)
+    plans[0] = best
+
+    result = evaluate(track, plans)
+    violation = np.maximum(result.average_power / average_power - 1, 0) + np.maximum(result.normalized_power / max_np - 1, 0)
+    score = result.finish_time * (1 + CONSTRAINT_PENALTY * violation)
+
+    order = np.argsort(score)
+    elite = plans[order[:n_elite]]
+    mean = smoothing * elite.mean(axis=0) + (1 - smoothing) * mean
+    std = smoothing * elite.std(axis=0) + (1 - smoothing) * std
+
+    if score[order[0]] < best_score:
+      best, best_score = plans[order[0]].copy(), score[order[0]]
+    i = order[0]
+    weights = result.segment_time[i] / result.finish_time[i]
+
+  best = rescale(track, best, average_power)
+  result = evaluate(track, best[None])
+
+  return PacingPlan(
+    boundaries=track.boundaries,
+    power=best,
+    finish_time=float(result.finish_time[0]),
+    segment_time=result.segment_time[0],
+    average_power=float(result.average_power[0]),
+    normalized_power=float(result.normalized_power[0]),
+    baseline_time=float(baseline.finish_time[0]),
+    iterations=iterations,
+    evaluations=iterations * population,
+  )
+
+
+def main():
+  """Optimize the pacing of a course for a given average power (and NP)."""
+  from argparse import ArgumentParser
+  from compile_courses import compiled_folder, load_compiled
+  parser = ArgumentParser(description="Optimize the pacing of a course for a given average power (and NP).")
+  parser.add_argument("--course", type=str, default="IM_Lake_Placid_140.6", help="The name of a course in `app/public/courses`")
+  parser.add_argument("--power", type=float, default=200, help="The average power (watts)")
+  parser.add_argument("--max-np", type=float, default=None, help="The highest normalized power allowed (watts)")
+  parser.add_argument("--segment-length", type=float, default=DEFAULT_SEGMENT_LENGTH, help="The length of each segment (meters)")
+  parser.add_argument("--step", type=float, default=DEFAULT_STEP, help="The step of the simulation (meters)")
+  parser.add_argument("--population", type=int, default=256)
+  parser.add_argument("--iterations", type=int, default=40)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--out", type=str, default=None, help="Where to save the plan (CSV)")
+  args = parser.parse_args()
+
+  # Use the compiled course if there is one (see `compile_courses.py`).
+  try:
+    course = load_compiled(args.course, compiled_folder())
+  except KeyError:
+    course = load_course(args.course)
+
+  params = Params(power_watts=args.power)
+  track = make_track(course, params, segment_length=args.segment_length, step=args.step)
+  plan = optimize(
+    track,
+    args.power,
+    max_normalized_power=args.max_np,
+    population=args.population,
+    iterations=args.iterations,
+    seed=args.seed,
+  )
+
+  print(plan.to_frame().round(1).to_string(index=False))
+  print(f"Finish time: {plan.finish_time:.0f}s (vs {plan.baseline_time:.0f}s at a constant {args.power:.0f}W)")
+  print(f"Average power: {plan.average_power:.1f}W, NP: {plan.normalized_power:.1f}W")
+
+  if args.out is not None:
+    plan.to_frame().to_csv(args.out, index=False)
+  print("DONE")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,316 @@
+import sys; sys.path.extend([".", "..", "../.."])
+
+import json
+import math
+import os
+from bisect import bisect_left
+from dataclasses import dataclass, field, fields
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+
+from utils.paths import courses_folder
+
+
+# Constants that control the simulation (the same as `simulator.ts` in the app).
+G = 9.80665 # m/s2
+M = 0.0289644 # kg/mol, molar mass of Earth's air
+R = 8.3144598 # N·m/(mol·K), universal gas constant
+Pb = 101325 # Pa
+ZERO_CELSIUS_KELVIN = 273.15
+
+# The minimum velocity is only enforced after this many iterations, so the rider can get going.
+OVERRIDE_AFTER_ITERS = 50
+
+
+@dataclass
+class Params:
+  """The configuration of a simulation. The defaults match the bike simulator in the app."""
+  power_watts: float = 250
+  cda: float = 0.28 # m^2
+  crr: float = 0.00375
+  loss_drivetrain: float = 4.7 # percent
+  mass_bike_kg: float = 10
+  mass_rider_kg: float = 75
+  temp_celsius: float = 20
+  relative_humidity: float = 0 # percent (0-100)
+  velocity_min: float = 1 # m/s
+  timestep: float = 0.1 # s
+
+  @property
+  def mass_kg(self) -> float:
+    return self.mass_bike_kg + self.mass_rider_kg
+
+
+@dataclass
+class Course:
+  """A bike course, as distance (`x`), altitude (`y`) and grade angle (`a`, radians) arrays."""
+  name: str
+  x: np.ndarray
+  y: np.ndarray
+  a: np.ndarray
+  meta: dict = field(default_factory=dict)
+
+  @property
+  def total_distance(self) -> float:
+    """The exact distance of the course file, rather than the assumed race distance."""
+    return float(self.x[-1]) if len(self.x) > 0 else self.meta["totalDistanceMeters"]
+
+  @cached_property
+  def segments(self) -> np.ndarray:
+    """An (n - 1, 7) array with `x0`, `x1`, `1 / (x1 - x0)`, `y0`, `dy`, `a0` and `da` for each segment of the course.
+
+    Segment `i` goes from point `i` to point `i + 1`, so it's the `cursor` of a rider between them (see `lookup`).
+    Keeping a segment in one row means a lookup is a single gather.
+    """
+    dx = np.diff(self.x)
+    with np.errstate(divide="ignore"):
+      inv_dx = np.where(dx > 0, 1 / dx, 0)
+    return np.ascontiguousarray(np.stack([self.x[:-1], self.x[1:], inv_dx, self.y[:-1], np.diff(self.y), self.a[:-1], np.diff(self.a)], axis=1))
+
+  def lookup(self, x: np.ndarray, cursor: np.ndarray):
+    """Returns the barometric term (`-G * M * y / R`) and the sin and cos of the grade at each distance in `x`.
+
+    `cursor` is the segment that each rider was on at the last step. Riders only
+    move a fraction of a segment per step, so rather than searching the whole
+    course, each cursor is moved until its segment contains `x`. The updated
+    cursor is returned too.
+    """
+    rows_of = self.segments
+    last = len(rows_of) - 1
+    while True:
+      rows = np.take(rows_of, cursor, axis=0)
+      forward = (rows[:, 1] < x) & (cursor < last)
+      back = (rows[:, 0] >= x) & (cursor > 0)
+      if not (forward.any() or back.any()):
+        break
+      cursor = cursor + forward - back
+
+    alpha = np.minimum(np.maximum((x - rows[:, 0]) * rows[:, 2], 0), 1)
+    alt = rows[:, 3] + rows[:, 4] * alpha
+    theta = rows[:, 5] + rows[:, 6] * alpha
+    return (-G * M / R) * alt, np.sin(theta), np.cos(theta), cursor
+
+
+def load_course(name: str) -> Course:
+  """Loads a course file, given its path or its name in `app/public/courses` (e.g "IM_Boulder_70.3")."""
+  path = name if os.path.exists(name) else courses_folder(f"{name}.json")
+
+  with open(path, "r") as f:
+    data = json.load(f)
+
+  points = data["data"]
+  return Course(
+    name=os.path.basename(path).replace(".json", ""),
+    x=np.array([p["x"] for p in points], dtype=np.float64),
+    y=np.array([p["y"] for p in points], dtype=np.float64),
+    a=np.array([p["a"] for p in points], dtype=np.float64),
+    meta=data.get("meta", {}),
+  )
+
+
+def saturation_pressure(Tk):
+  """Returns the saturation vapor pressure (Pa) at a temperature in Kelvin (Tetens equation)."""
+  Tc = np.asarray(Tk, dtype=np.float64) - ZERO_CELSIUS_KELVIN
+  return np.where(
+    Tc < 0,
+    611 * np.exp(21.875 * Tc / (Tc + 265.5)),
+    611 * np.exp(17.27 * Tc / (Tc + 237.3)),
+  )
+
+
+def get_rho(y, Tk, RH):
+  """Returns the air density (kg/m^3) at an altitude `y` (m), temperature `Tk` (K) and relative humidity `RH` (0-1)."""
+  pressure = Pb * np.exp((-G * M * np.asarray(y)) / (R * np.asarray(Tk)))
+  return 0.0034848 * (pressure - 0.0037960 * np.asarray(RH) * saturation_pressure(Tk)) / Tk
+
+
+@dataclass
+class SimulationResult:
+  states: pd.DataFrame # t, x, v, alt, rho, F_drag, F_grav, F_roll at each timestep
+  overrides: int # the number of timesteps where the rider had to go above the target power
+  meta: dict
+
+  @property
+  def finish_time(self) -> float:
+    return float(self.states.t.iloc[-1])
+
+
+def simulate(course: Course, params: Params) -> SimulationResult:
+  """Simulates a ride with constant power, one timestep at a time.
+
+  This is a port of `simulate` in `simulator.ts` (a simple Euler integration of
+  the forces acting on the bike), and is the reference for `simulate_batch`.
+  """
+  xs = course.x.tolist()
+  ys = course.y.tolist()
+  as_ = course.a.tolist()
+  n = len(xs)
+
+  total_distance = course.total_distance
+  mass = params.mass_kg
+  dt = params.timestep
+  Tk = params.temp_celsius + ZERO_CELSIUS_KELVIN
+  RH = params.relative_humidity / 100
+  humidity_term = 0.0037960 * RH * float(saturation_pressure(Tk))
+  F_legs = params.power_watts * (1 - 0.01 * params.loss_drivetrain)
+
+  states = {k: [] for k in ("t", "x", "v", "alt", "rho", "F_drag", "F_grav", "F_roll")}
+  overrides = 0
+
+  t, x, v = 0.0, 0.0, 0.0
+  iter = 1
+  while x < total_distance:
+    i1 = min(max(bisect_left(xs, x), 1), n - 1)
+    i0 = i1 - 1
+    alpha = min(1.0, max(0.0, (x - xs[i0]) / (xs[i1] - xs[i0]))) if xs[i1] > xs[i0] else 0.0
+    alt = ys[i0] * (1 - alpha) + ys[i1] * alpha
+    theta = as_[i0] * (1 - alpha) + as_[i1] * alpha
+    rho = 0.0034848 * (Pb * math.exp((-G * M * alt) / (R * Tk)) - humidity_term) / Tk
+
+    F_dt = F_legs / max(v, 1)
+    F_drag = 0.5 * rho * params.cda * v**2
+    F_grav = G * mass * math.sin(theta)
+    F_roll = G * mass * params.crr * math.cos(theta)
+
+    # Check if velocity will go zero or negative and override.
+    F_min = F_drag + F_grav + F_roll + (mass * (params.velocity_min - v)) / dt
+    if iter > OVERRIDE_AFTER_ITERS and F_dt < F_min:
+      F_dt = F_min
+      overrides += 1
+
+    a = (F_dt - F_drag - F_grav - F_roll) / mass
+    x = x + dt * v
+    v = v + dt * a
+    t = t + dt
+
+    for k, value in (("t", t), ("x", x), ("v", v), ("alt", alt), ("rho", rho), ("F_drag", F_drag), ("F_grav", F_grav), ("F_roll", F_roll)):
+      states[k].append(value)
+
+    iter += 1
+
+  return SimulationResult(
+    states=pd.DataFrame(states),
+    overrides=overrides,
+    meta={**course.meta, "computeIters": iter},
+  )
+
+
+def broadcast_params(params: Params, sweep: dict) -> tuple[dict[str, np.ndarray], tuple]:
+  """Broadcasts the arrays in `sweep` (any fields of `Params` except `timestep`) together.
+
+  Returns a flat array for every field (taken from `params` if it isn't in `sweep`),
+  and the shape that the arrays were broadcast to.
+  """
+  names = [f.name for f in fields(Params) if f.name != "timestep"]
+  unknown = set(sweep) - set(names)
+  if unknown:
+    raise ValueError(f"Unknown parameters: {sorted(unknown)}")
+
+  arrays = np.broadcast_arrays(*[np.asarray(sweep.get(name, getattr(params, name)), dtype=np.float64) for name in names])
+  return {name: a.ravel() for name, a in zip(names, arrays)}, arrays[0].shape
+
+
+def rider_constants(values: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+  """Computes everything that only depends on the parameters once per rider (see `broadcast_params`)."""
+  Tk = values["temp_celsius"] + ZERO_CELSIUS_KELVIN
+  mass = values["mass_bike_kg"] + values["mass_rider_kg"]
+  return {
+    "mass": mass,
+    "F_legs": values["power_watts"] * (1 - 0.01 * values["loss_drivetrain"]),
+    "rho_scale": 0.0034848 / Tk,
+    "inv_Tk": 1 / Tk,
+    "humidity_term": 0.0037960 * (values["relative_humidity"] / 100) * saturation_pressure(Tk),
+    "half_cda": 0.5 * values["cda"],
+    "g_mass": G * mass,
+    "g_mass_crr": G * mass * values["crr"],
+    "v_min": values["velocity_min"],
+  }
+
+
+@dataclass
+class BatchResult:
+  finish_time: np.ndarray # (N,) seconds
+  overrides: np.ndarray # (N,) the number of timesteps where each rider had to go above the target power
+  iters: int # the number of timesteps until the slowest rider finished
+
+
+def simulate_batch(course, params: Params | None = None, **sweep) -> BatchResult:
+  """Simulates N riders on the same course at once.
+
+  Any field of `Params` (except `timestep`) can be passed as an array, and the
+  arrays are broadcast together. Every other field comes from `params`. For example:
+
+  ```python
+  simulate_batch(course, power_watts=[200, 250, 300], cda=0.25)
+  ```
+
+  The `course` can be a `Course`, or a `CompiledCourse` (see `compile_courses.py`).
+  Each rider follows the same steps as `simulate`. Riders are dropped
+  from the batch as they finish, so the cost of a step only depends on how many
+  are still riding.
+  """
+  params = params or Params()
+  if np.ndim(sweep.get("timestep", params.timestep)) != 0:
+    raise ValueError("All of the riders in a batch have to use the same timestep.")
+
+  values, shape = broadcast_params(params, {k: v for k, v in sweep.items() if k != "timestep"})
+  n = values["power_watts"].size
+  dt = float(sweep.get("timestep", params.timestep))
+  total_distance = course.total_distance
+
+  # Each of these arrays (and the state of the riders) shrinks as riders finish.
+  riders = {
+    "id": np.arange(n),
+    "x": np.zeros(n),
+    "v": np.zeros(n),
+    "cursor": np.zeros(n, dtype=np.int64),
+    "overrides": np.zeros(n, dtype=np.int64),
+    **rider_constants(values),
+  }
+
+  finish_time = np.full(n, np.nan)
+  overrides = np.zeros(n, dtype=np.int64)
+
+  iter = 1
+  while len(riders["id"]) > 0:
+    r = riders
+    x, v = r["x"], r["v"]
+
+    baro, sin_theta, cos_theta, r["cursor"] = course.lookup(x, r["cursor"])
+    rho = r["rho_scale"] * (Pb * np.exp(baro * r["inv_Tk"]) - r["humidity_term"])
+
+    F_dt = r["F_legs"] / np.maximum(v, 1)
+    F_resist = r["half_cda"] * rho * v**2 + r["g_mass"] * sin_theta + r["g_mass_crr"] * cos_theta
+
+    if iter > OVERRIDE_AFTER_ITERS:
+      F_min = F_resist + r["mass"] * (r["v_min"] - v) / dt
+      override = F_dt < F_min
+      F_dt = np.where(override, F_min, F_dt)
+      r["overrides"] += override
+
+    r["x"] = x + dt * v
+    r["v"] = v + dt * (F_dt - F_resist) / r["mass"]
+
+    done = r["x"] >= total_distance
+    if done.any():
+      finish_time[r["id"][done]] = iter * dt
+      overrides[r["id"][done]] = r["overrides"][done]
+      riders = {k: a[~done] for k, a in r.items()}
+
+    iter += 1
+
+  return BatchResult(finish_time=finish_time.reshape(shape), overrides=overrides.reshape(shape), iters=iter - 1)
+
+
+def sweep(course, params: Params | None = None, **axes) -> pd.DataFrame:
+  """Simulates every combination of the values in `axes` (e.g `power_watts=[200, 250], cda=[0.25, 0.3]`).
+
+  Returns one row per combination, with the swept parameters, `finish_time` and `overrides`.
+  """
+  grids = np.meshgrid(*[np.asarray(v, dtype=np.float64) for v in axes.values()], indexing="ij")
+  columns = {name: g.ravel() for name, g in zip(axes, grids)}
+  result = simulate_batch(course, params, **columns)
+  return pd.DataFrame({**columns, "finish_time": result.finish_time, "overrides": result.overrides})
+
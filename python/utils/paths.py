@@ -29,4 +29,9 @@ def make_directory(filepath: str):
 
 def containing_folder(filepath: str) -> str:
   """Returns the folder containing `filepath`."""
-  return os.path.dirname(os.path.realpath(filepath))
\ No newline at end of file
+  return os.path.dirname(os.path.realpath(filepath))
+
+
+def courses_folder(relative_path: str = "") -> str:
+  """Returns a path relative to the folder of bike courses that the app uses."""
+  return os.path.join(top_folder("../app/public/courses"), relative_path)
@@ -0,0 +1,151 @@
+import glob
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from utils.paths import data_folder, make_directory
+
+
+def _category() -> pa.DataType:
+  return pa.dictionary(pa.int16(), pa.string())
+
+
+# The columns that could identify a person. The anonymized view leaves these out.
+IDENTIFYING_COLUMNS = ["ContactFullName", "BibNumber", "ContactId"]
+
+# The split times (in seconds).
+TIME_COLUMNS = ["SwimTime", "Transition1Time", "BikeTime", "Transition2Time", "RunTime", "FinishTime"]
+
+# Every file in the store is written with this schema, so that the dataset can be
+# read as a whole (even if a column happens to be empty for one subevent).
+#
+# Low-cardinality strings are dictionary-encoded and the split times are stored as
+# integers. The `*Converted` string versions of the times are left out, since they
+# are just a formatted copy of the integer columns.
+SCHEMA = pa.schema([
+  ("SubEventId", pa.string()),
+  ("SubeventName", _category()),
+  ("ResultId", pa.string()),
+  ("ContactId", pa.string()),
+  ("ContactFullName", pa.string()),
+  ("ContactGender", _category()),
+  ("BibNumber", pa.int32()),
+  ("AgeGroup", _category()),
+  ("CountryISO2", _category()),
+  ("CountryRepresentingISONumeric", pa.int16()),
+  ("EventStatus", _category()),
+  ("StatusCode", pa.int16()),
+  ("SwimTime", pa.int32()),
+  ("Transition1Time", pa.int32()),
+  ("BikeTime", pa.int32()),
+  ("Transition2Time", pa.int32()),
+  ("RunTime", pa.int32()),
+  ("FinishTime", pa.int32()),
+  ("FinishRankGroup", pa.int32()),
+  ("FinishRankGender", pa.int32()),
+  ("FinishRankOverall", pa.int32()),
+  ("SwimRankGroup", pa.int32()),
+  ("SwimRankGender", pa.int32()),
+  ("SwimRankOverall", pa.int32()),
+  ("BikeRankGroup", pa.int32()),
+  ("BikeRankGender", pa.int32()),
+  ("BikeRankOverall", pa.int32()),
+  ("RunRankGroup", pa.int32()),
+  ("RunRankGender", pa.int32()),
+  ("RunRankOverall", pa.int32()),
+  ("RankPoints", pa.int32()),
+  ("SyncDate", pa.string()),
+])
+
+# The dataset is partitioned by series and year, e.g `series=IRONMAN-70.3/year=2021/<subevent_id>.parquet`.
+PARTITION_SCHEMA = pa.schema([("series", pa.string()), ("year", pa.int16())])
+PARTITIONING = ds.partitioning(PARTITION_SCHEMA, flavor="hive")
+
+
+def store_folder(relative_path: str = "") -> str:
+  """Returns a path relative to the results store."""
+  return data_folder(os.path.join("im/parquet", relative_path))
+
+
+def store_path(subevent_id: str, series: str, year: int) -> str:
+  """Returns the path to the file for a subevent in the results store."""
+  return store_folder(f"series={series}/year={int(year)}/{subevent_id}.parquet")
+
+
+def list_subevents(folder: str | None = None) -> dict[str, str]:
+  """Returns the path to the file of each subevent in the store, keyed by subevent ID."""
+  pattern = os.path.join(folder or store_folder(), "series=*", "year=*", "*.parquet")
+  return {os.path.basename(path).replace(".parquet", ""): path for path in glob.glob(pattern)}
+
+
+def to_table(df: pd.DataFrame) -> pa.Table:
+  """Converts a (flattened) results dataframe to a table with the store's schema.
+
+  Columns that aren't in the schema are dropped, and missing columns are filled with nulls.
+  """
+  df = df.reindex(columns=SCHEMA.names)
+
+  for field in SCHEMA:
+    if pa.types.is_dictionary(field.type):
+      # Go through strings, so that the categories are strings even if the column is all null.
+      df[field.name] = df[field.name].astype("string").astype("category")
+    elif pa.types.is_integer(field.type):
+      # Use nullable integers so that missing values don't turn the column into floats.
+      df[field.name] = pd.to_numeric(df[field.name], errors="coerce").round().astype("Int64")
+    else:
+      df[field.name] = df[field.name].astype("string")
+
+  return pa.Table.from_pandas(df, schema=SCHEMA, preserve_index=False)
+
+
+def write_subevent(df: pd.DataFrame, subevent_id: str, series: str, year: int) -> str:
+  """Writes the results of a subevent to the store and returns the path."""
+  path = store_path(subevent_id, series, year)
+  make_directory(path)
+  pq.write_table(to_table(df), path, compression="zstd")
+  return path
+
+
+def dataset() -> ds.Dataset:
+  """Returns the results store as a `pyarrow` dataset (nothing is read yet)."""
+  schema = pa.unify_schemas([SCHEMA, PARTITION_SCHEMA])
+  return ds.dataset(store_folder(), schema=schema, format="parquet", partitioning=PARTITIONING)
+
+
+def read_results(
+  columns: list[str] | None = None,
+  series: list[str] | None = None,
+  years: list[int] | None = None,
+  subevent_ids: list[str] | None = None,
+  anonymized: bool = True,
+) -> pd.DataFrame:
+  """Reads results from the store.
+
+  Only the requested `columns` are read from disk, and partitions that don't match
+  `series` or `years` are skipped entirely. For example, to get every bike split
+  from the 70.3 races in 2023:
+
+  ```python
+  read_results(columns=["AgeGroup", "BikeTime"], series=["IRONMAN-70.3"], years=[2023])
+  ```
+
+  If `anonymized` is True, the columns that could identify a person are left out.
+  """
+  if columns is None:
+    columns = SCHEMA.names + PARTITION_SCHEMA.names
+    if anonymized:
+      columns = [c for c in columns if c not in IDENTIFYING_COLUMNS]
+
+  if anonymized and any(c in IDENTIFYING_COLUMNS for c in columns):
+    raise ValueError(f"The anonymized view doesn't include the columns {IDENTIFYING_COLUMNS}.")
+
+  filter = None
+  for name, values in (("series", series), ("year", years), ("SubEventId", subevent_ids)):
+    if values is not None:
+      expression = ds.field(name).isin(values)
+      filter = expression if filter is None else filter & expression
+
+  return dataset().to_table(columns=columns, filter=filter).to_pandas()